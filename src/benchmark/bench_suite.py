@@ -0,0 +1,292 @@
+import os
+import sys
+import json
+import math
+import time
+import shlex
+import platform
+import argparse
+import threading
+import subprocess
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmark.mock_server import add_server_args, behavior_from_args, serve_in_background
+from benchmark.run_mock import SRC_DIR, BENCHMARK_DIR, TASKS, write_slice, stage_command, count_output
+
+# 本地transformers推理脚本和model_result脚本（不走接口）
+LOCAL_ANSWER = {
+    "chemprot": "model_answer_generation/chemprot_answer.py",
+    "biored": "model_answer_generation/biored_answer.py",
+    "bioasq": "model_answer_generation/bioASQ_answer.py",
+}
+RESULT = {
+    "chemprot": "model_result/chemprot_test_result.py",
+    "biored": "model_result/biored_test_result.py",
+    "bioasq": "model_result/bioASQ_test_result.py",
+}
+SUITE_STAGES = ("answer", "test", "result", "gpt")
+
+def percentile(values, p):
+    """最近秩法分位数，values为空时返回None"""
+    if not values:
+        return None
+    values = sorted(values)
+    rank = max(1, math.ceil(p / 100 * len(values)))
+    return values[min(rank, len(values)) - 1]
+
+def latency_summary(values, source):
+    if not values:
+        return {"source": source, "count": 0}
+    return {
+        "source": source,
+        "count": len(values),
+        "mean_ms": round(sum(values) / len(values), 1),
+        "p50_ms": round(percentile(values, 50), 1),
+        "p95_ms": round(percentile(values, 95), 1),
+        "p99_ms": round(percentile(values, 99), 1),
+    }
+
+class OutputWatcher:
+    """
+    轮询输出文件，记录每条新记录出现的时间；相邻两条的间隔作为逐条耗时
+    （本地逐条推理时即单条延迟，批量或并发时只反映出结果的节奏）。
+    """
+    def __init__(self, path, interval=0.05):
+        self.path = path
+        self.interval = interval
+        self.arrivals = []
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.start_time = time.time()
+        self.thread.start()
+        return self
+
+    def run(self):
+        offset = 0
+        pending = b""
+        while True:
+            stopping = self.stop_event.is_set()
+            if os.path.exists(self.path):
+                with open(self.path, "rb") as f:
+                    f.seek(offset)
+                    data = f.read()
+                offset += len(data)
+                pending += data
+                now = time.time()
+                while b"\n" in pending:
+                    line, pending = pending.split(b"\n", 1)
+                    if line.strip():
+                        self.arrivals.append(now)
+            if stopping:
+                break
+            self.stop_event.wait(self.interval)
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+        times = [self.start_time] + self.arrivals
+        return [(b - a) * 1000 for a, b in zip(times, times[1:])]
+
+def maxrss_mb(rusage):
+    # Linux上ru_maxrss单位为KB，macOS上为字节
+    if sys.platform == "darwin":
+        return round(rusage.ru_maxrss / 1024 / 1024, 1)
+    return round(rusage.ru_maxrss / 1024, 1)
+
+def run_measured(cmd, output=None, server=None, timeout=None):
+    """
+    运行一个阶段并统计：耗时、吞吐、逐条延迟分位数、峰值RSS和CPU时间。
+    用os.wait4回收子进程，拿到的是这一个子进程（含其已回收的子进程）的资源用量，不与其他阶段混在一起。
+    """
+    if server is not None:
+        server.stats.reset()
+    watcher = OutputWatcher(output).start() if output else None
+    start = time.time()
+    proc = subprocess.Popen(cmd)
+    deadline = start + timeout if timeout else None
+    while True:
+        pid, status, rusage = os.wait4(proc.pid, os.WNOHANG)
+        if pid:
+            break
+        if deadline and time.time() > deadline:
+            proc.kill()
+            pid, status, rusage = os.wait4(proc.pid, 0)
+            break
+        time.sleep(0.02)
+    elapsed = time.time() - start
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    arrivals = watcher.stop() if watcher else []
+    ok, failed = count_output(output)
+
+    # 走模拟接口的阶段用服务端记录的逐请求延迟，其余阶段用输出间隔
+    samples = server.stats.latency_samples() if server is not None else []
+    if samples:
+        latency = latency_summary(samples, "mock_request")
+    else:
+        latency = latency_summary(arrivals, "output_interval")
+    server_stats = server.stats.snapshot() if server is not None else None
+    return {
+        "command": " ".join(shlex.quote(c) for c in cmd),
+        "returncode": proc.returncode,
+        "elapsed_s": round(elapsed, 3),
+        "records_ok": ok,
+        "records_failed": failed,
+        "items_per_s": round(ok / elapsed, 3) if output and elapsed > 0 else None,
+        "latency": latency,
+        "peak_rss_mb": maxrss_mb(rusage),
+        "cpu_user_s": round(rusage.ru_utime, 3),
+        "cpu_sys_s": round(rusage.ru_stime, 3),
+        "cpu_s": round(rusage.ru_utime + rusage.ru_stime, 3),
+        "server": server_stats,
+    }
+
+def git_info():
+    def git(*args):
+        try:
+            return subprocess.run(["git", *args], capture_output=True, text=True, cwd=SRC_DIR).stdout.strip()
+        except OSError:
+            return ""
+    return {"commit": git("rev-parse", "--short", "HEAD"), "dirty": bool(git("status", "--porcelain", "--untracked-files=no"))}
+
+def build_plan(args, task, workdir):
+    """返回[(stage, variant, cmd, output, 是否走模拟接口)]"""
+    plan = []
+    extra = shlex.split(args.extra_args)
+    for stage in args.stages:
+        if stage == "answer":
+            cmd, output = stage_command(task, "answer", workdir, args.model)
+            plan.append(("answer", "api", cmd + extra + shlex.split(args.answer_args), output, True))
+            if args.local_model_dir:
+                output = os.path.join(workdir, f"{task}-answer-local.json")
+                cmd = [sys.executable, os.path.join(SRC_DIR, LOCAL_ANSWER[task]), "--model_dir", args.local_model_dir,
+                       "--input", os.path.join(workdir, f"{task}-benchmark.json"), "--output", output,
+                       "--log", os.path.join(workdir, f"{task}-answer-local.log"),
+                       "--max_new_tokens", str(args.local_max_new_tokens), "--device", args.device]
+                plan.append(("answer", "local", cmd + shlex.split(args.local_args), output, False))
+        elif stage == "test":
+            cmd, output = stage_command(task, "test", workdir, args.model)
+            plan.append(("test", "api", cmd + extra + shlex.split(args.test_args), output, True))
+        elif stage == "gpt":
+            cmd, output = stage_command(task, "gpt", workdir, args.model)
+            plan.append(("gpt", "api", cmd + extra + shlex.split(args.gpt_args), output, True))
+        elif stage == "result":
+            test_output = os.path.join(workdir, f"{task}-test.json")
+            report = os.path.join(workdir, f"{task}-result.txt")
+            # 报告类脚本输入未变化时会按manifest跳过，计时的是跳过而不是计算，基准里一律强制重算
+            cmd = [sys.executable, os.path.join(SRC_DIR, RESULT[task]), "--test", test_output, "--result", report, "--force"]
+            if task != "bioasq":
+                cmd += ["--benchmark", os.path.join(workdir, f"{task}-benchmark.json")]
+            plan.append(("result", "label", cmd, None, False))
+            if task == "bioasq" and args.bert:
+                cmd = [sys.executable, os.path.join(SRC_DIR, "model_result/bioASQ_bert_result.py"),
+                       "--benchmark", os.path.join(workdir, f"{task}-benchmark.json"),
+                       "--answer", os.path.join(workdir, f"{task}-answer.json"),
+                       "--result", os.path.join(workdir, f"{task}-bert.txt"),
+                       "--log", os.path.join(workdir, f"{task}-bert.log"), "--force"]
+                plan.append(("result", "bert", cmd, None, False))
+    return plan
+
+def compare(current, baseline_path):
+    """与之前保存的结果按(task, stage, variant)对比吞吐"""
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+    old = {(r["task"], r["stage"], r["variant"]): r for r in baseline["results"]}
+    print(f"对比基线 {baseline_path}（commit {baseline['meta'].get('git', {}).get('commit')}）：")
+    for r in current:
+        b = old.get((r["task"], r["stage"], r["variant"]))
+        if not b:
+            continue
+        def ratio(key):
+            if r.get(key) and b.get(key):
+                return f"{r[key] / b[key]:.2f}x"
+            return "-"
+        print(f"  {r['task']}/{r['stage']}/{r['variant']}：耗时 {b['elapsed_s']}s -> {r['elapsed_s']}s，"
+              f"吞吐 {ratio('items_per_s')}，CPU {b['cpu_s']}s -> {r['cpu_s']}s，"
+              f"峰值RSS {b['peak_rss_mb']}MB -> {r['peak_rss_mb']}MB")
+
+def main():
+    parser = argparse.ArgumentParser(description="流水线各阶段吞吐基准：固定条数切片，LLM阶段走本地模拟接口")
+    parser.add_argument("--tasks", default="chemprot,biored,bioasq", help="任务，逗号分隔")
+    parser.add_argument("--stages", default="answer,test,result,gpt", help="阶段，逗号分隔：answer,test,result,gpt")
+    parser.add_argument("--limit", type=int, default=100, help="每个benchmark取前多少条")
+    parser.add_argument("--workdir", default="benchmark_runs/suite", help="切片输入和各阶段输出的目录")
+    parser.add_argument("--save", default=None, help="结果JSON路径，默认 benchmark_runs/results/<时间>-<commit>.json")
+    parser.add_argument("--compare", default=None, help="与之前保存的结果JSON对比吞吐")
+    parser.add_argument("--model", default="mock-model", help="请求中的模型名称")
+    parser.add_argument("--extra_args", default="", help="追加给所有API阶段脚本的参数，如 \"--threads 8\"")
+    parser.add_argument("--answer_args", default="", help="只追加给API answer阶段的参数")
+    parser.add_argument("--test_args", default="", help="只追加给test阶段的参数")
+    parser.add_argument("--gpt_args", default="", help="只追加给gpt阶段的参数")
+    parser.add_argument("--local_model_dir", default=None,
+                        help="小型本地transformers模型目录，给出时answer阶段另跑一遍本地推理脚本")
+    parser.add_argument("--local_max_new_tokens", type=int, default=32, help="本地推理的max_new_tokens")
+    parser.add_argument("--local_args", default="", help="追加给本地推理脚本的参数，如 \"--batch_size 8\"")
+    parser.add_argument("--device", default="cpu", help="本地推理设备")
+    parser.add_argument("--bert", action="store_true", help="result阶段对bioasq另跑bioASQ_bert_result.py")
+    parser.add_argument("--timeout", type=float, default=None, help="单个阶段的超时秒数")
+    add_server_args(parser)
+    parser.set_defaults(latency_ms=200, seed=0)
+    args = parser.parse_args()
+    args.stages = [s.strip() for s in args.stages.split(",") if s.strip()]
+    tasks = [t.strip().lower() for t in args.tasks.split(",") if t.strip()]
+    for stage in args.stages:
+        if stage not in SUITE_STAGES:
+            parser.error(f"未知阶段：{stage}")
+    for task in tasks:
+        if task not in TASKS:
+            parser.error(f"未知任务：{task}")
+
+    server, base_url = serve_in_background(behavior_from_args(args), request_log=args.request_log)
+    results = []
+    try:
+        for task in tasks:
+            workdir = os.path.join(args.workdir, task)
+            os.makedirs(workdir, exist_ok=True)
+            n = write_slice(os.path.join(BENCHMARK_DIR, TASKS[task]["benchmark"]),
+                            os.path.join(workdir, f"{task}-benchmark.json"), args.limit)
+            for stage, variant, cmd, output, use_mock in build_plan(args, task, workdir):
+                # 每次都从头跑，避免断点续跑跳过已有结果
+                if output and os.path.exists(output):
+                    os.remove(output)
+                if use_mock:
+                    cmd = cmd + ["--base_url", base_url, "--api_key", "mock-key"]
+                result = run_measured(cmd, output, server if use_mock else None, args.timeout)
+                # result阶段只写汇总报告，吞吐按输入条数算
+                if output is None and result["returncode"] == 0 and result["elapsed_s"] > 0:
+                    result["items_per_s"] = round(n / result["elapsed_s"], 3)
+                result = dict(task=task, stage=stage, variant=variant, items=n, **result)
+                results.append(result)
+                lat = result["latency"]
+                print(f"[{task}/{stage}/{variant}] 退出码{result['returncode']}，耗时{result['elapsed_s']}s，"
+                      f"{result['items_per_s']}条/秒，p50/p95/p99={lat.get('p50_ms')}/{lat.get('p95_ms')}/{lat.get('p99_ms')}ms，"
+                      f"峰值RSS {result['peak_rss_mb']}MB，CPU {result['cpu_s']}s")
+    finally:
+        server.shutdown()
+        server.stats.close()
+        server.server_close()
+
+    git = git_info()
+    meta = {
+        "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "git": git,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "args": vars(args),
+    }
+    save = args.save or os.path.join(
+        "benchmark_runs", "results", f"{time.strftime('%Y%m%d-%H%M%S')}-{git['commit'] or 'nogit'}.json"
+    )
+    save_dir = os.path.dirname(save)
+    if save_dir:
+        os.makedirs(save_dir, exist_ok=True)
+    with open(save, "w", encoding="utf-8") as f:
+        json.dump({"meta": meta, "results": results}, f, ensure_ascii=False, indent=2)
+    print(f"基准结果已保存到 {save}")
+    if args.compare:
+        compare(results, args.compare)
+
+if __name__ == "__main__":
+    main()
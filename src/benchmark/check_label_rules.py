@@ -0,0 +1,135 @@
+import os
+import sys
+import glob
+import json
+import argparse
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.checkpoint import load_records
+from common.label_rules import (
+    BIORED_ALIASES, BIORED_LABELS, CHEMPROT_ALIASES, CHEMPROT_LABELS, extract_candidate_labels, extract_label
+)
+
+# 回归用例：(benchmark, 模型输出, 期望标签, 期望规则)，取自已有answer文件中规则解析曾经出错的真实输出（截取结尾部分）
+CASES = [
+    # 解释里括号中的标签不算答案，"OUTPUT:"才是
+    ("chemprot",
+     "3. **CPR Category Mismatch**: None of the CPR categories fit:\n"
+     "   - No up/down-regulation (CPR:3/4)\n"
+     "   - No agonist/antagonist activity (CPR:5/6)\n"
+     "   - No substrate/product relationship (CPR:9)\n\n"
+     "**OUTPUT:**  \nfalse",
+     "false", "marker"),
+    ("chemprot",
+     "- \"Affinity\" indicates binding strength but does not specify:\n"
+     "  - Regulatory action (up/down regulation → CPR:3/4)\n"
+     "  - Agonist/antagonist activity (CPR:5/6)\n"
+     "  - Substrate/product relationship (CPR:9)\n"
+     "- No contextual evidence of functional impact beyond binding\n\n"
+     "**OUTPUT:** false",
+     "false", "marker"),
+    ("chemprot",
+     "There is no evidence of:\n- Regulation (CPR:3/4)\n- Agonist/antagonist activity (CPR:5/6)\n"
+     "- Substrate/product relationship (CPR:9)\n\n"
+     "The entities are merely co-occurring as administered compounds without described interaction.\n\n"
+     "OUTPUT: false",
+     "false", "marker"),
+    ("chemprot",
+     "- This effect is **activation/agonism** (CPR:5), as the chemical triggers a biological response.  \n"
+     "- No evidence of inhibition (CPR:4), antagonism (CPR:6), regulation (CPR:3/4), or substrate relationship (CPR:9).  \n\n"
+     "**OUTPUT: CPR:5**",
+     "CPR:5", "marker"),
+    ("chemprot",
+     "**OUTPUT: CPR:9**  \n\n### Explanation:  \n"
+     "- There is no indication of regulation (CPR:3/4), agonist/antagonist activity (CPR:5/6), "
+     "or absence of relation (false). The core action is binding, aligning with CPR:9.",
+     "CPR:9", "marker"),
+    ("chemprot",
+     "**Relation: CPR:9**  \n*(SUBSTRATE, PRODUCT OF, or SUBSTRATE PRODUCT OF)*  \n\n"
+     "3. No evidence suggests up/down-regulation (CPR:3/4), agonist/antagonist activity (CPR:5/6), "
+     "or absence of relation (false).  \n\n**Output:** CPR:9",
+     "CPR:9", "marker"),
+    # 前后给出不同的标签，交给LLM判断
+    ("chemprot",
+     "The correct relation is CPR:5, which includes AGONIST, AGONIST ACTIVATOR, and AGONIST INHIBITOR.\n\nCPR:5\n\nfalse",
+     "false", "conflict"),
+    ("chemprot",
+     "**Example-1 F: CPR:5**\n- **Output:** CPR:5\n\n**Example-1 G: CPR:9**\n- **Output:** CPR:9\n\n"
+     "In each of these examples, the classification is based on matching the question to the CPR types.",
+     "CPR:9", "conflict"),
+    # 分号后还有下文的不是结论
+    ("chemprot",
+     "**Answer:** If @GENE$ is an agoniist, the relation is \"CPR:5\"; if it's an antagonist, it's \"CPR:6\"; otherwise, \"false.\"",
+     "false", "multiple"),
+    # 正常写法
+    ("chemprot", "CPR:4", "CPR:4", "exact"),
+    ("biored", "The variant is linked to the disease.\n\n**Answer:** Positive_Correlation.",
+     "Positive_Correlation", "marker"),
+    ("biored", "Association between A and B is negative correlation", "Negative_Correlation", "multiple"),
+]
+
+def rule_args(benchmark, obj=None):
+    if benchmark == "chemprot":
+        return CHEMPROT_LABELS, CHEMPROT_ALIASES
+    labels = extract_candidate_labels(obj.get("system", "")) if obj else BIORED_LABELS
+    return labels, BIORED_ALIASES
+
+def run_cases():
+    failed = 0
+    for benchmark, text, want_label, want_rule in CASES:
+        labels, aliases = rule_args(benchmark)
+        label, confidence, rule = extract_label(text, labels, aliases)
+        if (label, rule) != (want_label, want_rule):
+            failed += 1
+            print(f"[失败] 期望({want_label}, {want_rule})，实际({label}, {rule}, {confidence})：{text[-120:]!r}")
+    print(f"回归用例{len(CASES)}条，失败{failed}条")
+    return failed
+
+def compare_judge(eval_dir, threshold):
+    """已有answer/test文件上：规则置信度达到阈值的条目与LLM裁判标签不一致的条数"""
+    total = 0
+    mismatched = 0
+    for answer_path in sorted(glob.glob(os.path.join(eval_dir, "model_answer", "*", "*", "*-answer.json"))):
+        name = os.path.basename(answer_path).lower()
+        benchmark = "chemprot" if "-chemprot-" in name else "biored" if "-biored-" in name else None
+        if benchmark is None:
+            continue
+        test_path = answer_path.replace("model_answer", "model_test", 1)[:-len("-answer.json")] + "-test.json"
+        folder = os.path.dirname(test_path)
+        matches = [f for f in (os.listdir(folder) if os.path.isdir(folder) else [])
+                   if f.lower() == os.path.basename(test_path).lower()]
+        if not matches:
+            continue
+        idx2judge = {}
+        for obj in load_records(os.path.join(folder, matches[0])):
+            if "label_json" in obj and obj.get("label_source") != "rule":
+                try:
+                    idx2judge[obj.get("idx")] = json.loads(obj["label_json"]).get("label")
+                except ValueError:
+                    continue
+        for obj in load_records(answer_path):
+            judge = idx2judge.get(obj.get("idx"))
+            if judge is None:
+                continue
+            label, confidence, rule = extract_label(obj.get("llm_output", ""), *rule_args(benchmark, obj))
+            if label is None or confidence < threshold:
+                continue
+            total += 1
+            if label != judge:
+                mismatched += 1
+                print(f"[不一致] {answer_path} idx={obj.get('idx')} 规则={label}({rule}) 裁判={judge}")
+    print(f"置信度>={threshold}的规则解析{total}条，与LLM裁判不一致{mismatched}条")
+
+def main():
+    parser = argparse.ArgumentParser(description="标签规则解析的回归检查：固定用例，可选地与已有LLM裁判结果比对")
+    parser.add_argument("--eval_dir", default=None, help="给出时另在该目录下已有的answer/test文件上统计规则与LLM裁判不一致的条目")
+    parser.add_argument("--rule_threshold", type=float, default=0.95, help="与model_test中--rule_threshold相同")
+    args = parser.parse_args()
+
+    failed = run_cases()
+    if args.eval_dir:
+        compare_judge(args.eval_dir, args.rule_threshold)
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,386 @@
+import re
+import json
+import time
+import math
+import random
+import argparse
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 本地模拟的OpenAI兼容接口（/v1/chat/completions），只依赖标准库，
+# 用于离线压测各脚本的并发、重试、退避和限流逻辑，不消耗真实API额度。
+
+LATENCY_DISTS = ("fixed", "uniform", "normal", "lognormal", "exponential")
+REPLY_MODES = ("auto", "echo", "canned")
+
+def count_tokens(text):
+    """粗略估计token数（约4个字符一个token），只用于usage统计"""
+    return max(1, len(text) // 4) if text else 0
+
+def find_candidate_labels(text):
+    """从prompt中找候选标签：['Positive_Correlation', ...] 或 'CPR:3' 这类带引号的写法"""
+    match = re.search(r"\[((?:\s*'[^']+'\s*,?)+)\]", text)
+    if match:
+        return re.findall(r"'([^']+)'", match.group(1))
+    labels = re.findall(r"'(CPR:\d|false)'", text)
+    return list(dict.fromkeys(labels))
+
+class MockBehavior:
+    """
+    模拟服务端的行为配置：
+    - 延迟：首token延迟按latency_dist抽样（中位数/均值为latency_ms），之后每个流式分块再等token_ms；
+    - 错误注入：按rate_429返回429（带Retry-After），按rate_500返回500；并发超过max_concurrency时也返回429；
+    - 回答：auto按请求内容生成可解析的回答（json_object时给合法JSON），echo原样返回最后一条user消息，
+      canned从canned_replies中随机取一条。
+    """
+    def __init__(self, latency_dist="lognormal", latency_ms=800, latency_sigma=0.5, token_ms=0,
+                 rate_429=0.0, rate_500=0.0, retry_after=1, max_concurrency=0,
+                 reply_mode="auto", canned_replies=None, chunk_chars=16, seed=None):
+        if latency_dist not in LATENCY_DISTS:
+            raise ValueError(f"不支持的延迟分布：{latency_dist}")
+        if reply_mode not in REPLY_MODES:
+            raise ValueError(f"不支持的回答模式：{reply_mode}")
+        self.latency_dist = latency_dist
+        self.latency_ms = latency_ms
+        self.latency_sigma = latency_sigma
+        self.token_ms = token_ms
+        self.rate_429 = rate_429
+        self.rate_500 = rate_500
+        self.retry_after = retry_after
+        self.max_concurrency = max_concurrency
+        self.reply_mode = reply_mode
+        self.canned_replies = canned_replies or ["This is a mock reply."]
+        self.chunk_chars = max(1, chunk_chars)
+        self.rng = random.Random(seed)
+        self.rng_lock = threading.Lock()
+
+    def random(self):
+        with self.rng_lock:
+            return self.rng.random()
+
+    def sample_latency(self):
+        """抽样一次首token延迟（秒）"""
+        base = self.latency_ms / 1000
+        with self.rng_lock:
+            if self.latency_dist == "fixed":
+                value = base
+            elif self.latency_dist == "uniform":
+                value = self.rng.uniform(base * (1 - self.latency_sigma), base * (1 + self.latency_sigma))
+            elif self.latency_dist == "normal":
+                value = self.rng.gauss(base, base * self.latency_sigma)
+            elif self.latency_dist == "lognormal":
+                value = self.rng.lognormvariate(math.log(base), self.latency_sigma) if base > 0 else 0
+            else:
+                value = self.rng.expovariate(1 / base) if base > 0 else 0
+        return max(0.0, value)
+
+    def choice(self, items):
+        with self.rng_lock:
+            return self.rng.choice(items)
+
+    def reply(self, body):
+        """按回答模式生成回答文本"""
+        messages = body.get("messages") or []
+        system = "\n".join(m.get("content") or "" for m in messages if m.get("role") == "system")
+        user = next((m.get("content") or "" for m in reversed(messages) if m.get("role") == "user"), "")
+        if self.reply_mode == "echo":
+            return user
+        if self.reply_mode == "canned":
+            return self.choice(self.canned_replies)
+        json_mode = (body.get("response_format") or {}).get("type") in ("json_object", "json_schema")
+        if json_mode:
+            return json.dumps(self.json_reply(system, user), ensure_ascii=False)
+        labels = find_candidate_labels(system + "\n" + user)
+        if labels:
+            return f"Answer: {self.choice(labels)}"
+        return self.choice(self.canned_replies)
+
+    def json_reply(self, system, user):
+        """json_object请求：打分类prompt返回score/reason/match，其余返回label；批量prompt按idx返回results数组"""
+        def one():
+            if '"score"' in system:
+                score = self.choice([1, 2, 3, 4, 5])
+                return {"score": score, "reason": "mock judgement", "match": score >= 3}
+            if "True" in system and "False" in system:
+                return {"label": self.choice(["True", "False"])}
+            labels = find_candidate_labels(system + "\n" + user) or ["false"]
+            return {"label": self.choice(labels)}
+        item_ids = re.findall(r"^### Item idx=(-?\d+)", user, re.MULTILINE)
+        if item_ids:
+            results = []
+            for item_id in item_ids:
+                entry = {"idx": int(item_id)}
+                entry.update(one())
+                results.append(entry)
+            return {"results": results}
+        return one()
+
+class MockStats:
+    """请求计数、在途并发峰值和延迟样本，线程安全；可选把每个请求追加写入request_log（JSONL）"""
+    def __init__(self, request_log=None):
+        self.lock = threading.Lock()
+        self.request_log = open(request_log, "a", encoding="utf-8") if request_log else None
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counts = {"total": 0, "ok": 0, "rate_limited": 0, "server_error": 0, "bad_request": 0, "client_closed": 0,
+                           "stream": 0}
+            self.in_flight = 0
+            self.peak_in_flight = 0
+            self.prompt_tokens = 0
+            self.completion_tokens = 0
+            self.latencies = []
+            self.started = time.time()
+
+    def enter(self):
+        with self.lock:
+            self.counts["total"] += 1
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+            return self.in_flight
+
+    def leave(self, record):
+        with self.lock:
+            self.in_flight -= 1
+            status = record["status"]
+            if status == 200:
+                self.counts["ok"] += 1
+                self.prompt_tokens += record.get("prompt_tokens", 0)
+                self.completion_tokens += record.get("completion_tokens", 0)
+                self.latencies.append(record["latency_ms"])
+            elif status == 429:
+                self.counts["rate_limited"] += 1
+            elif status == 499:
+                self.counts["client_closed"] += 1
+            elif status >= 500:
+                self.counts["server_error"] += 1
+            else:
+                self.counts["bad_request"] += 1
+            if record.get("stream"):
+                self.counts["stream"] += 1
+            if self.request_log is not None:
+                self.request_log.write(json.dumps(record, ensure_ascii=False) + "\n")
+                self.request_log.flush()
+
+    def snapshot(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            def pct(p):
+                if not latencies:
+                    return None
+                return latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))]
+            return dict(
+                self.counts,
+                in_flight=self.in_flight,
+                peak_in_flight=self.peak_in_flight,
+                prompt_tokens=self.prompt_tokens,
+                completion_tokens=self.completion_tokens,
+                latency_p50_ms=pct(50),
+                latency_p95_ms=pct(95),
+                latency_p99_ms=pct(99),
+                uptime_s=round(time.time() - self.started, 3),
+            )
+
+    def latency_samples(self):
+        """成功请求的延迟样本（毫秒）"""
+        with self.lock:
+            return list(self.latencies)
+
+    def close(self):
+        with self.lock:
+            if self.request_log is not None:
+                self.request_log.close()
+                self.request_log = None
+
+class MockHandler(BaseHTTPRequestHandler):
+    server_version = "MockOpenAI/1.0"
+
+    def log_message(self, format, *args):
+        logging.debug("%s - %s", self.address_string(), format % args)
+
+    def send_json(self, status, obj, headers=None):
+        data = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_error_json(self, status, message, err_type, headers=None):
+        self.send_json(status, {"error": {"message": message, "type": err_type, "code": str(status)}}, headers)
+
+    def do_GET(self):
+        path = self.path.split("?")[0].rstrip("/")
+        if path == "/stats":
+            self.send_json(200, self.server.stats.snapshot())
+        elif path in ("/v1/models", "/models"):
+            self.send_json(200, {"object": "list", "data": [{"id": "mock-model", "object": "model"}]})
+        else:
+            self.send_error_json(404, f"Unknown path {self.path}", "not_found")
+
+    def do_POST(self):
+        path = self.path.split("?")[0].rstrip("/")
+        if path == "/stats/reset":
+            self.server.stats.reset()
+            self.send_json(200, {"ok": True})
+            return
+        if path not in ("/v1/chat/completions", "/chat/completions"):
+            self.send_error_json(404, f"Unknown path {self.path}", "not_found")
+            return
+        behavior = self.server.behavior
+        stats = self.server.stats
+        start = time.time()
+        in_flight = stats.enter()
+        record = {"ts": round(start, 3), "path": path, "in_flight": in_flight, "status": 200}
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+            try:
+                body = json.loads(self.rfile.read(length) or b"{}")
+            except ValueError:
+                record["status"] = 400
+                self.send_error_json(400, "Invalid JSON body", "invalid_request_error")
+                return
+            stream = bool(body.get("stream"))
+            record.update(model=body.get("model"), stream=stream)
+
+            # 429在排队阶段就返回，不占服务端时间；500在处理一段时间后才返回
+            if (behavior.max_concurrency and in_flight > behavior.max_concurrency) or behavior.random() < behavior.rate_429:
+                record["status"] = 429
+                self.send_error_json(429, "Rate limit exceeded (mock)", "rate_limit_error",
+                                     {"Retry-After": str(behavior.retry_after)})
+                return
+            ttft = behavior.sample_latency()
+            if behavior.random() < behavior.rate_500:
+                time.sleep(ttft)
+                record["status"] = 500
+                self.send_error_json(500, "Internal server error (mock)", "server_error")
+                return
+
+            content = behavior.reply(body)
+            prompt_text = "".join(m.get("content") or "" for m in body.get("messages") or [])
+            usage = {"prompt_tokens": count_tokens(prompt_text), "completion_tokens": count_tokens(content)}
+            usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+            record.update(prompt_tokens=usage["prompt_tokens"], completion_tokens=usage["completion_tokens"])
+            chunks = [content[i:i + behavior.chunk_chars] for i in range(0, len(content), behavior.chunk_chars)] or [""]
+            completion_id = f"chatcmpl-mock-{int(start * 1000)}-{in_flight}"
+            created = int(start)
+            model = body.get("model") or "mock-model"
+
+            time.sleep(ttft)
+            record["ttft_ms"] = round(ttft * 1000, 1)
+            if stream:
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Cache-Control", "no-cache")
+                self.end_headers()
+                include_usage = bool((body.get("stream_options") or {}).get("include_usage"))
+                for i, piece in enumerate(chunks):
+                    if i and behavior.token_ms:
+                        time.sleep(behavior.token_ms / 1000)
+                    delta = {"role": "assistant", "content": piece} if i == 0 else {"content": piece}
+                    self.write_sse({
+                        "id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                        "choices": [{"index": 0, "delta": delta, "finish_reason": None}]
+                    })
+                self.write_sse({
+                    "id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                    "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]
+                })
+                if include_usage:
+                    self.write_sse({
+                        "id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                        "choices": [], "usage": usage
+                    })
+                self.wfile.write(b"data: [DONE]\n\n")
+                self.wfile.flush()
+            else:
+                if behavior.token_ms:
+                    time.sleep(behavior.token_ms * (len(chunks) - 1) / 1000)
+                self.send_json(200, {
+                    "id": completion_id, "object": "chat.completion", "created": created, "model": model,
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": content},
+                                 "finish_reason": "stop"}],
+                    "usage": usage
+                })
+        except (BrokenPipeError, ConnectionResetError):
+            # 客户端超时或取消（如对冲请求的落后一方）时连接已断开
+            record["status"] = 499
+        finally:
+            record["latency_ms"] = round((time.time() - start) * 1000, 1)
+            stats.leave(record)
+
+    def write_sse(self, obj):
+        self.wfile.write(b"data: " + json.dumps(obj, ensure_ascii=False).encode("utf-8") + b"\n\n")
+        self.wfile.flush()
+
+def make_server(host, port, behavior, request_log=None):
+    """创建（未启动的）模拟服务，port为0时自动分配空闲端口"""
+    server = ThreadingHTTPServer((host, port), MockHandler)
+    server.daemon_threads = True
+    server.behavior = behavior
+    server.stats = MockStats(request_log)
+    return server
+
+def serve_in_background(behavior, host="127.0.0.1", port=0, request_log=None):
+    """在后台线程启动模拟服务，返回(server, base_url)，用完调用server.shutdown()"""
+    server = make_server(host, port, behavior, request_log)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, f"http://{host}:{server.server_address[1]}/v1"
+
+def add_server_args(parser):
+    parser.add_argument("--latency_dist", default="lognormal", choices=LATENCY_DISTS, help="首token延迟分布")
+    parser.add_argument("--latency_ms", type=float, default=800,
+                        help="延迟中位数/均值（毫秒），lognormal为中位数，exponential为均值")
+    parser.add_argument("--latency_sigma", type=float, default=0.5,
+                        help="延迟离散程度：lognormal的sigma，normal为相对标准差，uniform为相对半宽")
+    parser.add_argument("--token_ms", type=float, default=0, help="流式输出每个分块之间的间隔（毫秒）")
+    parser.add_argument("--chunk_chars", type=int, default=16, help="流式输出每个分块的字符数")
+    parser.add_argument("--rate_429", type=float, default=0.0, help="随机返回429的比例")
+    parser.add_argument("--rate_500", type=float, default=0.0, help="随机返回500的比例")
+    parser.add_argument("--retry_after", type=float, default=1, help="429响应的Retry-After秒数")
+    parser.add_argument("--max_concurrency", type=int, default=0, help="服务端并发上限，超出时返回429，0为不限")
+    parser.add_argument("--reply_mode", default="auto", choices=REPLY_MODES,
+                        help="auto按请求生成可解析的回答，echo返回最后一条user消息，canned从--canned_file随机取")
+    parser.add_argument("--canned_file", default=None, help="canned模式的回答文件：JSON字符串数组或每行一条的文本")
+    parser.add_argument("--seed", type=int, default=None, help="随机种子，固定后延迟与错误注入可复现")
+    parser.add_argument("--request_log", default=None, help="逐请求日志（JSONL）：状态码、延迟、在途并发、token数")
+
+def behavior_from_args(args):
+    canned = None
+    if args.canned_file:
+        with open(args.canned_file, "r", encoding="utf-8") as f:
+            text = f.read()
+        canned = json.loads(text) if text.lstrip().startswith("[") else [line for line in text.splitlines() if line.strip()]
+    return MockBehavior(
+        latency_dist=args.latency_dist, latency_ms=args.latency_ms, latency_sigma=args.latency_sigma,
+        token_ms=args.token_ms, rate_429=args.rate_429, rate_500=args.rate_500, retry_after=args.retry_after,
+        max_concurrency=args.max_concurrency, reply_mode=args.reply_mode, canned_replies=canned,
+        chunk_chars=args.chunk_chars, seed=args.seed
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description="本地模拟OpenAI兼容接口，用于离线压测")
+    parser.add_argument("--host", default="127.0.0.1", help="监听地址")
+    parser.add_argument("--port", type=int, default=8000, help="监听端口")
+    add_server_args(parser)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s", datefmt="%Y-%m-%d %H:%M:%S")
+    server = make_server(args.host, args.port, behavior_from_args(args), args.request_log)
+    print(f"模拟接口已启动：http://{args.host}:{server.server_address[1]}/v1（GET /stats 查看统计）")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(json.dumps(server.stats.snapshot(), ensure_ascii=False))
+        server.stats.close()
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+import os
+import sys
+import json
+import time
+import shlex
+import argparse
+import subprocess
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmark.mock_server import add_server_args, behavior_from_args, serve_in_background
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCHMARK_DIR = "data/evaluation/benchmark"
+
+# 每个任务各阶段对应的脚本和benchmark文件
+TASKS = {
+    "chemprot": {
+        "benchmark": "chemprot.json",
+        "answer": "model_answer_generation/chemprot_answer_api.py",
+        "test": "model_test/chemprot_test_api.py",
+        "gpt": "gpt_test/chemprot_gpt_api.py",
+    },
+    "biored": {
+        "benchmark": "bioRED.json",
+        "answer": "model_answer_generation/biored_answer_api.py",
+        "test": "model_test/biored_test_api.py",
+        "gpt": "gpt_test/biored_gpt_api.py",
+    },
+    "bioasq": {
+        "benchmark": "BioASQ.json",
+        "answer": "model_answer_generation/bioasq_answer_api.py",
+        "test": "model_test/bioASQ_test_api.py",
+        "gpt": "gpt_test/bioASQ_gpt_api.py",
+    },
+}
+STAGES = ("answer", "test", "gpt")
+
+def write_slice(src, dst, limit):
+    """取benchmark的前limit条（limit<=0为全部）写到dst，返回条数"""
+    count = 0
+    with open(src, "r", encoding="utf-8") as fin, open(dst, "w", encoding="utf-8") as fout:
+        for line in fin:
+            if not line.strip():
+                continue
+            if 0 < limit <= count:
+                break
+            fout.write(line if line.endswith("\n") else line + "\n")
+            count += 1
+    return count
+
+def stage_command(task, stage, workdir, model):
+    """返回(命令参数列表, 输出文件)；answer阶段的输出是test和gpt阶段的输入"""
+    conf = TASKS[task]
+    benchmark = os.path.join(workdir, f"{task}-benchmark.json")
+    answer = os.path.join(workdir, f"{task}-answer.json")
+    output = os.path.join(workdir, f"{task}-{stage}.json")
+    log = os.path.join(workdir, f"{task}-{stage}.log")
+    script = os.path.join(SRC_DIR, conf[stage])
+    if stage == "answer":
+        cmd = [sys.executable, script, "--model", model, "--input", benchmark, "--output", answer, "--log", log]
+        output = answer
+    elif stage == "test":
+        cmd = [sys.executable, script, "--model", model, "--input", answer, "--output", output, "--log", log]
+        if task == "bioasq":
+            cmd += ["--gold", benchmark]
+    else:
+        cmd = [sys.executable, script, "--model", model, "--benchmark", benchmark, "--answer", answer,
+               "--output", output, "--log", log]
+    return cmd, output
+
+def count_output(path):
+    """统计输出文件的成功/失败条数"""
+    ok = failed = 0
+    if path and os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    obj = json.loads(line)
+                except ValueError:
+                    failed += 1
+                    continue
+                if "error" in obj:
+                    failed += 1
+                else:
+                    ok += 1
+    return ok, failed
+
+def run_against_mock(cmd, server, base_url, output=None, timeout=None):
+    """
+    把--base_url/--api_key指向模拟服务后运行一条命令，返回耗时、退出码、服务端统计和输出条数。
+    每次运行前清零服务端统计，便于逐阶段对比。
+    """
+    cmd = list(cmd) + ["--base_url", base_url, "--api_key", "mock-key"]
+    server.stats.reset()
+    start = time.time()
+    proc = subprocess.run(cmd, timeout=timeout)
+    elapsed = time.time() - start
+    ok, failed = count_output(output)
+    return {
+        "command": " ".join(shlex.quote(c) for c in cmd),
+        "returncode": proc.returncode,
+        "elapsed_s": round(elapsed, 3),
+        "records_ok": ok,
+        "records_failed": failed,
+        "items_per_s": round(ok / elapsed, 3) if output and elapsed > 0 else None,
+        "server": server.stats.snapshot(),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="启动本地模拟接口并让各脚本对其运行，统计吞吐、429/500次数和重试表现",
+        epilog="也可在 -- 之后直接给出要运行的命令，例如：run_mock.py --rate_429 0.1 -- python src/model_test/chemprot_test_api.py --input a.json --output b.json"
+    )
+    parser.add_argument("--task", default="chemprot", choices=sorted(TASKS), help="任务")
+    parser.add_argument("--stages", default="answer,test,gpt", help="依次运行的阶段，逗号分隔：answer,test,gpt")
+    parser.add_argument("--limit", type=int, default=50, help="取benchmark前多少条，0为全部")
+    parser.add_argument("--workdir", default="benchmark_runs/mock", help="切片输入、输出和日志的目录")
+    parser.add_argument("--model", default="mock-model", help="请求中的模型名称")
+    parser.add_argument("--extra_args", default="", help="追加给每个阶段脚本的参数，如 \"--threads 8\"")
+    parser.add_argument("--answer_args", default="", help="只追加给answer阶段的参数，如 \"--async_mode --adaptive_limit\"")
+    parser.add_argument("--test_args", default="", help="只追加给test阶段的参数")
+    parser.add_argument("--gpt_args", default="", help="只追加给gpt阶段的参数")
+    parser.add_argument("--timeout", type=float, default=None, help="单个阶段的超时秒数")
+    parser.add_argument("--report", default=None, help="把各阶段统计写入该JSON文件")
+    add_server_args(parser)
+    argv = sys.argv[1:]
+    command = None
+    if "--" in argv:
+        pos = argv.index("--")
+        argv, command = argv[:pos], argv[pos + 1:]
+    args = parser.parse_args(argv)
+
+    server, base_url = serve_in_background(behavior_from_args(args), request_log=args.request_log)
+    print(f"模拟接口：{base_url}")
+    results = []
+    try:
+        if command:
+            results.append(dict(stage="command", **run_against_mock(command, server, base_url, timeout=args.timeout)))
+        else:
+            os.makedirs(args.workdir, exist_ok=True)
+            src = os.path.join(BENCHMARK_DIR, TASKS[args.task]["benchmark"])
+            n = write_slice(src, os.path.join(args.workdir, f"{args.task}-benchmark.json"), args.limit)
+            print(f"{args.task}：取benchmark前{n}条")
+            for stage in [s.strip() for s in args.stages.split(",") if s.strip()]:
+                if stage not in STAGES:
+                    raise ValueError(f"未知阶段：{stage}")
+                cmd, output = stage_command(args.task, stage, args.workdir, args.model)
+                # 每次都从头跑，避免断点续跑跳过已有结果
+                if os.path.exists(output):
+                    os.remove(output)
+                cmd += shlex.split(args.extra_args) + shlex.split(getattr(args, f"{stage}_args"))
+                result = dict(stage=stage, **run_against_mock(cmd, server, base_url, output, args.timeout))
+                results.append(result)
+                s = result["server"]
+                print(f"[{stage}] 耗时{result['elapsed_s']}s，成功{result['records_ok']}条，失败{result['records_failed']}条，"
+                      f"{result['items_per_s']}条/秒；请求{s['total']}次，429共{s['rate_limited']}次，"
+                      f"500共{s['server_error']}次，并发峰值{s['peak_in_flight']}")
+                if result["returncode"] != 0:
+                    print(f"[{stage}] 退出码{result['returncode']}，停止后续阶段")
+                    break
+    finally:
+        server.shutdown()
+        server.stats.close()
+        server.server_close()
+
+    if args.report:
+        report_dir = os.path.dirname(args.report)
+        if report_dir:
+            os.makedirs(report_dir, exist_ok=True)
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump({"base_url": base_url, "args": vars(args), "results": results}, f, ensure_ascii=False, indent=2)
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+    if any(r["returncode"] != 0 for r in results):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+import os
+import sys
+import glob
+import json
+import argparse
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmark.bench_suite import percentile
+
+def load_telemetry(patterns):
+    records = []
+    for pattern in patterns:
+        paths = sorted(glob.glob(pattern)) or [pattern]
+        for path in paths:
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        try:
+                            records.append(json.loads(line))
+                        except ValueError:
+                            continue
+    return records
+
+def parse_prices(price_args, price_file):
+    """价格单位：每百万token，{model: (输入价, 输出价)}"""
+    prices = {}
+    if price_file:
+        with open(price_file, "r", encoding="utf-8") as f:
+            for model, p in json.load(f).items():
+                prices[model] = (float(p["input"]), float(p["output"]))
+    for item in price_args or []:
+        model, _, values = item.partition("=")
+        inp, _, out = values.partition(",")
+        prices[model] = (float(inp), float(out or inp))
+    return prices
+
+def summarize(records, group_by, prices):
+    groups = {}
+    for r in records:
+        key = tuple(r.get(k) for k in group_by)
+        groups.setdefault(key, []).append(r)
+
+    rows = []
+    for key, rs in sorted(groups.items(), key=lambda kv: [str(k) for k in kv[0]]):
+        live = [r for r in rs if not r.get("cached")]
+        ok = [r for r in live if r.get("status") == "ok"]
+        errors = [r for r in live if r.get("status") != "ok"]
+        cached = [r for r in rs if r.get("cached")]
+        start = min(r["ts"] for r in rs)
+        end = max(r["ts"] + (r.get("total_ms") or 0) / 1000 for r in rs)
+        span = max(end - start, 1e-9)
+        attempts = {}
+        for r in rs:
+            if r.get("item") is not None:
+                attempts[r["item"]] = max(attempts.get(r["item"], 0), r.get("attempt") or 1)
+        done_items = {r["item"] for r in rs if r.get("status") == "ok" and r.get("item") is not None}
+        def tokens(name, rows_):
+            return sum(r.get(name) or 0 for r in rows_)
+        def pct(name, p, rows_=ok):
+            values = [r[name] for r in rows_ if r.get(name) is not None]
+            return percentile(values, p)
+        row = dict(zip(group_by, key))
+        row.update({
+            "calls": len(rs),
+            "ok": len(ok),
+            "errors": len(errors),
+            "cached": len(cached),
+            "hedged": sum(1 for r in live if r.get("hedged")),
+            "rate_limited": sum(1 for r in errors if r.get("status_code") == 429),
+            "items": len(attempts),
+            "items_done": len(done_items),
+            "mean_attempts": round(sum(attempts.values()) / len(attempts), 3) if attempts else None,
+            "max_attempts": max(attempts.values()) if attempts else None,
+            "wall_s": round(span, 3),
+            "calls_per_s": round(len(ok) / span, 3),
+            "items_per_s": round(len(done_items) / span, 3),
+            "latency_p50_ms": pct("latency_ms", 50),
+            "latency_p95_ms": pct("latency_ms", 95),
+            "latency_p99_ms": pct("latency_ms", 99),
+            "ttft_p50_ms": pct("ttft_ms", 50),
+            "ttft_p95_ms": pct("ttft_ms", 95),
+            "queue_wait_p95_ms": pct("queue_wait_ms", 95, live),
+            "prompt_tokens": tokens("prompt_tokens", ok),
+            "completion_tokens": tokens("completion_tokens", ok),
+            "reasoning_tokens": tokens("reasoning_tokens", ok),
+            "cached_tokens_saved": tokens("total_tokens", cached),
+        })
+        model = row.get("model")
+        if model in prices:
+            price_in, price_out = prices[model]
+            row["cost"] = round((row["prompt_tokens"] * price_in + row["completion_tokens"] * price_out) / 1e6, 4)
+        rows.append(row)
+    return rows
+
+def print_table(rows, group_by):
+    for row in rows:
+        name = "/".join(str(row.get(k)) for k in group_by)
+        print(f"== {name}")
+        print(f"  请求{row['calls']}次：成功{row['ok']}，失败{row['errors']}（429共{row['rate_limited']}），命中缓存{row['cached']}，对冲{row['hedged']}")
+        print(f"  条目{row['items']}个，完成{row['items_done']}个，平均尝试{row['mean_attempts']}次，最多{row['max_attempts']}次")
+        print(f"  吞吐：{row['calls_per_s']}请求/秒，{row['items_per_s']}条/秒（墙钟{row['wall_s']}s）")
+        print(f"  耗时p50/p95/p99：{row['latency_p50_ms']}/{row['latency_p95_ms']}/{row['latency_p99_ms']}ms，"
+              f"首token p50/p95：{row['ttft_p50_ms']}/{row['ttft_p95_ms']}ms，排队p95：{row['queue_wait_p95_ms']}ms")
+        cost = f"，费用{row['cost']}" if "cost" in row else ""
+        print(f"  token：prompt {row['prompt_tokens']}，completion {row['completion_tokens']}"
+              f"（reasoning {row['reasoning_tokens']}），缓存节省{row['cached_tokens_saved']}{cost}")
+
+def main():
+    parser = argparse.ArgumentParser(description="汇总--telemetry生成的逐请求遥测：按模型/benchmark/阶段统计吞吐、尾延迟和token花费")
+    parser.add_argument("files", nargs="+", help="遥测JSONL文件，可用通配符")
+    parser.add_argument("--group_by", default="model,benchmark,stage", help="分组字段，逗号分隔")
+    parser.add_argument("--price", action="append", help="模型单价（每百万token）：MODEL=输入价,输出价，可重复")
+    parser.add_argument("--price_file", default=None, help="单价JSON：{model: {\"input\": x, \"output\": y}}")
+    parser.add_argument("--json", default=None, help="同时把汇总结果写入该JSON文件")
+    args = parser.parse_args()
+
+    group_by = [k.strip() for k in args.group_by.split(",") if k.strip()]
+    rows = summarize(load_telemetry(args.files), group_by, parse_prices(args.price, args.price_file))
+    print_table(rows, group_by)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(rows, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main()
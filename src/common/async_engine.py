@@ -0,0 +1,56 @@
+import asyncio
+import logging
+from tqdm import tqdm
+from common.rate_limiter import is_rate_limit_error
+
+async def retry_async(call, max_retries, retry_base_wait, label, limiter=None):
+    """
+    以指数退避重试异步调用call()（无参协程函数）。
+    等待通过asyncio.sleep调度，不占用任何线程；全部失败时抛出最后一次的异常。
+    call内部应已经过共享limiter（见common.llm_call.create_chat_async），
+    传入同一个limiter时，429的等待交给limiter的全局暂停，这里不再各自退避。
+    """
+    last_exception = None
+    for attempt in range(max_retries):
+        try:
+            return await call()
+        except Exception as e:
+            last_exception = e
+            if attempt == max_retries - 1:
+                break
+            if limiter is not None and is_rate_limit_error(e):
+                errmsg = f"{label}请求被限流(429)：{e}，第{attempt + 1}次重试，由共享限流器统一等待..."
+                print(errmsg)
+                logging.warning(errmsg)
+                continue
+            wait_time = retry_base_wait * (2 ** attempt)
+            errmsg = f"{label}请求出错：{e}，第{attempt + 1}次重试，等待{wait_time:.1f}秒..."
+            print(errmsg)
+            logging.warning(errmsg)
+            await asyncio.sleep(wait_time)
+    raise last_exception
+
+def run_async(tasks, worker, max_in_flight=64, on_result=None, desc="LLM生成中(异步)"):
+    """
+    在单个事件循环里并发执行worker(task)，同时在途的请求数不超过max_in_flight。
+    每完成一条就调用on_result(result)，返回全部结果（按完成顺序）。
+    """
+    async def _main():
+        semaphore = asyncio.Semaphore(max_in_flight)
+
+        async def _run(task):
+            async with semaphore:
+                return await worker(task)
+
+        results = []
+        pending = [asyncio.ensure_future(_run(task)) for task in tasks]
+        with tqdm(total=len(pending), desc=desc) as pbar:
+            for future in asyncio.as_completed(pending):
+                result = await future
+                if on_result is not None:
+                    on_result(result)
+                results.append(result)
+                pbar.update(1)
+        return results
+
+    return asyncio.run(_main())
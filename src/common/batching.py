@@ -0,0 +1,20 @@
+def plan_token_batches(lengths, max_batch_size, max_batch_tokens=0):
+    """
+    按token长度升序分桶组批，返回若干个原始下标列表。
+    每批样本数不超过max_batch_size，且 样本数*批内最大长度（即padding后的总token数）
+    不超过max_batch_tokens（<=0表示不限）；单条就超预算的样本单独成批。
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    batches = []
+    cur = []
+    for i in order:
+        # 升序遍历，当前样本即为加入后的批内最大长度
+        over_size = len(cur) >= max_batch_size
+        over_tokens = max_batch_tokens > 0 and lengths[i] * (len(cur) + 1) > max_batch_tokens
+        if cur and (over_size or over_tokens):
+            batches.append(cur)
+            cur = []
+        cur.append(i)
+    if cur:
+        batches.append(cur)
+    return batches
@@ -0,0 +1,386 @@
+import hashlib
+import inspect
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+import numpy as np
+import torch
+from tqdm import tqdm
+from transformers import AutoModel, AutoTokenizer
+
+from common.batching import plan_token_batches
+
+# bert_score库中各模型默认取的层数（model2layers），只列出本仓库用到的
+DEFAULT_LAYERS = {"bert-base-uncased": 9, "bert-base-cased": 9, "bert-large-uncased": 18, "roberta-large": 17}
+
+def text_key(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def store_dir(root, model_type, num_layers, dtype="float32", backend_tag=""):
+    """不同模型、层数、精度、推理后端（如onnx-int8）的向量不能混用，各占一个子目录"""
+    suffix = f"-{backend_tag}" if backend_tag else ""
+    return os.path.join(root, f"{model_type.replace('/', '_')}-L{num_layers}-{dtype}{suffix}")
+
+def load_truncated_model(model_type, num_layers):
+    """与bert_score相同：截掉num_layers之后的层，最后一层输出即为所需的隐藏层；pooler用不到，一并去掉"""
+    model = AutoModel.from_pretrained(model_type)
+    model.encoder.layer = torch.nn.ModuleList(model.encoder.layer[:num_layers])
+    if getattr(model, "pooler", None) is not None:
+        model.pooler = None
+    model.eval()
+    return model
+
+class TorchEncoder:
+    """PyTorch前向，输入输出均为CPU上的tensor"""
+    def __init__(self, model_type, num_layers, device="cpu", threads=0):
+        if threads:
+            torch.set_num_threads(threads)
+        self.device = device
+        self.model = load_truncated_model(model_type, num_layers).to(device)
+
+    def __call__(self, input_ids, mask):
+        with torch.no_grad():
+            out = self.model(input_ids.to(self.device), attention_mask=mask.to(self.device))[0]
+        return out.float().cpu()
+
+class _LastHiddenState(torch.nn.Module):
+    """导出用的包装：按关键字参数调用模型，只输出最后一层隐藏状态"""
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask):
+        return self.model(input_ids=input_ids, attention_mask=attention_mask)[0]
+
+def export_onnx(model_type, num_layers, onnx_dir, quantize=False):
+    """把截断后的模型导出为ONNX（batch和序列长度为动态维度），quantize时另存int8动态量化版本；已导出过则直接复用"""
+    name = f"{model_type.replace('/', '_')}-L{num_layers}"
+    path = os.path.join(onnx_dir, name + ".onnx")
+    if not os.path.exists(path):
+        os.makedirs(onnx_dir, exist_ok=True)
+        logging.info(f"导出ONNX模型：{path}")
+        model = _LastHiddenState(load_truncated_model(model_type, num_layers))
+        dummy_ids = torch.ones((2, 8), dtype=torch.long)
+        dummy_mask = torch.ones((2, 8), dtype=torch.long)
+        tmp = path + ".tmp"
+        # 新版torch默认走dynamo导出器，dynamic_axes需要原来的TorchScript导出器
+        export_kwargs = {"dynamo": False} if "dynamo" in inspect.signature(torch.onnx.export).parameters else {}
+        with torch.no_grad():
+            torch.onnx.export(
+                model, (dummy_ids, dummy_mask), tmp,
+                input_names=["input_ids", "attention_mask"], output_names=["last_hidden_state"],
+                dynamic_axes={
+                    "input_ids": {0: "batch", 1: "seq"},
+                    "attention_mask": {0: "batch", 1: "seq"},
+                    "last_hidden_state": {0: "batch", 1: "seq"},
+                },
+                opset_version=17, **export_kwargs
+            )
+        os.replace(tmp, path)
+    if not quantize:
+        return path
+    q_path = os.path.join(onnx_dir, name + "-int8.onnx")
+    if not os.path.exists(q_path):
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        logging.info(f"int8动态量化：{q_path}")
+        quantize_dynamic(path, q_path + ".tmp", weight_type=QuantType.QInt8)
+        os.replace(q_path + ".tmp", q_path)
+    return q_path
+
+class OnnxEncoder:
+    """ONNX Runtime前向（CPU），onnxruntime为可选依赖，只在--backend onnx时需要"""
+    def __init__(self, model_type, num_layers, onnx_dir, quantize=False, threads=0):
+        import onnxruntime as ort
+        path = export_onnx(model_type, num_layers, onnx_dir, quantize)
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+
+    def __call__(self, input_ids, mask):
+        out = self.session.run(["last_hidden_state"], {
+            "input_ids": input_ids.numpy(),
+            "attention_mask": mask.numpy(),
+        })[0]
+        return torch.from_numpy(out)
+
+class EmbeddingStore:
+    """
+    按文本哈希持久化BERT逐token向量（已L2归一化），跨模型、跨运行复用：
+    index.sqlite记录key→(分片, 起始行, token数)，向量按行追加写入分片文件<分片>.bin，
+    读取时用numpy.memmap映射，不整体读入内存。
+    每个实例第一次写入时新建自己的分片，数据落盘后才登记索引，多个进程可同时读写同一目录。
+    """
+    def __init__(self, path, dtype="float32"):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.lock = threading.Lock()
+        self.stats = {"hit": 0, "miss": 0, "write": 0}
+        os.makedirs(path, exist_ok=True)
+        self.conn = sqlite3.connect(os.path.join(path, "index.sqlite"), timeout=60,
+                                    check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, shard TEXT NOT NULL, start INTEGER NOT NULL, "
+            "n_tokens INTEGER NOT NULL, created REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self.dim = self._read_dim()
+        self.maps = {}
+        self.shard = None
+        self.shard_rows = 0
+
+    def _read_dim(self):
+        row = self.conn.execute("SELECT value FROM meta WHERE name = 'dim'").fetchone()
+        return int(row[0]) if row else None
+
+    def _map(self, shard, end_row):
+        """映射分片文件；本进程还在追加的分片行数不够时重新映射"""
+        if self.dim is None:
+            # 打开时还是空库，之后由其他进程写入了第一批向量
+            self.dim = self._read_dim()
+        mm = self.maps.get(shard)
+        if mm is None or mm.shape[0] < end_row:
+            file = os.path.join(self.path, shard + ".bin")
+            rows = os.path.getsize(file) // (self.dim * self.dtype.itemsize)
+            mm = np.memmap(file, dtype=self.dtype, mode="r", shape=(rows, self.dim))
+            self.maps[shard] = mm
+        return mm
+
+    def get_many(self, keys):
+        """返回{key: (token数, dim)的float32数组}，未缓存的key不在结果中"""
+        keys = list(dict.fromkeys(keys))
+        found = {}
+        with self.lock:
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                rows = self.conn.execute(
+                    f"SELECT key, shard, start, n_tokens FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})",
+                    chunk
+                ).fetchall()
+                for key, shard, start, n_tokens in rows:
+                    mm = self._map(shard, start + n_tokens)
+                    found[key] = np.asarray(mm[start:start + n_tokens], dtype=np.float32)
+            self.stats["hit"] += len(found)
+            self.stats["miss"] += len(keys) - len(found)
+        return found
+
+    def put_many(self, items):
+        """items为[(key, (token数, dim)数组)]，先追加写入本实例的分片并落盘，再一次性登记索引"""
+        if not items:
+            return
+        with self.lock:
+            if self.dim is None:
+                self.dim = self._read_dim()
+            if self.dim is None:
+                self.dim = int(items[0][1].shape[1])
+                self.conn.execute("INSERT OR IGNORE INTO meta (name, value) VALUES ('dim', ?)", (str(self.dim),))
+            if self.shard is None:
+                self.shard = f"{int(time.time())}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+            rows = []
+            with open(os.path.join(self.path, self.shard + ".bin"), "ab") as f:
+                for key, emb in items:
+                    f.write(np.ascontiguousarray(emb, dtype=self.dtype).tobytes())
+                    rows.append((key, self.shard, self.shard_rows, int(emb.shape[0]), time.time()))
+                    self.shard_rows += int(emb.shape[0])
+                f.flush()
+                os.fsync(f.fileno())
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO embeddings (key, shard, start, n_tokens, created) VALUES (?, ?, ?, ?, ?)", rows
+            )
+            self.stats["write"] += len(rows)
+
+    def summary(self):
+        with self.lock:
+            hit, miss = self.stats["hit"], self.stats["miss"]
+            rate = hit / (hit + miss) if hit + miss else 0.0
+            return (f"向量缓存统计：命中{hit}条，未命中{miss}条，命中率{rate:.1%}，"
+                    f"写入{self.stats['write']}条（{self.path}）")
+
+    def close(self):
+        with self.lock:
+            self.maps.clear()
+            self.conn.close()
+
+class BertScorer:
+    """
+    BERTScore，与bert_score库默认设置一致（不用idf、不做baseline rescale，取第num_layers层输出，
+    [CLS]/[SEP]权重为0，即句首句尾token只参与匹配、不计入P/R的平均）。
+    与bert_score库的区别是逐token向量按文本缓存：同一句子（如各模型共用的金标准）只编码一次，
+    配合EmbeddingStore跨运行复用，全部命中时不加载BERT模型。
+    backend为"torch"（默认）或"onnx"（CPU上用ONNX Runtime，quantize时用int8动态量化模型），threads为推理线程数，0为默认。
+    待编码的句子按token长度排序后组批，每批不超过batch_size条、padding后不超过max_batch_tokens个token（0为不限）。
+    """
+    def __init__(self, model_type="bert-base-uncased", num_layers=None, device="cpu", batch_size=64, store=None,
+                 backend="torch", onnx_dir="onnx_models", quantize=False, threads=0, max_batch_tokens=0):
+        self.model_type = model_type
+        self.num_layers = num_layers or DEFAULT_LAYERS.get(model_type, 9)
+        self.device = device
+        self.batch_size = batch_size
+        self.store = store
+        self.backend = backend
+        self.onnx_dir = onnx_dir
+        self.quantize = quantize
+        self.threads = threads
+        self.max_batch_tokens = max_batch_tokens
+        self.tokenizer = None
+        self.encoder = None
+        self.memory = {}
+        self.encoded = 0
+        self.encode_seconds = 0.0
+        self.real_tokens = 0
+        self.padded_tokens = 0
+
+    @property
+    def backend_tag(self):
+        """缓存目录后缀：PyTorch为空（与此前的缓存兼容），ONNX为onnx或onnx-int8"""
+        if self.backend == "torch":
+            return ""
+        return "onnx-int8" if self.quantize else "onnx"
+
+    def _load(self):
+        if self.encoder is not None:
+            return
+        logging.info(f"加载BERTScore模型：{self.model_type}（取第{self.num_layers}层，后端{self.backend_tag or 'torch'}）")
+        self.tokenizer = AutoTokenizer.from_pretrained(self.model_type, use_fast=False)
+        if self.backend == "onnx":
+            self.encoder = OnnxEncoder(self.model_type, self.num_layers, self.onnx_dir, self.quantize, self.threads)
+        else:
+            self.encoder = TorchEncoder(self.model_type, self.num_layers, self.device, self.threads)
+
+    def _tokenize(self, text):
+        if not text:
+            return self.tokenizer.build_inputs_with_special_tokens([])
+        return self.tokenizer.encode(text, add_special_tokens=True, max_length=self.tokenizer.model_max_length,
+                                     truncation=True)
+
+    def _encode(self, ids):
+        """编码一批已分词的句子，返回L2归一化后的逐token向量列表"""
+        max_len = max(len(x) for x in ids)
+        self.real_tokens += sum(len(x) for x in ids)
+        self.padded_tokens += max_len * len(ids)
+        input_ids = torch.full((len(ids), max_len), self.tokenizer.pad_token_id, dtype=torch.long)
+        mask = torch.zeros((len(ids), max_len), dtype=torch.long)
+        for i, x in enumerate(ids):
+            input_ids[i, :len(x)] = torch.tensor(x, dtype=torch.long)
+            mask[i, :len(x)] = 1
+        out = self.encoder(input_ids, mask)
+        out = (out / out.norm(dim=-1, keepdim=True)).numpy()
+        return [out[i, :len(x)] for i, x in enumerate(ids)]
+
+    def embed(self, texts):
+        """返回{文本: 逐token向量}；依次查本次运行的内存、磁盘缓存，都没有的才送入BERT"""
+        texts = [t.strip() for t in texts]
+        result = {t: self.memory[t] for t in texts if t in self.memory}
+        missing = [t for t in dict.fromkeys(texts) if t not in result]
+        if missing and self.store is not None:
+            found = self.store.get_many([text_key(t) for t in missing])
+            for t in missing:
+                emb = found.get(text_key(t))
+                if emb is not None:
+                    result[t] = self.memory[t] = emb
+            missing = [t for t in missing if t not in result]
+        if missing:
+            self._load()
+            t0 = time.time()
+            ids = [self._tokenize(t) for t in missing]
+            # 按长度分桶组批减少padding；结果按文本存回，调用方的顺序不受影响
+            plan = plan_token_batches([len(x) for x in ids], self.batch_size, self.max_batch_tokens)
+            pbar = tqdm(total=len(missing), desc="BERT编码")
+            for batch_ids in plan:
+                embs = self._encode([ids[i] for i in batch_ids])
+                batch = [missing[i] for i in batch_ids]
+                for t, emb in zip(batch, embs):
+                    result[t] = self.memory[t] = emb
+                if self.store is not None:
+                    self.store.put_many([(text_key(t), emb) for t, emb in zip(batch, embs)])
+                pbar.update(len(batch_ids))
+            pbar.close()
+            self.encoded += len(missing)
+            self.encode_seconds += time.time() - t0
+        return result
+
+    @staticmethod
+    def _greedy_match(cand, ref):
+        """cand、ref为逐token单位向量，首尾为[CLS]/[SEP]，权重为0"""
+        sim = cand @ ref.T
+        precision = sim.max(axis=1)[1:-1]
+        recall = sim.max(axis=0)[1:-1]
+        p = float(precision.mean()) if precision.size else 0.0
+        r = float(recall.mean()) if recall.size else 0.0
+        f = 2 * p * r / (p + r) if p + r else 0.0
+        return p, r, f
+
+    def score(self, cands, refs):
+        """与bert_score.score(cands, refs)相同，返回P、R、F1三个列表"""
+        embs = self.embed(list(cands) + list(refs))
+        P, R, F = [], [], []
+        for cand, ref in zip(cands, refs):
+            p, r, f = self._greedy_match(embs[cand.strip()], embs[ref.strip()])
+            P.append(p)
+            R.append(r)
+            F.append(f)
+        return P, R, F
+
+    def summary(self):
+        rate = f"，{self.encoded / self.encode_seconds:.1f}条/秒" if self.encode_seconds else ""
+        fill = f"，padding后有效token占{self.real_tokens / self.padded_tokens:.1%}" if self.padded_tokens else ""
+        return (f"BERT编码{self.encoded}条（后端{self.backend_tag or 'torch'}，{self.encode_seconds:.1f}s{rate}{fill}），"
+                f"其余来自缓存")
+
+def check_backend(scorer, cands, refs, limit=200):
+    """
+    精度检验：取前limit对，用PyTorch后端（不走缓存）重算BERTScore，与scorer（如ONNX int8后端）的结果比较，
+    返回F1逐条差值的最大值、平均值以及平均F1的差。
+    """
+    cands, refs = list(cands)[:limit], list(refs)[:limit]
+    reference = BertScorer(scorer.model_type, scorer.num_layers, scorer.device, scorer.batch_size,
+                           max_batch_tokens=scorer.max_batch_tokens)
+    f1 = scorer.score(cands, refs)[2]
+    ref_f1 = reference.score(cands, refs)[2]
+    diffs = [abs(a - b) for a, b in zip(f1, ref_f1)]
+    return {
+        "pairs": len(diffs),
+        "max_abs_diff": max(diffs) if diffs else 0.0,
+        "mean_abs_diff": sum(diffs) / len(diffs) if diffs else 0.0,
+        "mean_f1_diff": (sum(f1) - sum(ref_f1)) / len(diffs) if diffs else 0.0,
+        "torch_rate": reference.encoded / reference.encode_seconds if reference.encode_seconds else None,
+    }
+
+def add_bertscore_args(parser):
+    parser.add_argument("--model_type", default="bert-base-uncased", help="BERTScore使用的模型")
+    parser.add_argument("--num_layers", type=int, default=None, help="取第几层的输出，默认与bert_score库一致（bert-base-uncased为9）")
+    parser.add_argument("--bert_batch_size", type=int, default=64, help="BERT编码每批的最大条数")
+    parser.add_argument("--bert_batch_tokens", type=int, default=8192,
+                        help="BERT编码每批padding后的token上限，句子按长度排序后组批，0为不限")
+    parser.add_argument("--embedding_cache", default=None,
+                        help="逐token向量的持久化缓存目录，金标准和重复出现的预测句只编码一次，跨模型复用；不传则只在本次运行内复用")
+    parser.add_argument("--embedding_dtype", default="float32", choices=["float32", "float16"],
+                        help="缓存向量的存储精度，float16占用减半，分数有约1e-4的误差")
+    parser.add_argument("--backend", default="torch", choices=["torch", "onnx"],
+                        help="BERT推理后端，onnx为导出到ONNX后在CPU上用onnxruntime推理")
+    parser.add_argument("--quantize", action="store_true", help="onnx后端使用int8动态量化模型")
+    parser.add_argument("--onnx_dir", default="data/evaluation/bertscore_onnx", help="导出的ONNX模型存放目录，已导出则直接复用")
+    parser.add_argument("--bert_threads", type=int, default=0, help="推理线程数，0为后端默认")
+    parser.add_argument("--verify_backend", type=int, default=0,
+                        help="非torch后端时，取前N对用PyTorch重算并报告F1差异，0为不检验")
+
+def open_bertscorer(args, device):
+    """按命令行参数创建BertScorer，指定--embedding_cache时挂上磁盘向量缓存"""
+    num_layers = args.num_layers or DEFAULT_LAYERS.get(args.model_type, 9)
+    scorer = BertScorer(args.model_type, num_layers, device, args.bert_batch_size, backend=args.backend,
+                        onnx_dir=args.onnx_dir, quantize=args.quantize, threads=args.bert_threads,
+                        max_batch_tokens=args.bert_batch_tokens)
+    if args.embedding_cache:
+        scorer.store = EmbeddingStore(
+            store_dir(args.embedding_cache, args.model_type, num_layers, args.embedding_dtype, scorer.backend_tag),
+            dtype=args.embedding_dtype
+        )
+        logging.info(f"启用向量缓存：{scorer.store.path}")
+    return scorer
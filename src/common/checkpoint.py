@@ -0,0 +1,117 @@
+import json
+import os
+import logging
+
+def load_records(path):
+    """读取jsonl输出文件，跳过空行和中断时写了一半的坏行，文件不存在时返回空列表"""
+    records = []
+    if not os.path.exists(path):
+        return records
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                records.append(json.loads(line))
+            except Exception:
+                continue
+    return records
+
+def trim_partial_line(path):
+    """
+    续跑前调用：中断时可能留下没有换行结尾的半行，直接追加会把新记录粘在它后面，
+    这里把文件截断到最后一个完整行（半行本来就无法解析）。返回截掉的字节数。
+    """
+    if not os.path.exists(path):
+        return 0
+    with open(path, "rb+") as f:
+        size = f.seek(0, os.SEEK_END)
+        if size == 0:
+            return 0
+        f.seek(size - 1)
+        if f.read(1) == b"\n":
+            return 0
+        # 从末尾往前找最后一个换行
+        pos = size
+        while pos > 0:
+            step = min(65536, pos)
+            f.seek(pos - step)
+            chunk = f.read(step)
+            cut = chunk.rfind(b"\n")
+            if cut >= 0:
+                pos = pos - step + cut + 1
+                break
+            pos -= step
+        f.truncate(pos)
+    logging.warning(f"{path}末尾有中断时写了一半的行，已截掉{size - pos}字节")
+    return size - pos
+
+def is_done_record(obj):
+    """
+    成功记录算完成；带"final": true的error记录（如缺gold、提取不到预测答案这类输入不变重跑结果也不变的预检失败）同样算完成，
+    其余error记录重跑时会重新请求。
+    """
+    return "error" not in obj or bool(obj.get("final"))
+
+def get_done_set(output_path):
+    """
+    断点续跑：返回输出文件中已完成的idx集合（见is_done_record）。
+    可重试的失败记录不算完成，重跑时只会重新请求这些失败项和缺失项。
+    """
+    done_set = set()
+    for obj in load_records(output_path):
+        if "idx" in obj and is_done_record(obj):
+            done_set.add(obj["idx"])
+    return done_set
+
+def report_resume(output_path, done_set):
+    if done_set:
+        msg = f"检测到{output_path}中已完成 {len(done_set)} 条，将跳过这些样本..."
+        print(msg)
+        logging.info(msg)
+
+def compact_output(output_path, latest_ids=None, expected_ids=None):
+    """
+    整理续跑后的输出文件：同一idx出现多次时优先保留最后一条成功记录，
+    全部失败则保留最后一条错误记录；latest_ids中的idx（旧结果已过期）无论成败都保留最后一条。
+    expected_ids中没有任何记录的idx补一条"No result generated."错误记录，保证下游统计的条数与输入一致。
+    按idx排序后写临时文件再原子替换原文件。
+    """
+    records = load_records(output_path)
+    present = {obj["idx"] for obj in records if "idx" in obj}
+    missing = [idx for idx in (expected_ids or ()) if idx not in present]
+    if missing:
+        logging.warning(f"{len(missing)}条没有生成结果，写入错误记录占位：{missing[:20]}")
+        records.extend({"idx": idx, "error": "No result generated."} for idx in missing)
+    if not records:
+        return
+    idx2record = {}
+    no_idx = []
+    for obj in records:
+        if "idx" not in obj:
+            no_idx.append(obj)
+            continue
+        old = idx2record.get(obj["idx"])
+        if old is None or not is_done_record(old) or is_done_record(obj) or obj["idx"] in (latest_ids or ()):
+            idx2record[obj["idx"]] = obj
+    ordered = [idx2record[idx] for idx in sorted(idx2record, key=lambda x: (x is None, x if x is not None else 0))]
+    tmp_path = output_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as fout:
+        for obj in ordered + no_idx:
+            fout.write(json.dumps(obj, ensure_ascii=False) + "\n")
+    os.replace(tmp_path, output_path)
+    n_error = sum(1 for obj in ordered if not is_done_record(obj))
+    logging.info(f"输出文件整理完成：共{len(ordered)}条，其中失败{n_error}条（重跑同一命令即可只补这些）")
+
+def drop_records(output_path, idx_set):
+    """删除输出文件中idx属于idx_set的记录（上游输入变化后让这些样本重新计算），写临时文件后原子替换"""
+    if not idx_set or not os.path.exists(output_path):
+        return 0
+    records = load_records(output_path)
+    kept = [obj for obj in records if obj.get("idx") not in idx_set]
+    tmp_path = output_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as fout:
+        for obj in kept:
+            fout.write(json.dumps(obj, ensure_ascii=False) + "\n")
+    os.replace(tmp_path, output_path)
+    return len(records) - len(kept)
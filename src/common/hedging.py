@@ -0,0 +1,214 @@
+import asyncio
+import logging
+import math
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+class RequestCancelled(Exception):
+    """对冲中落败的同步流式请求在读到下一个chunk时关闭连接并抛出该异常"""
+    cancelled = True
+
+class LatencyTracker:
+    """线程安全地记录最近window次成功请求的耗时（秒，从真正发出请求算起），用于取对冲阈值"""
+    def __init__(self, window=500):
+        self.samples = deque(maxlen=window)
+        self.lock = threading.Lock()
+
+    def add(self, seconds):
+        with self.lock:
+            self.samples.append(seconds)
+
+    def __len__(self):
+        with self.lock:
+            return len(self.samples)
+
+    def percentile(self, p):
+        with self.lock:
+            values = sorted(self.samples)
+        if not values:
+            return None
+        rank = max(1, math.ceil(p / 100.0 * len(values)))
+        return values[min(rank, len(values)) - 1]
+
+class Hedger:
+    """
+    请求对冲：请求发出后超过已观测耗时的第percentile分位仍未返回，就再发一个相同的请求，先成功的为准，另一个取消。
+    异步请求直接cancel；同步流式请求在下一个chunk处关闭连接；同步非流式请求无法中断，只是不再等待、结果丢弃。
+    对冲请求数不超过主请求数的budget比例；观测样本不足min_samples时不对冲，阈值不低于min_delay秒。
+    """
+    def __init__(self, percentile=95, budget=0.05, min_samples=20, min_delay=1.0, max_workers=64, window=500):
+        self.percentile = percentile
+        self.budget = budget
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.tracker = LatencyTracker(window)
+        self.max_workers = max_workers
+        self.executor = None
+        self.lock = threading.Lock()
+        self.stats = {"primary": 0, "hedged": 0, "hedge_won": 0, "over_budget": 0}
+
+    def delay(self):
+        """当前的对冲阈值（秒），样本不足时为None"""
+        if len(self.tracker) < self.min_samples:
+            return None
+        return max(self.min_delay, self.tracker.percentile(self.percentile))
+
+    def _count_primary(self):
+        with self.lock:
+            self.stats["primary"] += 1
+
+    def _take_budget(self):
+        with self.lock:
+            if self.stats["hedged"] + 1 > self.budget * self.stats["primary"]:
+                self.stats["over_budget"] += 1
+                return False
+            self.stats["hedged"] += 1
+            return True
+
+    def _observe(self, timing):
+        if timing.get("start"):
+            self.tracker.add(time.time() - timing["start"])
+
+    def _won(self, timing, winner_timing, hedge_won):
+        timing.update({k: v for k, v in winner_timing.items() if k != "cancel"})
+        if hedge_won:
+            with self.lock:
+                self.stats["hedge_won"] += 1
+        self._observe(winner_timing)
+
+    @staticmethod
+    def _remaining(timing, delay):
+        """距离对冲还需等待的秒数；请求还在限流器里排队（尚未发出）时按整段delay再等"""
+        start = timing.get("start")
+        return delay if start is None else start + delay - time.time()
+
+    def _pool(self):
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="hedge")
+            return self.executor
+
+    def call(self, fn, timing):
+        """
+        同步调用：fn(timing)发出一次请求并返回结果，timing中记下start等时间点，
+        流式请求应在timing["cancel"]被置位时放弃。胜出请求的时间点写回timing，对冲过时timing["hedged"]为True。
+        """
+        self._count_primary()
+        delay = self.delay()
+        if delay is None:
+            result = fn(timing)
+            self._observe(timing)
+            return result
+        pool = self._pool()
+        p_timing = {"cancel": threading.Event()}
+        primary = pool.submit(fn, p_timing)
+        while True:
+            remaining = self._remaining(p_timing, delay)
+            if remaining <= 0:
+                break
+            done, _ = wait([primary], timeout=remaining)
+            if done:
+                result = primary.result()
+                self._won(timing, p_timing, False)
+                return result
+        if not self._take_budget():
+            result = primary.result()
+            self._won(timing, p_timing, False)
+            return result
+        timing["hedged"] = True
+        h_timing = {"cancel": threading.Event()}
+        hedge = pool.submit(fn, h_timing)
+        pending = {primary: p_timing, hedge: h_timing}
+        first_error = None
+        while pending:
+            done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+            for future in done:
+                winner_timing = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    first_error = first_error or e
+                    continue
+                for other, other_timing in pending.items():
+                    other_timing["cancel"].set()
+                    other.cancel()
+                self._won(timing, winner_timing, future is hedge)
+                return result
+        raise first_error
+
+    async def call_async(self, fn, timing):
+        """异步调用：fn(timing)为协程函数，落败的一方直接取消（中断HTTP请求并归还限流名额）"""
+        self._count_primary()
+        delay = self.delay()
+        if delay is None:
+            result = await fn(timing)
+            self._observe(timing)
+            return result
+        p_timing = {}
+        primary = asyncio.ensure_future(fn(p_timing))
+        hedge = None
+        try:
+            while True:
+                remaining = self._remaining(p_timing, delay)
+                if remaining <= 0:
+                    break
+                done, _ = await asyncio.wait({primary}, timeout=remaining)
+                if done:
+                    result = primary.result()
+                    self._won(timing, p_timing, False)
+                    return result
+            if not self._take_budget():
+                result = await primary
+                self._won(timing, p_timing, False)
+                return result
+            timing["hedged"] = True
+            h_timing = {}
+            hedge = asyncio.ensure_future(fn(h_timing))
+            pending = {primary: p_timing, hedge: h_timing}
+            first_error = None
+            while pending:
+                done, _ = await asyncio.wait(set(pending), return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    winner_timing = pending.pop(task)
+                    if task.exception() is not None:
+                        first_error = first_error or task.exception()
+                        continue
+                    self._won(timing, winner_timing, task is hedge)
+                    return task.result()
+            raise first_error
+        finally:
+            for task in (primary, hedge):
+                if task is not None and not task.done():
+                    task.cancel()
+
+    def summary(self):
+        with self.lock:
+            s = dict(self.stats)
+        threshold = self.delay()
+        threshold = f"{threshold:.2f}s" if threshold is not None else "样本不足"
+        return (f"请求对冲统计：主请求{s['primary']}次，对冲{s['hedged']}次（对冲先返回{s['hedge_won']}次），"
+                f"超出预算未对冲{s['over_budget']}次，当前阈值p{self.percentile:g}={threshold}")
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+def add_hedge_args(parser):
+    parser.add_argument("--hedge_percentile", type=float, default=0,
+                        help="请求耗时超过已观测耗时的该分位（如95）仍未返回时再发一个相同请求，先返回的为准；0为不对冲")
+    parser.add_argument("--hedge_budget", type=float, default=0.05, help="对冲请求数占主请求数的比例上限")
+    parser.add_argument("--hedge_min_samples", type=int, default=20, help="至少观测到这么多次成功请求后才开始对冲")
+    parser.add_argument("--hedge_min_delay", type=float, default=1.0, help="对冲阈值的下限（秒）")
+
+def open_hedger(args):
+    """按命令行参数创建对冲器，未指定--hedge_percentile时返回None"""
+    if not getattr(args, "hedge_percentile", 0):
+        return None
+    hedger = Hedger(
+        percentile=args.hedge_percentile, budget=args.hedge_budget, min_samples=args.hedge_min_samples,
+        min_delay=args.hedge_min_delay, max_workers=max(8, 3 * getattr(args, "threads", 4))
+    )
+    logging.info(f"启用请求对冲：p{args.hedge_percentile:g}，预算{args.hedge_budget:.0%}")
+    return hedger
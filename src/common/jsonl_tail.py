@@ -0,0 +1,168 @@
+import json
+import logging
+import os
+import time
+
+from common.checkpoint import compact_output, drop_records
+from common.manifest import report_stale
+
+DONE_SUFFIX = ".done"
+
+def done_marker_path(path):
+    return path + DONE_SUFFIX
+
+def clear_done(path):
+    """生产者开始写输出前删除上次运行留下的完成标记"""
+    marker = done_marker_path(path)
+    if os.path.exists(marker):
+        os.remove(marker)
+
+def mark_done(path):
+    """生产者整理完输出文件后写完成标记，跟随读取的下游据此判断不会再有新记录"""
+    with open(done_marker_path(path), "w", encoding="utf-8") as f:
+        json.dump({"path": path, "finished_at": time.time()}, f)
+
+def is_done(path):
+    return os.path.exists(done_marker_path(path))
+
+def tail_records(path, poll_interval=0.5, idle_timeout=1800):
+    """
+    跟随读取仍在写入的jsonl文件（类似tail -f），逐条yield带idx的记录，每个idx只yield一次：
+    成功记录到达即yield；带error的记录先暂存，生产者续跑补上成功记录则丢弃，到结束仍失败才yield。
+    只处理以换行结尾的完整行；文件被原子替换（如生产者结束时compact_output）后从头重读并按idx去重。
+    出现完成标记且已读完时结束；超过idle_timeout秒既无新行也无标记时告警并结束，None为一直等待。
+    """
+    seen = set()
+    errors = {}
+    fin = None
+    inode = None
+    buf = ""
+    last_progress = time.time()
+    finishing = False
+    try:
+        while True:
+            if fin is None and os.path.exists(path):
+                fin = open(path, "r", encoding="utf-8")
+                inode = os.fstat(fin.fileno()).st_ino
+                buf = ""
+            got_line = False
+            if fin is not None:
+                for chunk in iter(fin.readline, ""):
+                    buf += chunk
+                    if not buf.endswith("\n"):
+                        break
+                    line, buf = buf, ""
+                    got_line = True
+                    if not line.strip():
+                        continue
+                    try:
+                        obj = json.loads(line)
+                    except ValueError:
+                        continue
+                    idx = obj.get("idx")
+                    if idx is None or idx in seen:
+                        continue
+                    if "error" in obj:
+                        errors[idx] = obj
+                        continue
+                    seen.add(idx)
+                    errors.pop(idx, None)
+                    yield obj
+            if got_line:
+                last_progress = time.time()
+                continue
+            # 读到末尾：文件被替换则重新打开，已结束则收尾
+            if fin is not None:
+                try:
+                    replaced = os.stat(path).st_ino != inode
+                except FileNotFoundError:
+                    replaced = False
+                if replaced:
+                    fin.close()
+                    fin = None
+                    continue
+            # 完成标记在原子替换之后写出，看到标记后再检查一轮，读完替换后的文件和最后追加的行
+            if is_done(path):
+                if finishing or not os.path.exists(path):
+                    break
+                finishing = True
+                continue
+            if idle_timeout is not None and time.time() - last_progress > idle_timeout:
+                logging.warning(f"{path}超过{idle_timeout}秒没有新记录也没有完成标记，停止跟随")
+                break
+            time.sleep(poll_interval)
+    finally:
+        if fin is not None:
+            fin.close()
+    for idx in sorted(errors, key=lambda x: (x is None, x if x is not None else 0)):
+        if idx not in seen:
+            yield errors[idx]
+
+class FollowedInput:
+    """
+    跟随模式的输入：逐条读取上游仍在写入的记录，manifest中仍然有效的已完成idx直接复用，其余交给prepare：
+    prepare(idx, obj)返回dict时为不需要LLM的输出记录（如规则解析），直接写入；返回以idx开头的tuple时为LLM任务。
+    hash_fn(idx, obj)给出该条输入的内容哈希，返回None的记录忽略；remaining(seen)在上游结束后给出还需处理的(idx, obj)（如缺答案的benchmark条目）。
+    """
+    def __init__(self, path, output_path, done_set, manifest, prepare, hash_fn, remaining=None,
+                 poll_interval=0.5, idle_timeout=1800):
+        self.path = path
+        self.output_path = output_path
+        self.done_set = done_set
+        self.manifest = manifest
+        self.prepare = prepare
+        self.hash_fn = hash_fn
+        self.remaining = remaining
+        self.poll_interval = poll_interval
+        self.idle_timeout = idle_timeout
+        self.input_hashes = {}
+        self.stale = set()
+        self.reused = 0
+        self.direct = 0
+        self.submitted = 0
+
+    def _records(self):
+        for obj in tail_records(self.path, self.poll_interval, self.idle_timeout):
+            yield obj["idx"], obj
+        if self.remaining is not None:
+            yield from self.remaining(set(self.input_hashes))
+
+    def tasks(self, writer):
+        """逐条yield LLM任务；结果写入顺序按到达顺序登记到writer"""
+        for cur_idx, obj in self._records():
+            if cur_idx in self.input_hashes:
+                continue
+            input_hash = self.hash_fn(cur_idx, obj)
+            if input_hash is None:
+                continue
+            self.input_hashes[cur_idx] = input_hash
+            if cur_idx in self.done_set:
+                if self.manifest.is_fresh(cur_idx, input_hash):
+                    self.reused += 1
+                    continue
+                self.stale.add(cur_idx)
+            writer.expect(cur_idx)
+            prepared = self.prepare(cur_idx, obj)
+            if isinstance(prepared, dict):
+                writer.write(prepared)
+                self.direct += 1
+                continue
+            self.submitted += 1
+            yield prepared
+
+    def finish(self):
+        """writer关闭后调用：重算过的idx以新结果为准，没有结果的idx补错误记录，上游已删除的idx清掉，最后写manifest"""
+        compact_output(self.output_path, latest_ids=self.stale, expected_ids=list(self.input_hashes))
+        gone = set(self.done_set) - set(self.input_hashes)
+        if gone and not self.manifest.legacy and is_done(self.path):
+            drop_records(self.output_path, gone)
+            self.stale |= gone
+        report_stale(self.output_path, self.manifest, len(self.stale), self.reused)
+        self.manifest.save(self.input_hashes)
+        logging.info(f"跟随读取{self.path}：复用{self.reused}条，直接写出{self.direct}条，提交LLM{self.submitted}条")
+
+def add_follow_args(parser, input_name="输入"):
+    parser.add_argument("--follow", action="store_true",
+                        help=f"流水线模式：边读取上游仍在生成的{input_name}文件边处理，直到上游写出<文件>.done完成标记")
+    parser.add_argument("--follow_timeout", type=float, default=1800,
+                        help="跟随模式下超过该秒数既无新记录也无完成标记则结束，0为一直等待")
@@ -0,0 +1,81 @@
+import json
+import os
+import threading
+
+from common.checkpoint import load_records, trim_partial_line
+
+def rewrite_sorted_by_idx(path):
+    """按idx对jsonl文件整体重排（稳定排序，无idx的行排在最后，跳过写了一半的坏行），原子替换原文件"""
+    records = load_records(path)
+    records.sort(key=lambda obj: (obj.get("idx") is None, obj.get("idx") if obj.get("idx") is not None else 0))
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as fout:
+        for obj in records:
+            fout.write(json.dumps(obj, ensure_ascii=False) + "\n")
+    os.replace(tmp_path, path)
+
+class OrderedJsonlWriter:
+    """
+    并发结果的重排序写入器（线程安全）：
+    按expected_order（提交顺序的idx列表）依次落盘，下一个该写的idx一到就写出并flush，
+    其后已到达的连续结果一并写出，因此中途崩溃也只丢失尚在缓冲区里的少量结果。
+    缓冲区超过max_pending条时不再等待慢请求，按到达顺序直接写出以保持内存平稳，
+    close时再按idx重排整个文件。
+    """
+    def __init__(self, path, expected_order, mode="a", max_pending=256):
+        self.path = path
+        self.expected = list(expected_order)
+        self.pos = 0
+        self.max_pending = max_pending
+        self.pending = {}
+        self.spilled = False
+        self.spilled_ids = set()
+        self.lock = threading.Lock()
+        if mode == "a":
+            trim_partial_line(path)
+        self.fout = open(path, mode, encoding="utf-8")
+
+    def expect(self, idx):
+        """追加一个待写入的idx（跟随模式下任务边到边提交，事先不知道完整顺序）"""
+        with self.lock:
+            self.expected.append(idx)
+
+    def _emit(self, record):
+        self.fout.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def write(self, record):
+        with self.lock:
+            self.pending[record.get("idx")] = record
+            while self.pos < len(self.expected):
+                next_idx = self.expected[self.pos]
+                if next_idx in self.pending:
+                    self._emit(self.pending.pop(next_idx))
+                elif next_idx not in self.spilled_ids:
+                    break
+                self.pos += 1
+            if len(self.pending) > self.max_pending:
+                for idx, obj in self.pending.items():
+                    self._emit(obj)
+                    self.spilled_ids.add(idx)
+                self.pending.clear()
+                self.spilled = True
+            self.fout.flush()
+
+    def close(self):
+        with self.lock:
+            if self.fout.closed:
+                return
+            for obj in self.pending.values():
+                self._emit(obj)
+                self.spilled = True
+            self.pending.clear()
+            self.fout.close()
+            if self.spilled:
+                rewrite_sorted_by_idx(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
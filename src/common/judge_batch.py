@@ -0,0 +1,167 @@
+import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from tqdm import tqdm
+from common.llm_call import create_chat
+
+def batch_system_prompt(system_prompt, entry_example):
+    """在原system prompt后追加多条打包的说明，要求按idx逐条返回results数组"""
+    return (
+        system_prompt.rstrip() +
+        "\n\nYou will receive several items in one message, each starting with a line '### Item idx=<idx>'. "
+        "Handle every item independently according to the instructions above. "
+        "Only output one JSON object of the form {\"results\": [ ... ]} containing exactly one entry per item, "
+        f"each entry like: {entry_example}"
+    )
+
+def batch_user_prompt(entries):
+    """entries为[(idx, 单条user prompt)]"""
+    return "\n\n".join(f"### Item idx={idx}\n{text}" for idx, text in entries)
+
+def parse_batch_results(content, expected_ids, validate):
+    """
+    解析批量返回的{"results": [...]}（也接受直接返回数组），返回{idx: entry}。
+    只保留idx属于本批、通过validate(idx, entry)校验且不重复的条目，其余由调用方逐条补请求。
+    """
+    try:
+        obj = json.loads(content)
+    except Exception:
+        return {}
+    results = obj.get("results") if isinstance(obj, dict) else obj
+    if not isinstance(results, list):
+        return {}
+    expected = set(expected_ids)
+    valid = {}
+    duplicated = set()
+    for entry in results:
+        if not isinstance(entry, dict):
+            continue
+        idx = entry.get("idx")
+        # 模型偶尔把idx写成字符串
+        if isinstance(idx, str) and idx.strip().lstrip("-").isdigit():
+            idx = int(idx.strip())
+        if idx not in expected:
+            continue
+        if idx in valid:
+            duplicated.add(idx)
+            continue
+        try:
+            ok = validate(idx, entry)
+        except Exception:
+            ok = False
+        if ok:
+            valid[idx] = entry
+    for idx in duplicated:
+        valid.pop(idx, None)
+    return valid
+
+def is_valid_gpt_score(idx, entry):
+    """gpt_test打分条目：score为1~5的整数，match为布尔值，reason为字符串"""
+    score = entry.get("score")
+    return (isinstance(score, int) and not isinstance(score, bool) and 1 <= score <= 5
+            and isinstance(entry.get("match"), bool) and isinstance(entry.get("reason"), str))
+
+def request_batch(client, model, system_prompt, entries, validate, max_retries=5, cache=None, label="批量",
+                  telemetry=None, limiter=None):
+    """
+    一次请求判定一组条目，返回{idx: entry}（只含合法条目）。
+    请求异常时按5/10/15/20/25秒重试，全部失败或返回内容无法解析时返回空dict，交给逐条回退。
+    """
+    kwargs = dict(
+        model=model,
+        messages=[
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": batch_user_prompt(entries)},
+        ],
+        response_format={"type": "json_object"},
+    )
+    # 遥测中批量请求以首尾idx标记
+    item = f"batch:{entries[0][0]}-{entries[-1][0]}"
+    wait_times = [5, 10, 15, 20, 25]
+    for attempt in range(max_retries):
+        try:
+            content = create_chat(client, kwargs, cache=cache, limiter=limiter, telemetry=telemetry, item=item).content
+        except Exception as e:
+            logging.warning(f"{label}第{attempt + 1}次请求出错：{e}")
+            if attempt < max_retries - 1:
+                time.sleep(wait_times[min(attempt, len(wait_times) - 1)])
+            continue
+        valid = parse_batch_results(content, [idx for idx, _ in entries], validate)
+        if not valid and cache is not None:
+            # 整批都不合法的回答不留在缓存里
+            cache.delete(kwargs)
+        return valid
+    logging.error(f"{label}请求重试{max_retries}次仍失败，全部改为逐条请求。")
+    return {}
+
+def run_judge_tasks(tasks, writer, threads, single_fn, batch_fn=None, batch_size=1, desc="LLM judging",
+                    error_fields=None):
+    """
+    并发执行判定任务并按顺序写入writer。tasks的每个元素是以idx开头的tuple：
+    batch_size<=1时每条调用single_fn(*task)；否则每batch_size条打成一组调用batch_fn(group)，
+    batch_fn返回该组每条的输出记录。线程异常时写入error记录，error_fields为其附带的额外字段。
+    """
+    batched = batch_fn is not None and batch_size > 1
+    if batched:
+        units = [tasks[i:i + batch_size] for i in range(0, len(tasks), batch_size)]
+    else:
+        units = [[task] for task in tasks]
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        future2unit = {}
+        for unit in units:
+            future2unit[_submit_unit(executor, unit, single_fn, batch_fn if batched else None)] = unit
+        with tqdm(total=len(tasks), desc=desc) as pbar:
+            for future in as_completed(future2unit):
+                unit = future2unit[future]
+                for out in _unit_outputs(future, unit, error_fields):
+                    writer.write(out)
+                pbar.update(len(unit))
+
+def run_judge_stream(task_iter, writer, threads, single_fn, batch_fn=None, batch_size=1, desc="LLM judging",
+                     error_fields=None):
+    """
+    与run_judge_tasks相同，但任务来自迭代器（如跟随读取仍在生成的答案文件）：
+    每攒够一组就提交，结果完成即写入writer，判定与上游生成重叠进行。返回任务总数。
+    """
+    batched = batch_fn is not None and batch_size > 1
+    size = batch_size if batched else 1
+    count = 0
+    with ThreadPoolExecutor(max_workers=threads) as executor, tqdm(desc=desc) as pbar:
+        def submit(unit):
+            future = _submit_unit(executor, unit, single_fn, batch_fn if batched else None)
+
+            def on_done(f):
+                for out in _unit_outputs(f, unit, error_fields):
+                    writer.write(out)
+                pbar.update(len(unit))
+            future.add_done_callback(on_done)
+
+        unit = []
+        for task in task_iter:
+            unit.append(task)
+            count += 1
+            if len(unit) >= size:
+                submit(unit)
+                unit = []
+        if unit:
+            submit(unit)
+    return count
+
+def _submit_unit(executor, unit, single_fn, batch_fn=None):
+    if batch_fn is not None:
+        return executor.submit(batch_fn, unit)
+    return executor.submit(single_fn, *unit[0])
+
+def _unit_outputs(future, unit, error_fields=None):
+    """取一组任务的输出记录；线程异常时为组内每条生成error记录"""
+    try:
+        outs = future.result()
+        if isinstance(outs, dict):
+            outs = [outs]
+    except Exception as e:
+        outs = [
+            dict({"idx": task[0], "error": f"Threaded error: {e}"}, **(error_fields or {}))
+            for task in unit
+        ]
+    return outs
@@ -0,0 +1,172 @@
+import ast
+import json
+import re
+
+CHEMPROT_LABELS = ["CPR:3", "CPR:4", "CPR:5", "CPR:6", "CPR:9", "false"]
+BIORED_LABELS = ["Positive_Correlation", "Negative_Correlation", "Association"]
+
+# 整条输出（或答案标记之后的内容）恰好是这些写法时，直接映射到标准标签
+CHEMPROT_ALIASES = {
+    "cpr:3": "CPR:3", "cpr3": "CPR:3", "cpr 3": "CPR:3",
+    "upregulator": "CPR:3", "activator": "CPR:3", "indirect upregulator": "CPR:3",
+    "cpr:4": "CPR:4", "cpr4": "CPR:4", "cpr 4": "CPR:4",
+    "downregulator": "CPR:4", "inhibitor": "CPR:4", "indirect downregulator": "CPR:4",
+    "cpr:5": "CPR:5", "cpr5": "CPR:5", "cpr 5": "CPR:5",
+    "agonist": "CPR:5", "agonist activator": "CPR:5", "agonist inhibitor": "CPR:5",
+    "cpr:6": "CPR:6", "cpr6": "CPR:6", "cpr 6": "CPR:6", "antagonist": "CPR:6",
+    "cpr:9": "CPR:9", "cpr9": "CPR:9", "cpr 9": "CPR:9",
+    "substrate": "CPR:9", "product of": "CPR:9", "substrate product of": "CPR:9",
+    "false": "false", "none": "false", "no relation": "false", "no relationship": "false",
+}
+BIORED_ALIASES = {
+    "positive correlation": "Positive_Correlation", "positive": "Positive_Correlation",
+    "negative correlation": "Negative_Correlation", "negative": "Negative_Correlation",
+    "association": "Association", "associated": "Association",
+    "bind": "Bind", "binding": "Bind",
+    "cotreatment": "Cotreatment", "co treatment": "Cotreatment",
+    "comparison": "Comparison",
+    "drug interaction": "Drug_Interaction",
+    "conversion": "Conversion",
+}
+
+# 规则有改动时递增，写入model_test的manifest配置，使旧的规则解析结果失效
+RULES_VERSION = 3
+
+# 出现在这些标记之后的标签视为模型给出的最终答案；整词匹配，避免命中Correlation中的relation、answered中的answer
+# （chemprot的prompt要求的输出格式就是"OUTPUT: 标签"）
+ANSWER_MARKERS = re.compile(
+    r"\b(?:final answer|answer|final output|output|label|relation(?:ship)?(?: type)?(?: is)?|correct relation(?:ship)? is|"
+    r"best described as|classified as|corresponds to)\b\s*[:：]?\s*",
+    re.IGNORECASE
+)
+NEGATION = re.compile(r"\b(?:not|no|rather than|instead of|neither|nor|isn't|is not|doesn't)\b[^.\n]{0,40}$", re.IGNORECASE)
+
+def extract_candidate_labels(system_prompt):
+    """从system prompt的"Choose the correct relation from [...]"中取本条的候选标签"""
+    match = re.search(r"Choose the correct relation from (\[.*?\])", system_prompt, re.DOTALL)
+    if match:
+        try:
+            labels = ast.literal_eval(match.group(1))
+            if labels:
+                return [str(label) for label in labels]
+        except (ValueError, SyntaxError):
+            pass
+    return BIORED_LABELS
+
+def normalize(text):
+    """去掉<think>段、markdown符号和引号，统一小写，下划线/连字符换成空格"""
+    text = re.sub(r"<think>.*?</think>", " ", text, flags=re.DOTALL)
+    text = re.sub(r"[*`#>\"'“”‘’\[\]()]", " ", text)
+    text = text.lower().replace("_", " ").replace("-", " ")
+    return re.sub(r"\s+", " ", text).strip(" .;,:：。；，")
+
+def _label_pattern(label):
+    """标签在原文中的写法：CPR:4 / CPR 4 / Positive_Correlation / Positive Correlation，需整词匹配，不区分大小写"""
+    body = "".join(
+        r"[:\s]?" if ch == ":" else r"[_\s]" if ch in "_ " else re.escape(ch)
+        for ch in label
+    )
+    return re.compile(r"(?<![\w:])" + body + r"(?![\w:])", re.IGNORECASE)
+
+def _is_bare_word(term):
+    """单个普通英文单词（如association、negative），在行文中随口出现的可能性大，不能单凭它认定标签"""
+    return re.fullmatch(r"[a-z]+", normalize(term)) is not None
+
+def _label_spans(text, labels):
+    return [m.span() for label in labels for m in _label_pattern(label).finditer(text)]
+
+def _alias_lookup(fragment, aliases, labels):
+    key = normalize(fragment)
+    for label in labels:
+        if key == normalize(label):
+            return label
+    label = aliases.get(key)
+    if label in labels:
+        return label
+    return None
+
+def _marker_label(text, marker, aliases, labels):
+    """答案标记之后给出的标签，不是标签则返回None"""
+    tail = text[marker.end():]
+    # 答案标记之后第一个有内容的行（"**OUTPUT:**"后换行再给标签时跳过只剩markdown符号的部分）
+    first_line = next((line for line in tail.split("\n") if normalize(line)), "")
+    # 答案标记之后的第一句，如 "**Answer:** Positive_Correlation."；分号后还有下文的（"the relation is "CPR:5"; if ..."）不算句子结束
+    head = re.split(r"(?<=[.。])\s", first_line.strip())[0]
+    return _alias_lookup(head, aliases, labels)
+
+def extract_label(text, labels, aliases):
+    """
+    规则抽取标签，返回(标签或None, 置信度, 命中规则)：
+    - 1.0  exact：整条输出去掉格式后就是标签或其别名；
+    - 0.98 json：输出里带 "label": "..."；
+    - 0.95 marker / last_line：最后一个答案标记（Answer:、OUTPUT:、relation is 等）之后或最后一行正好是标签；
+    - 0.5  conflict：同上，但其他答案标记或单独成行的标签给出了不同的标签，交给LLM判断；
+    - 0.9  single：全文只提到一种候选标签（含别名，不区分大小写）且前面没有否定词；
+    - 0.6  single_bare：同上，但只以单个普通单词的形式出现（如association），交给LLM判断；
+    - 0.5  multiple：提到多种候选标签，交给LLM判断；
+    - 0.0  none：一个都没有。
+    """
+    if not text or not text.strip():
+        return None, 0.0, "empty"
+    text = re.sub(r"<think>.*?</think>", " ", text, flags=re.DOTALL).strip()
+
+    label = _alias_lookup(text, aliases, labels)
+    if label:
+        return label, 1.0, "exact"
+
+    match = re.search(r'"label"\s*:\s*"([^"]+)"', text)
+    if match:
+        label = _alias_lookup(match.group(1), aliases, labels)
+        if label:
+            return label, 0.98, "json"
+
+    # 落在标签内部的标记（如Negative Correlation里的relation）不算；
+    # 后面紧跟括号的是解释性文字里的注解（如"No substrate/product relationship (CPR:9)"），也不算
+    spans = _label_spans(text, labels)
+    markers = [m for m in ANSWER_MARKERS.finditer(text)
+               if not any(start < m.end() and m.start() < end for start, end in spans)
+               and not text[m.end():].lstrip("*_ \t").startswith(("(", "（"))]
+    lines = [line for line in text.split("\n") if line.strip()]
+    # 各答案标记和单独成行的标签给出的结论；前后说法不一（如先"CPR:5"后"false"、罗列多个示例答案）时交给LLM判断
+    marker_labels = [_marker_label(text, m, aliases, labels) for m in markers]
+    stated = {label for label in marker_labels if label} | {
+        label for label in (_alias_lookup(line, aliases, labels) for line in lines) if label
+    }
+    if marker_labels and marker_labels[-1]:
+        label = marker_labels[-1]
+        if len(stated) > 1:
+            return label, 0.5, "conflict"
+        return label, 0.95, "marker"
+
+    label = _alias_lookup(lines[-1], aliases, labels)
+    if label:
+        if len(stated) > 1:
+            return label, 0.5, "conflict"
+        return label, 0.95, "last_line"
+
+    # 标签和别名都在规范化后的文本上整词匹配
+    norm = normalize(text)
+    terms = [(label, label) for label in labels] + [(alias, label) for alias, label in aliases.items() if label in labels]
+    found = {}
+    bare = {}
+    for term, label in terms:
+        for m in _label_pattern(normalize(term)).finditer(norm):
+            found.setdefault(label, []).append(m.start())
+            bare[label] = bare.get(label, True) and _is_bare_word(term)
+    if len(found) == 1:
+        label, positions = next(iter(found.items()))
+        negated = any(NEGATION.search(norm[max(0, pos - 60):pos]) for pos in positions)
+        if negated:
+            return label, 0.4, "single_negated"
+        if bare[label]:
+            return label, 0.6, "single_bare"
+        return label, 0.9, "single"
+    if len(found) > 1:
+        # 多个标签时取最后出现的一个，供参考
+        label = max(found, key=lambda k: found[k][-1])
+        return label, 0.5, "multiple"
+    return None, 0.0, "none"
+
+def rule_label_json(label):
+    """与LLM裁判输出同样格式的label_json，下游model_result无需区分来源"""
+    return json.dumps({"label": label}, ensure_ascii=False)
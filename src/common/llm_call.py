@@ -0,0 +1,154 @@
+import time
+from types import SimpleNamespace
+
+from common.hedging import RequestCancelled
+
+class ChatResult:
+    """
+    一次chat请求的结果：content为回答文本，usage为token用量（流式或缓存中没有时为None），
+    cached表示是否命中响应缓存。带usage属性，共享限流器可直接据此统计token。
+    """
+    def __init__(self, content, usage=None, cached=False):
+        self.content = content
+        self.usage = usage
+        self.cached = cached
+
+def usage_to_dict(usage):
+    if usage is None:
+        return None
+    if isinstance(usage, dict):
+        return usage
+    out = {k: getattr(usage, k, None) for k in ("prompt_tokens", "completion_tokens", "total_tokens")}
+    details = getattr(usage, "completion_tokens_details", None)
+    reasoning = getattr(details, "reasoning_tokens", None) if details is not None else None
+    if reasoning:
+        out["reasoning_tokens"] = reasoning
+    return out
+
+def _from_cache(hit):
+    usage = SimpleNamespace(**hit["usage"]) if hit["usage"] else None
+    return ChatResult(hit["content"], usage, cached=True)
+
+def _is_first_token(delta):
+    return bool(getattr(delta, "content", None) or getattr(delta, "reasoning_content", None))
+
+def _raw_chat(client, kwargs, stream=False, timing=None):
+    """
+    timing（dict）中记下真正发出请求的时间start，流式时另记第一个token到达的时间first_token；
+    timing["cancel"]（threading.Event）被置位时流式请求关闭连接并抛出RequestCancelled（对冲落败方）。
+    """
+    timing = timing if timing is not None else {}
+    timing["start"] = time.time()
+    if stream:
+        kwargs = dict(kwargs)
+        kwargs.pop("stream_options", None)
+        completion = client.chat.completions.create(stream=True, **kwargs)
+        cancel = timing.get("cancel")
+        full_content = ""
+        usage = None
+        for chunk in completion:
+            if cancel is not None and cancel.is_set():
+                if hasattr(completion, "close"):
+                    completion.close()
+                raise RequestCancelled("对冲请求已由另一方先返回")
+            if getattr(chunk, "usage", None):
+                usage = chunk.usage
+            if hasattr(chunk, "choices") and chunk.choices:
+                delta = chunk.choices[0].delta
+                if "first_token" not in timing and _is_first_token(delta):
+                    timing["first_token"] = time.time()
+                if hasattr(delta, "content") and delta.content:
+                    full_content += delta.content
+        return ChatResult(full_content, usage)
+    completion = client.chat.completions.create(**kwargs)
+    return ChatResult(completion.choices[0].message.content, getattr(completion, "usage", None))
+
+async def _raw_chat_async(client, kwargs, stream=False, timing=None):
+    timing = timing if timing is not None else {}
+    timing["start"] = time.time()
+    if stream:
+        kwargs = dict(kwargs)
+        kwargs.pop("stream_options", None)
+        completion = await client.chat.completions.create(stream=True, **kwargs)
+        full_content = ""
+        usage = None
+        async for chunk in completion:
+            if getattr(chunk, "usage", None):
+                usage = chunk.usage
+            if hasattr(chunk, "choices") and chunk.choices:
+                delta = chunk.choices[0].delta
+                if "first_token" not in timing and _is_first_token(delta):
+                    timing["first_token"] = time.time()
+                if hasattr(delta, "content") and delta.content:
+                    full_content += delta.content
+        return ChatResult(full_content, usage)
+    completion = await client.chat.completions.create(**kwargs)
+    return ChatResult(completion.choices[0].message.content, getattr(completion, "usage", None))
+
+def _limited_chat(client, kwargs, stream, limiter, timing):
+    if limiter is not None:
+        return limiter.call(_raw_chat, client, kwargs, stream, timing)
+    return _raw_chat(client, kwargs, stream, timing)
+
+async def _limited_chat_async(client, kwargs, stream, limiter, timing):
+    if limiter is not None:
+        return await limiter.call_async(_raw_chat_async, client, kwargs, stream, timing)
+    return await _raw_chat_async(client, kwargs, stream, timing)
+
+def create_chat(client, kwargs, stream=False, cache=None, limiter=None, telemetry=None, item=None, hedger=None):
+    """
+    所有chat.completions请求的统一入口（同步）：
+    先查响应缓存，命中则不占用限流额度直接返回；未命中再经共享限流器（如有）调用接口，
+    成功的回答写回缓存。异常原样抛出，由调用方负责重试。
+    传入telemetry时每次调用（含命中缓存和失败）都记一行遥测，item为所属条目（如idx），用于统计尝试次数。
+    传入hedger时未命中缓存的请求可被对冲（见common.hedging.Hedger），对冲请求同样经过限流器。
+    """
+    t0 = time.time()
+    timing = {}
+    if cache is not None:
+        hit = cache.get(kwargs)
+        if hit is not None:
+            result = _from_cache(hit)
+            if telemetry is not None:
+                telemetry.record_call(kwargs, item, t0, timing, result=result, stream=stream)
+            return result
+    try:
+        if hedger is not None:
+            result = hedger.call(lambda t: _limited_chat(client, kwargs, stream, limiter, t), timing)
+        else:
+            result = _limited_chat(client, kwargs, stream, limiter, timing)
+    except Exception as e:
+        if telemetry is not None:
+            telemetry.record_call(kwargs, item, t0, timing, error=e, stream=stream)
+        raise
+    if telemetry is not None:
+        telemetry.record_call(kwargs, item, t0, timing, result=result, stream=stream)
+    if cache is not None:
+        cache.put(kwargs, result.content, usage_to_dict(result.usage))
+    return result
+
+async def create_chat_async(client, kwargs, stream=False, cache=None, limiter=None, telemetry=None, item=None, hedger=None):
+    """create_chat的异步版本，client为AsyncOpenAI"""
+    t0 = time.time()
+    timing = {}
+    if cache is not None:
+        hit = cache.get(kwargs)
+        if hit is not None:
+            result = _from_cache(hit)
+            if telemetry is not None:
+                telemetry.record_call(kwargs, item, t0, timing, result=result, stream=stream)
+            return result
+    try:
+        if hedger is not None:
+            result = await hedger.call_async(lambda t: _limited_chat_async(client, kwargs, stream, limiter, t), timing)
+        else:
+            result = await _limited_chat_async(client, kwargs, stream, limiter, timing)
+    except Exception as e:
+        if telemetry is not None:
+            telemetry.record_call(kwargs, item, t0, timing, error=e, stream=stream)
+        raise
+    if telemetry is not None:
+        telemetry.record_call(kwargs, item, t0, timing, result=result, stream=stream)
+    if cache is not None:
+        cache.put(kwargs, result.content, usage_to_dict(result.usage))
+    return result
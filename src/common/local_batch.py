@@ -0,0 +1,162 @@
+import copy
+from collections import OrderedDict
+import torch
+from transformers import DynamicCache
+
+def build_prompt(tokenizer, system_prompt, user_prompt, enable_thinking=None, use_qwen_template=False):
+    """
+    拼接本地推理用的完整prompt，与各*_answer.py中local_generate的逻辑一致。
+    Qwen系列走chat模板，其余模型直接用换行拼接system和user。
+    """
+    if use_qwen_template and hasattr(tokenizer, "apply_chat_template"):
+        messages = [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt}
+        ]
+        chat_template_kwargs = dict(
+            conversation=messages,
+            tokenize=False,
+            add_generation_prompt=True
+        )
+        if enable_thinking is not None:
+            chat_template_kwargs["enable_thinking"] = enable_thinking
+        return tokenizer.apply_chat_template(**chat_template_kwargs)
+    return system_prompt + "\n" + user_prompt
+
+def local_generate_batch(model, tokenizer, prompts, max_new_tokens=4096, device="cpu"):
+    """
+    批量贪心解码：左侧padding对齐后一次generate多条prompt，
+    只解码每条新生成的token，返回与prompts顺序一致的字符串列表。
+    """
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    # decoder-only模型批量生成必须左padding，否则新token会接在pad后面
+    padding_side = tokenizer.padding_side
+    tokenizer.padding_side = "left"
+    try:
+        inputs = tokenizer(prompts, return_tensors="pt", padding=True).to(device)
+    finally:
+        tokenizer.padding_side = padding_side
+    with torch.no_grad():
+        outputs = model.generate(
+            **inputs,
+            max_new_tokens=max_new_tokens,
+            do_sample=False,
+            pad_token_id=tokenizer.pad_token_id
+        )
+    new_tokens = outputs[:, inputs["input_ids"].shape[1]:]
+    return tokenizer.batch_decode(new_tokens, skip_special_tokens=True)
+
+def count_tokens(tokenizer, prompts):
+    """预先分词统计每条prompt的token数，用于按长度分桶"""
+    encoded = tokenizer(prompts, add_special_tokens=True)
+    return [len(ids) for ids in encoded["input_ids"]]
+
+def split_prompt_prefix(tokenizer, system_prompt, user_prompt, enable_thinking=None, use_qwen_template=False):
+    """
+    返回(prefix, prompt)：prompt为完整prompt，prefix为user内容之前的部分
+    （system prompt及其模板标记），同一system prompt的所有样本共享这一前缀。
+    """
+    prompt = build_prompt(tokenizer, system_prompt, user_prompt, enable_thinking, use_qwen_template)
+    pos = prompt.rfind(user_prompt)
+    prefix = prompt[:pos] if pos > 0 else ""
+    return prefix, prompt
+
+class PrefixCache:
+    """
+    共享前缀的KV cache：每个不同的前缀只prefill一次并保留past_key_values，
+    之后每条样本从它的拷贝继续，只需编码前缀之后的token。
+    max_entries限制同时保留的前缀数（LRU淘汰），前缀逐条变化时设为1即可。
+    """
+    def __init__(self, model, tokenizer, device="cpu", max_entries=8):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.device = device
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+
+    def get(self, prefix):
+        if prefix in self.entries:
+            self.entries.move_to_end(prefix)
+        else:
+            prefix_ids = self.tokenizer(prefix, return_tensors="pt")["input_ids"].to(self.device)
+            with torch.no_grad():
+                out = self.model(input_ids=prefix_ids, use_cache=True)
+            past = out.past_key_values
+            if isinstance(past, tuple):
+                # 老版本transformers返回tuple，转成支持crop的DynamicCache
+                past = DynamicCache.from_legacy_cache(past)
+            self.entries[prefix] = (prefix_ids, past)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return self.entries[prefix]
+
+    def generate(self, prefix, prompt, max_new_tokens=4096):
+        input_ids = self.tokenizer(prompt, return_tensors="pt")["input_ids"].to(self.device)
+        past = None
+        if prefix:
+            prefix_ids, cache = self.get(prefix)
+            # 分词边界可能让前缀最后几个token与完整prompt不同，只复用真正一致的部分
+            n = min(prefix_ids.shape[1], input_ids.shape[1] - 1)
+            same = (input_ids[0, :n] == prefix_ids[0, :n]).long()
+            k = int(same.cumprod(0).sum())
+            if k > 0:
+                past = copy.deepcopy(cache)
+                if k < prefix_ids.shape[1]:
+                    past.crop(k)
+        with torch.no_grad():
+            outputs = self.model.generate(
+                input_ids=input_ids,
+                attention_mask=torch.ones_like(input_ids),
+                past_key_values=past,
+                max_new_tokens=max_new_tokens,
+                do_sample=False,
+                pad_token_id=self.tokenizer.eos_token_id
+            )
+        return self.tokenizer.decode(outputs[0, input_ids.shape[1]:], skip_special_tokens=True)
+
+def _label_rows(tokenizer, prompt, labels):
+    """
+    每个候选标签按它在prompt之后的实际写法分词：prompt不以空白结尾时前面加一个空格，整段一起分词，
+    与prompt分词结果的公共前缀之后都算标签部分（分词边界合并的token也算进去），去掉末尾的特殊token。
+    返回[(整段token ids, 标签token数)]。
+    """
+    sep = "" if prompt[-1:].isspace() else " "
+    prompt_ids = tokenizer(prompt)["input_ids"]
+    special = set(tokenizer.all_special_ids)
+    rows = []
+    for label in labels:
+        ids = tokenizer(prompt + sep + label)["input_ids"]
+        while len(ids) > len(prompt_ids) and ids[-1] in special:
+            ids = ids[:-1]
+        k = 0
+        while k < min(len(ids), len(prompt_ids)) and ids[k] == prompt_ids[k]:
+            k += 1
+        k = max(1, min(k, len(ids) - 1))
+        rows.append((ids, len(ids) - k))
+    return rows
+
+def score_labels(model, tokenizer, prompt, labels, device="cpu"):
+    """
+    候选标签对数似然打分：prompt后分别接上每个候选标签拼成一批，只做一次前向，
+    取标签部分token的平均log概率（按token数归一化，不偏向false这类token少的标签），最后在候选集上softmax归一化。
+    返回(最优标签, {标签: 概率})，不做任何自回归解码。
+    """
+    rows = _label_rows(tokenizer, prompt, labels)
+    pad_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+    max_len = max(len(ids) for ids, _ in rows)
+    input_ids = torch.tensor([ids + [pad_id] * (max_len - len(ids)) for ids, _ in rows], device=device)
+    attention_mask = torch.tensor([[1] * len(ids) + [0] * (max_len - len(ids)) for ids, _ in rows], device=device)
+    with torch.no_grad():
+        logits = model(input_ids=input_ids, attention_mask=attention_mask).logits
+    logprobs = torch.log_softmax(logits.float(), dim=-1)
+    scores = []
+    for i, (ids, n_label) in enumerate(rows):
+        # 位置p的token由p-1处的logits预测
+        positions = torch.arange(len(ids) - n_label, len(ids), device=device)
+        targets = input_ids[i, positions]
+        scores.append(logprobs[i, positions - 1, targets].mean())
+    probs = torch.softmax(torch.stack(scores), dim=0).tolist()
+    label_probs = {label: round(p, 6) for label, p in zip(labels, probs)}
+    best = max(label_probs, key=label_probs.get)
+    return best, label_probs
@@ -0,0 +1,125 @@
+import hashlib
+import json
+import logging
+import os
+
+from common.checkpoint import drop_records
+
+MANIFEST_VERSION = 1
+
+def record_hash(*parts):
+    """对若干可JSON序列化的对象取规范化JSON（键排序）的sha256，作为逐条内容哈希"""
+    payload = json.dumps(parts, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+def file_digest(path, chunk_size=1 << 20):
+    """文件内容的sha256，文件不存在时返回None"""
+    if not os.path.exists(path):
+        return None
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def manifest_path(output_path):
+    return output_path + ".manifest.json"
+
+def load_manifest(output_path):
+    """读取产物旁的manifest，不存在、损坏或版本不符时返回None"""
+    path = manifest_path(output_path)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except ValueError:
+        return None
+    if manifest.get("version") != MANIFEST_VERSION:
+        return None
+    return manifest
+
+def save_manifest(output_path, manifest):
+    manifest = dict(manifest, version=MANIFEST_VERSION)
+    path = manifest_path(output_path)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+class RecordManifest:
+    """
+    逐条产物（按idx的jsonl）的manifest：记录每个idx上游输入的内容哈希和配置（模型、提示词等）的哈希。
+    没有manifest的旧输出视为全部可复用，本次运行后建立manifest。
+    """
+    def __init__(self, output_path, config):
+        self.output_path = output_path
+        self.config = record_hash(config)
+        manifest = load_manifest(output_path)
+        self.legacy = manifest is None
+        self.config_changed = not self.legacy and manifest.get("config") != self.config
+        self.records = {} if self.legacy else manifest.get("records", {})
+
+    def is_fresh(self, idx, input_hash):
+        """该idx已有的结果是否仍对应当前输入和配置"""
+        if self.legacy:
+            return True
+        if self.config_changed:
+            return False
+        return self.records.get(str(idx)) == input_hash
+
+    def save(self, input_hashes):
+        save_manifest(self.output_path, {
+            "config": self.config,
+            "records": {str(idx): h for idx, h in input_hashes.items()},
+        })
+
+def report_stale(output_path, manifest, n_stale, n_reused):
+    if manifest.legacy:
+        if n_reused:
+            logging.info(f"{output_path}没有manifest，沿用已完成的{n_reused}条并建立manifest")
+        return
+    if n_stale:
+        reason = "配置（模型、提示词等）已变化" if manifest.config_changed else "上游输入已变化或已删除"
+        msg = f"{reason}：{n_stale}条需要重算，复用{n_reused}条"
+        print(msg)
+        logging.info(msg)
+
+def reuse_unchanged(output_path, done_set, input_hashes, config):
+    """
+    逐条产物的增量重算：input_hashes为{idx: 该条上游输入的内容哈希}，config为影响结果的配置。
+    已完成但输入哈希或配置与manifest不一致的idx视为过期，从输出文件中删除后重新计算；其余直接复用。
+    返回可复用的done_set，并立即按当前输入写入manifest——之后落盘的记录都对应当前输入，中途中断续跑也不会误判。
+    """
+    manifest = RecordManifest(output_path, config)
+    stale = {idx for idx in done_set if not manifest.is_fresh(idx, input_hashes.get(idx))}
+    if stale:
+        drop_records(output_path, stale)
+    report_stale(output_path, manifest, len(stale), len(done_set) - len(stale))
+    manifest.save(input_hashes)
+    return set(done_set) - stale
+
+def inputs_unchanged(output_path, inputs, config):
+    """汇总类产物（报告txt）：输出存在且所有输入文件内容和配置都与manifest一致时返回True"""
+    manifest = load_manifest(output_path)
+    if manifest is None or not os.path.exists(output_path):
+        return False
+    if manifest.get("config") != record_hash(config):
+        return False
+    return manifest.get("inputs") == {path: file_digest(path) for path in inputs}
+
+def save_inputs_manifest(output_path, inputs, config):
+    save_manifest(output_path, {
+        "config": record_hash(config),
+        "inputs": {path: file_digest(path) for path in inputs},
+    })
+
+def skip_if_unchanged(output_path, inputs, config, force=False):
+    """输入未变化时跳过重算并刷新输出的修改时间（编排器按时间判断是否最新），返回是否跳过"""
+    if force or not inputs_unchanged(output_path, inputs, config):
+        return False
+    os.utime(output_path, None)
+    msg = f"输入与配置均未变化，跳过：{output_path}（--force强制重算）"
+    print(msg)
+    logging.info(msg)
+    return True
@@ -0,0 +1,181 @@
+import asyncio
+import email.utils
+import threading
+import time
+from collections import deque
+
+from common.hedging import RequestCancelled
+
+def is_rate_limit_error(e):
+    """判断异常是否为429限流（openai.RateLimitError或带429状态码的APIStatusError）"""
+    if getattr(e, "status_code", None) == 429:
+        return True
+    return type(e).__name__ == "RateLimitError"
+
+def parse_retry_after(e):
+    """从异常的HTTP响应头中读取Retry-After（秒数或HTTP日期），没有则返回None"""
+    response = getattr(e, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return float(value) / 1000.0
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def usage_tokens(result):
+    usage = getattr(result, "usage", None)
+    return getattr(usage, "total_tokens", 0) or 0
+
+class AdaptiveRateLimiter:
+    """
+    所有worker共享的自适应限流器（AIMD）：
+    - 并发窗口：每次成功 +increase/窗口（约每轮窗口+increase），遇到429乘以decrease_factor；
+    - 可选每秒请求数max_rps、每分钟token数max_tpm上限（滑动窗口统计）；
+    - 429时全局暂停：有Retry-After按其等待，否则从base_pause起随连续429翻倍，
+      所有线程一起等，避免各自退避后同时重试。
+    同步线程用call()，协程用call_async()。
+    """
+    def __init__(self, max_concurrency, min_concurrency=1, max_rps=0, max_tpm=0,
+                 increase=1.0, decrease_factor=0.5, base_pause=2.0, max_pause=60.0):
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.max_rps = max_rps
+        self.max_tpm = max_tpm
+        self.increase = increase
+        self.decrease_factor = decrease_factor
+        self.base_pause = base_pause
+        self.max_pause = max_pause
+        self.window = float(max_concurrency)
+        self.in_flight = 0
+        self.pause_until = 0.0
+        self.last_cut = 0.0
+        self.consecutive_429 = 0
+        self.request_times = deque()
+        self.token_events = deque()
+        self.cond = threading.Condition()
+        self.stats = {"success": 0, "rate_limited": 0, "error": 0}
+
+    def _wait_time(self, now):
+        """返回还需等待的秒数，0表示可以立即发出请求"""
+        if now < self.pause_until:
+            return self.pause_until - now
+        if self.in_flight >= int(self.window):
+            return 0.05
+        if self.max_rps > 0:
+            while self.request_times and self.request_times[0] <= now - 1.0:
+                self.request_times.popleft()
+            if len(self.request_times) >= self.max_rps:
+                return self.request_times[0] + 1.0 - now
+        if self.max_tpm > 0:
+            while self.token_events and self.token_events[0][0] <= now - 60.0:
+                self.token_events.popleft()
+            if sum(tokens for _, tokens in self.token_events) >= self.max_tpm:
+                return self.token_events[0][0] + 60.0 - now
+        return 0.0
+
+    def _try_acquire(self):
+        now = time.time()
+        wait = self._wait_time(now)
+        if wait <= 0:
+            self.in_flight += 1
+            self.request_times.append(now)
+            return now, 0.0
+        return None, wait
+
+    def acquire(self):
+        with self.cond:
+            while True:
+                started, wait = self._try_acquire()
+                if started is not None:
+                    return started
+                self.cond.wait(timeout=min(wait, 1.0))
+
+    async def acquire_async(self):
+        while True:
+            with self.cond:
+                started, wait = self._try_acquire()
+            if started is not None:
+                return started
+            await asyncio.sleep(min(wait, 1.0))
+
+    def release(self, started, tokens=0, error=None):
+        with self.cond:
+            self.in_flight -= 1
+            now = time.time()
+            if getattr(error, "cancelled", False):
+                # 对冲中落败被取消的请求只归还并发名额，不计成功或失败
+                pass
+            elif error is None:
+                self.stats["success"] += 1
+                self.consecutive_429 = 0
+                self.window = min(self.max_concurrency, self.window + self.increase / self.window)
+                if tokens:
+                    self.token_events.append((now, tokens))
+            elif is_rate_limit_error(error):
+                self.stats["rate_limited"] += 1
+                self.consecutive_429 += 1
+                # 同一波并发请求的429只降一次窗口
+                if started >= self.last_cut:
+                    self.window = max(self.min_concurrency, self.window * self.decrease_factor)
+                    self.last_cut = now
+                retry_after = parse_retry_after(error)
+                if retry_after is None:
+                    retry_after = min(self.max_pause, self.base_pause * (2 ** (self.consecutive_429 - 1)))
+                self.pause_until = max(self.pause_until, now + retry_after)
+            else:
+                self.stats["error"] += 1
+            self.cond.notify_all()
+
+    def call(self, fn, *args, **kwargs):
+        started = self.acquire()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            self.release(started, error=e)
+            raise
+        self.release(started, tokens=usage_tokens(result))
+        return result
+
+    async def call_async(self, fn, *args, **kwargs):
+        started = await self.acquire_async()
+        try:
+            result = await fn(*args, **kwargs)
+        except asyncio.CancelledError:
+            self.release(started, error=RequestCancelled())
+            raise
+        except Exception as e:
+            self.release(started, error=e)
+            raise
+        self.release(started, tokens=usage_tokens(result))
+        return result
+
+    def summary(self):
+        with self.cond:
+            return (f"限流器统计：成功{self.stats['success']}次，429共{self.stats['rate_limited']}次，"
+                    f"其他错误{self.stats['error']}次，当前并发窗口{self.window:.1f}")
+
+def add_limit_args(parser):
+    parser.add_argument("--adaptive_limit", action="store_true",
+                        help="启用共享自适应限流器：成功时加性增大并发，429时乘性减小并按Retry-After全局暂停")
+    parser.add_argument("--max_rps", type=float, default=0, help="自适应限流器的每秒请求数上限，0为不限")
+    parser.add_argument("--max_tpm", type=int, default=0, help="自适应限流器的每分钟token数上限，0为不限")
+
+def open_limiter(args, max_concurrency):
+    """按命令行参数创建限流器；未加--adaptive_limit时返回None"""
+    if not args.adaptive_limit:
+        return None
+    return AdaptiveRateLimiter(max_concurrency=max_concurrency, max_rps=args.max_rps, max_tpm=args.max_tpm)
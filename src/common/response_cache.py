@@ -0,0 +1,134 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+# 只影响传输方式、不影响回答内容的参数，不参与缓存key
+TRANSPORT_FIELDS = ("stream", "stream_options", "timeout", "extra_headers")
+
+def cache_key(kwargs):
+    """按请求内容（model、messages、response_format、extra_body及其他采样参数）计算sha256"""
+    payload = {k: v for k, v in kwargs.items() if k not in TRANSPORT_FIELDS}
+    text = json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+class ResponseCache:
+    """
+    基于SQLite的LLM响应缓存（内容寻址）：同一请求只真正调用一次接口，重跑时直接读盘。
+    - max_size_mb：缓存总大小上限，超出时按最近访问时间淘汰最旧的记录；
+    - max_age_days：记录有效期，过期视为未命中并删除，0为永不过期；
+    - 统计命中/未命中/写入/淘汰次数，summary()输出到日志。
+    单个连接加锁供多线程共享，WAL模式下多个进程可同时读写同一个库文件。
+    """
+    def __init__(self, path, max_size_mb=1024, max_age_days=0):
+        self.path = path
+        self.max_bytes = int(max_size_mb * 1024 * 1024) if max_size_mb else 0
+        self.max_age = max_age_days * 86400 if max_age_days else 0
+        self.lock = threading.Lock()
+        self.stats = {"hit": 0, "miss": 0, "write": 0, "evict": 0}
+        cache_dir = os.path.dirname(path)
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, model TEXT, content TEXT NOT NULL, usage TEXT, "
+            "size INTEGER NOT NULL, created REAL NOT NULL, last_access REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_last_access ON responses(last_access)")
+        self.evict()
+
+    def get(self, kwargs):
+        """命中时返回{"content": ..., "usage": dict或None}，否则返回None"""
+        key = cache_key(kwargs)
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT content, usage, created FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and self.max_age and row[2] < now - self.max_age:
+                self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.stats["evict"] += 1
+                row = None
+            if row is None:
+                self.stats["miss"] += 1
+                return None
+            self.conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+            self.stats["hit"] += 1
+        return {"content": row[0], "usage": json.loads(row[1]) if row[1] else None}
+
+    def put(self, kwargs, content, usage=None):
+        if content is None:
+            return
+        key = cache_key(kwargs)
+        usage_text = json.dumps(usage) if usage else None
+        size = len(content.encode("utf-8")) + len(usage_text or "")
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses (key, model, content, usage, size, created, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, kwargs.get("model"), content, usage_text, size, now, now)
+            )
+            self.stats["write"] += 1
+            need_evict = self.stats["write"] % 200 == 0
+        if need_evict:
+            self.evict()
+
+    def delete(self, kwargs):
+        """删除某个请求的缓存（如返回内容未通过校验，避免之后一直命中坏结果）"""
+        with self.lock:
+            self.conn.execute("DELETE FROM responses WHERE key = ?", (cache_key(kwargs),))
+
+    def evict(self):
+        """先删过期记录，再按最近访问时间从旧到新删除，直到总大小不超过上限"""
+        with self.lock:
+            if self.max_age:
+                cur = self.conn.execute("DELETE FROM responses WHERE created < ?", (time.time() - self.max_age,))
+                self.stats["evict"] += max(cur.rowcount, 0)
+            if not self.max_bytes:
+                return
+            total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            # 一次删到上限的90%，避免每次写入都触发淘汰
+            target = total - int(self.max_bytes * 0.9)
+            freed = 0
+            victims = []
+            for key, size in self.conn.execute("SELECT key, size FROM responses ORDER BY last_access ASC"):
+                if freed >= target:
+                    break
+                victims.append((key,))
+                freed += size
+            self.conn.executemany("DELETE FROM responses WHERE key = ?", victims)
+            self.stats["evict"] += len(victims)
+
+    def summary(self):
+        with self.lock:
+            hit, miss = self.stats["hit"], self.stats["miss"]
+            rate = hit / (hit + miss) if hit + miss else 0.0
+            return (f"响应缓存统计：命中{hit}次，未命中{miss}次，命中率{rate:.1%}，"
+                    f"写入{self.stats['write']}条，淘汰{self.stats['evict']}条（{self.path}）")
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+def add_cache_args(parser):
+    parser.add_argument("--cache_db", default=None,
+                        help="LLM响应缓存的SQLite文件路径，相同请求直接读缓存；不传则不启用")
+    parser.add_argument("--cache_max_mb", type=float, default=1024, help="响应缓存大小上限(MB)，超出按最近访问时间淘汰，0为不限")
+    parser.add_argument("--cache_max_age_days", type=float, default=0, help="响应缓存有效天数，0为永不过期")
+
+def open_cache(args):
+    """按命令行参数打开响应缓存，未指定--cache_db时返回None"""
+    if not getattr(args, "cache_db", None):
+        return None
+    cache = ResponseCache(args.cache_db, max_size_mb=args.cache_max_mb, max_age_days=args.cache_max_age_days)
+    logging.info(f"启用响应缓存：{args.cache_db}")
+    return cache
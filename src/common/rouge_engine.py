@@ -0,0 +1,75 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from rouge_score import rouge_scorer, tokenizers
+
+class PretokenizedTokenizer(tokenizers.Tokenizer):
+    """已分词（词干化）的token列表原样返回，其余文本交给rouge_score的默认分词器"""
+    def __init__(self, use_stemmer=True):
+        self.base = tokenizers.DefaultTokenizer(use_stemmer=use_stemmer)
+
+    def tokenize(self, text):
+        if isinstance(text, (list, tuple)):
+            return list(text)
+        return self.base.tokenize(text)
+
+# 进程池中每个worker各自构建一次scorer
+_worker_scorer = None
+
+def _init_worker(rouge_types, use_stemmer):
+    global _worker_scorer
+    _worker_scorer = rouge_scorer.RougeScorer(list(rouge_types), tokenizer=PretokenizedTokenizer(use_stemmer))
+
+def _score_chunk(chunk):
+    return [
+        {k: v.fmeasure for k, v in _worker_scorer.score(target, prediction).items()}
+        for target, prediction in chunk
+    ]
+
+class RougeEngine:
+    """
+    ROUGE计算引擎：scorer只构建一次，金标准句子的分词和词干化结果按文本缓存（多个模型共用同一批金标准），
+    预测句较多时按chunk_size分块交给进程池并行打分（workers为0或None时取CPU核数）；workers为1或条数不足一块时在本进程内计算。
+    结果与rouge_scorer.RougeScorer(rouge_types, use_stemmer).score(gold, pred)的fmeasure一致。
+    """
+    def __init__(self, rouge_types=("rouge1", "rouge2", "rougeL"), use_stemmer=True, workers=None, chunk_size=200):
+        self.rouge_types = tuple(rouge_types)
+        self.use_stemmer = use_stemmer
+        self.workers = workers if workers else (os.cpu_count() or 1)
+        self.chunk_size = chunk_size
+        self.tokenizer = PretokenizedTokenizer(use_stemmer)
+        self.scorer = rouge_scorer.RougeScorer(list(self.rouge_types), tokenizer=self.tokenizer)
+        self.gold_tokens = {}
+        self.pool = None
+
+    def _gold(self, text):
+        tokens = self.gold_tokens.get(text)
+        if tokens is None:
+            tokens = self.gold_tokens[text] = self.tokenizer.tokenize(text)
+        return tokens
+
+    def _pool(self):
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(
+                max_workers=self.workers, initializer=_init_worker, initargs=(self.rouge_types, self.use_stemmer)
+            )
+        return self.pool
+
+    def score_pairs(self, golds, preds):
+        """返回与输入等长的列表，每项为{rouge类型: fmeasure}"""
+        pairs = [(self._gold(g), p) for g, p in zip(golds, preds)]
+        if self.workers <= 1 or len(pairs) <= self.chunk_size:
+            return [
+                {k: v.fmeasure for k, v in self.scorer.score(target, prediction).items()}
+                for target, prediction in pairs
+            ]
+        chunks = [pairs[i:i + self.chunk_size] for i in range(0, len(pairs), self.chunk_size)]
+        results = []
+        for part in self._pool().map(_score_chunk, chunks):
+            results.extend(part)
+        return results
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
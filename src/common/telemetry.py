@@ -0,0 +1,94 @@
+import json
+import logging
+import os
+import threading
+import time
+
+def _usage_value(usage, *path):
+    """按路径取usage中的字段，兼容SDK对象和dict（如completion_tokens_details.reasoning_tokens）"""
+    value = usage
+    for key in path:
+        if value is None:
+            return None
+        value = value.get(key) if isinstance(value, dict) else getattr(value, key, None)
+    return value
+
+class Telemetry:
+    """
+    每次chat请求写一行遥测记录到旁路JSONL文件（线程安全，逐行flush）：
+    排队等待（共享限流器内的等待）、流式首token时间、请求耗时、prompt/completion/reasoning token数、
+    同一条目的第几次尝试、是否命中缓存以及错误类型。汇总见 src/benchmark/telemetry_summary.py。
+    """
+    def __init__(self, path, benchmark=None, stage=None):
+        self.path = path
+        self.benchmark = benchmark
+        self.stage = stage
+        self.lock = threading.Lock()
+        self.attempts = {}
+        self.count = 0
+        log_dir = os.path.dirname(path)
+        if log_dir:
+            os.makedirs(log_dir, exist_ok=True)
+        self.fout = open(path, "a", encoding="utf-8")
+
+    def record_call(self, kwargs, item, t0, timing, result=None, error=None, stream=False):
+        """t0为进入create_chat的时间，timing为_raw_chat记下的start/first_token时间点"""
+        end = time.time()
+        start = timing.get("start")
+        first_token = timing.get("first_token")
+        usage = result.usage if result is not None else None
+        record = {
+            "ts": round(t0, 3),
+            "benchmark": self.benchmark,
+            "stage": self.stage,
+            "model": kwargs.get("model"),
+            "item": item,
+            "attempt": None,
+            "status": "ok" if error is None else "error",
+            "cached": bool(result is not None and result.cached),
+            "stream": bool(stream),
+            "queue_wait_ms": round((start - t0) * 1000, 1) if start else None,
+            "ttft_ms": round((first_token - start) * 1000, 1) if start and first_token else None,
+            "latency_ms": round((end - start) * 1000, 1) if start else None,
+            "total_ms": round((end - t0) * 1000, 1),
+            "prompt_tokens": _usage_value(usage, "prompt_tokens"),
+            "completion_tokens": _usage_value(usage, "completion_tokens"),
+            "reasoning_tokens": (_usage_value(usage, "reasoning_tokens")
+                                 or _usage_value(usage, "completion_tokens_details", "reasoning_tokens")),
+            "total_tokens": _usage_value(usage, "total_tokens"),
+        }
+        if timing.get("hedged"):
+            record["hedged"] = True
+        if error is not None:
+            record["error_type"] = type(error).__name__
+            record["status_code"] = getattr(error, "status_code", None)
+            record["error"] = str(error)[:200]
+        with self.lock:
+            if item is not None:
+                self.attempts[item] = self.attempts.get(item, 0) + 1
+                record["attempt"] = self.attempts[item]
+            self.fout.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self.fout.flush()
+            self.count += 1
+
+    def close(self):
+        with self.lock:
+            if not self.fout.closed:
+                self.fout.close()
+        logging.info(f"请求遥测共{self.count}条，写入 {self.path}")
+
+def add_telemetry_args(parser):
+    parser.add_argument("--telemetry", nargs='?', const="auto", default=None,
+                        help="逐请求遥测（排队、首token、耗时、token数、重试次数）写入JSONL；"
+                             "只写参数名时为 <output>.telemetry.jsonl，不传则不记录")
+
+def open_telemetry(args, benchmark, stage):
+    """按命令行参数打开遥测文件，未指定--telemetry时返回None"""
+    path = getattr(args, "telemetry", None)
+    if not path:
+        return None
+    if path == "auto":
+        path = args.output + ".telemetry.jsonl"
+    telemetry = Telemetry(path, benchmark=benchmark, stage=stage)
+    logging.info(f"启用请求遥测：{path}")
+    return telemetry
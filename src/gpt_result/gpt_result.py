@@ -1,7 +1,12 @@
+import os
+import sys
 import argparse
 import json
 import re
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.manifest import save_inputs_manifest, skip_if_unchanged
+
 def extract_scores(answer_file):
     score_list = []
     with open(answer_file, "r", encoding="utf-8") as fin:
@@ -20,7 +25,12 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--test", required=True, help="待评价答案的jsonl文件名")
     parser.add_argument("--result", required=True, help="输出txt文件名")
+    parser.add_argument("--force", action="store_true", help="即使输入文件和上次相同也重新计算")
     args = parser.parse_args()
+    # 输入文件内容未变化时直接复用已有报告
+    config = {"stage": "gpt_result"}
+    if skip_if_unchanged(args.result, [args.test], config, args.force):
+        return
 
     score_list = extract_scores(args.test)
     lines = []
@@ -37,6 +47,7 @@ def main():
     with open(args.result, "w", encoding="utf-8") as fout:
         fout.write("\n".join(lines) + "\n")
     print("\n".join(lines))
+    save_inputs_manifest(args.result, [args.test], config)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,13 +1,23 @@
 import os
+import sys
 import json
 from openai import OpenAI
-from tqdm import tqdm
 import argparse
 import logging
 import re
-from concurrent.futures import ThreadPoolExecutor, as_completed
 import time
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.checkpoint import get_done_set, report_resume, compact_output
+from common.jsonl_tail import FollowedInput, add_follow_args
+from common.jsonl_writer import OrderedJsonlWriter
+from common.judge_batch import batch_system_prompt, is_valid_gpt_score, request_batch, run_judge_stream, run_judge_tasks
+from common.llm_call import create_chat
+from common.manifest import RecordManifest, record_hash, reuse_unchanged
+from common.response_cache import add_cache_args, open_cache
+from common.rate_limiter import add_limit_args, open_limiter
+from common.telemetry import add_telemetry_args, open_telemetry
+
 def extract_user_and_label(data_text):
     """
     从data字段中提取user prompt和金标准标签
@@ -31,13 +41,13 @@ def build_prompt(user_prompt, model_answer, gold_label):
         f"Please rate the answer and explain your score in JSON format as instructed."
     )
 
-def score_one(idx, user_prompt, model_answer, gold_label, system_prompt, client, model, max_retries=5):
+def score_one(idx, user_prompt, model_answer, gold_label, system_prompt, client, model, max_retries=5, cache=None, telemetry=None, limiter=None):
     user_prompt_full = build_prompt(user_prompt, model_answer, gold_label)
     wait_times = [5, 10, 15, 20, 25]  # 总共5次，第一次失败后5s，后面4次10s
     last_exception = None
     for attempt in range(max_retries):
         try:
-            completion = client.chat.completions.create(
+            kwargs = dict(
                 model=model,
                 messages=[
                     {"role": "system", "content": system_prompt},
@@ -45,11 +55,13 @@ def score_one(idx, user_prompt, model_answer, gold_label, system_prompt, client,
                 ],
                 response_format={"type": "json_object"},
             )
-            result = completion.choices[0].message.content
+            result = create_chat(client, kwargs, cache=cache, limiter=limiter, telemetry=telemetry, item=idx).content
             # 检查返回内容是否为合法JSON
             try:
                 json.loads(result)
             except Exception as e:
+                if cache is not None:
+                    cache.delete(kwargs)
                 logging.error(f"idx={idx} LLM输出不是合法JSON: {e}")
                 return {
                     "idx": idx,
@@ -91,6 +103,12 @@ def main():
     parser.add_argument("--api_key", default=os.getenv("DASHSCOPE_API_KEY"), help="API KEY")
     parser.add_argument("--base_url", default="https://dashscope.aliyuncs.com/compatible-mode/v1", help="API base url")
     parser.add_argument("--threads", type=int, default=4, help="并发线程数量")
+    parser.add_argument("--judge_batch_size", type=int, default=1,
+                        help="每次请求打包评分的条数，大于1时按idx返回results数组，缺失或不合法的条目逐条补请求")
+    add_cache_args(parser)
+    add_limit_args(parser)
+    add_telemetry_args(parser)
+    add_follow_args(parser, "答案")
     args = parser.parse_args()
 
     # 配置日志
@@ -101,6 +119,9 @@ def main():
         datefmt="%Y-%m-%d %H:%M:%S"
     )
     client = OpenAI(api_key=args.api_key, base_url=args.base_url)
+    cache = open_cache(args)
+    limiter = open_limiter(args, args.threads)
+    telemetry = open_telemetry(args, "biored", "gpt")
 
     # few-shot 示例，包含answer字段，但LLM只需输出score/reason/match
     example_5 = json.dumps({
@@ -169,51 +190,103 @@ Please only output the JSON object with the specified fields.
         benchmark_items = [json.loads(line) for line in fin if line.strip()]
     idx2benchmark = {item["idx"]: item for item in benchmark_items}
 
-    # 读取答案 jsonl
-    with open(args.answer, "r", encoding="utf-8") as fin:
-        answer_items = [json.loads(line) for line in fin if line.strip()]
-    idx2answer = {item["idx"]: item for item in answer_items}
+    config = {"stage": "biored_gpt", "model": args.model, "prompt": system_prompt}
 
-    # 构造所有任务
-    tasks = []
-    for cur_idx in sorted(idx2benchmark.keys()):
+    def build_task(cur_idx, answer_obj):
         benchmark_obj = idx2benchmark[cur_idx]
-        answer_obj = idx2answer.get(cur_idx, None)
         data_text = benchmark_obj.get("data", "")
         user_prompt, gold_label = extract_user_and_label(data_text)
         model_answer = answer_obj.get("llm_output", "").strip() if answer_obj else ""
-        tasks.append((cur_idx, user_prompt, model_answer, gold_label))
-
-    results = {}
-    with ThreadPoolExecutor(max_workers=args.threads) as executor:
-        future2idx = {
-            executor.submit(
-                score_one, idx, user_prompt, model_answer, gold_label, system_prompt,
-                client, args.model, 5
-            ): idx
-            for idx, user_prompt, model_answer, gold_label in tasks
-        }
-        for future in tqdm(as_completed(future2idx), total=len(future2idx), desc="Concurrent LLM scoring w/ retry"):
-            idx = future2idx[future]
-            try:
-                out = future.result()
-            except Exception as e:
-                out = {
-                    "idx": idx,
-                    "error": f"Threaded error: {e}",
-                    "gold_label": "",
-                    "model_answer": "",
-                    "retries": 5
-                }
-            results[idx] = out
-
-    # 按照输入顺序写出结果，保证idx一致性
-    with open(args.output, "w", encoding="utf-8") as fout:
-        for cur_idx in sorted(idx2benchmark.keys()):
-            out = results.get(cur_idx, {"idx": cur_idx, "error": "No result generated.", "retries": 5})
-            out["idx"] = cur_idx  # 显式确保idx一致性
-            fout.write(json.dumps(out, ensure_ascii=False) + "\n")
-            fout.flush()
+        return (cur_idx, user_prompt, model_answer, gold_label)
+
+    def input_hash(cur_idx, answer_obj):
+        """按评分输入（模型答案和金标准）计算内容哈希，不在benchmark中的答案忽略"""
+        if cur_idx not in idx2benchmark:
+            return None
+        return record_hash(build_task(cur_idx, answer_obj)[1:])
+
+    batch_system_prompt_text = batch_system_prompt(
+        system_prompt, '{ "idx": 0, "score": 5, "reason": "...", "match": true }'
+    )
+
+    def score_single(idx, user_prompt, model_answer, gold_label):
+        return score_one(idx, user_prompt, model_answer, gold_label, system_prompt, client, args.model, 5, cache, telemetry, limiter)
+
+    def score_group(group):
+        entries = [
+            (idx, build_prompt(user_prompt, model_answer, gold_label))
+            for idx, user_prompt, model_answer, gold_label in group
+        ]
+        results = request_batch(
+            client, args.model, batch_system_prompt_text, entries, is_valid_gpt_score,
+            5, cache, telemetry=telemetry, limiter=limiter, label=f"idx={group[0][0]}~{group[-1][0]} 批量"
+        )
+        outs = []
+        for idx, user_prompt, model_answer, gold_label in group:
+            entry = results.get(idx)
+            if entry is None:
+                logging.warning(f"idx={idx} 批量结果缺失或不合法，改为单条请求")
+                outs.append(score_single(idx, user_prompt, model_answer, gold_label))
+                continue
+            score_json = {"score": entry["score"], "reason": entry["reason"], "match": entry["match"]}
+            outs.append({
+                "idx": idx,
+                "gptscore_json": json.dumps(score_json, ensure_ascii=False),
+                "gold_label": gold_label,
+                "model_answer": model_answer,
+                "retries": 1,
+                "judge_batch": len(group)
+            })
+        return outs
+
+    # 断点续跑：跳过已成功评分的idx，带error的记录会重新请求
+    done_set = get_done_set(args.output)
+    if args.follow:
+        # 流水线模式：答案边生成边评分，上游写出完成标记后，没有答案的benchmark条目按空答案评分
+        source = FollowedInput(
+            args.answer, args.output, done_set, RecordManifest(args.output, config), build_task, input_hash,
+            remaining=lambda seen: ((cur_idx, None) for cur_idx in sorted(idx2benchmark) if cur_idx not in seen),
+            idle_timeout=args.follow_timeout or None
+        )
+        with OrderedJsonlWriter(args.output, [], mode="a") as writer:
+            run_judge_stream(
+                source.tasks(writer), writer, args.threads, score_single, score_group,
+                batch_size=args.judge_batch_size, desc="Concurrent LLM scoring w/ retry",
+                error_fields={"gold_label": "", "model_answer": "", "retries": 5}
+            )
+        source.finish()
+    else:
+        # 读取答案 jsonl
+        with open(args.answer, "r", encoding="utf-8") as fin:
+            answer_items = [json.loads(line) for line in fin if line.strip()]
+        idx2answer = {item["idx"]: item for item in answer_items}
+
+        # 构造所有任务
+        tasks = [build_task(cur_idx, idx2answer.get(cur_idx)) for cur_idx in sorted(idx2benchmark.keys())]
+
+        # 增量重算：按每条评分输入（模型答案和金标准）的内容哈希比对manifest，只重算变化的条目
+        input_hashes = {task[0]: record_hash(task[1:]) for task in tasks}
+        done_set = reuse_unchanged(args.output, done_set, input_hashes, config)
+        report_resume(args.output, done_set)
+        tasks = [task for task in tasks if task[0] not in done_set]
+        expected = [task[0] for task in tasks]
+
+        with OrderedJsonlWriter(args.output, expected, mode="a") as writer:
+            run_judge_tasks(
+                tasks, writer, args.threads, score_single, score_group,
+                batch_size=args.judge_batch_size, desc="Concurrent LLM scoring w/ retry",
+                error_fields={"gold_label": "", "model_answer": "", "retries": 5}
+            )
+
+        # 按idx整理输出文件（同一idx只留一条），保证idx一致性
+        compact_output(args.output)
+    if limiter is not None:
+        logging.info(limiter.summary())
+    if cache is not None:
+        logging.info(cache.summary())
+        cache.close()
+    if telemetry is not None:
+        telemetry.close()
     logging.info(f"全部评分处理完成，结果保存在 {args.output}")
 
 if __name__ == "__main__":
@@ -1,4 +1,5 @@
 import os
+import sys
 import json
 import re
 from tqdm import tqdm
@@ -7,6 +8,12 @@ import logging
 import torch
 from transformers import AutoTokenizer, AutoModelForCausalLM
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.local_batch import build_prompt, local_generate_batch, count_tokens, split_prompt_prefix, PrefixCache
+from common.batching import plan_token_batches
+from common.checkpoint import get_done_set, report_resume, compact_output, trim_partial_line
+from common.jsonl_tail import clear_done, mark_done
+
 def clean_context(text, supporting_sentences=None):
     text = re.sub(r"<answer>.*?<context>", "", text, flags=re.DOTALL)
     text = re.sub(r"<answer>.*?(\n|$)", "", text, flags=re.DOTALL)
@@ -37,6 +44,19 @@ def system_prompt_round2():
         "Supporting sentence: In these conditions, JTV519 (K201), a 1,4-benzothiazepine derivative and multi-channel blocker, stabilizes RyR2s and decrease SR Ca²⁺ leak.\n"
     )
 
+def shared_context_prompt(context, question):
+    """共享上下文模式下放在最前面、两轮共用的system内容：两轮的few-shot示例和本条Context/Question都在这里，只编码一次"""
+    return system_prompt_round1() + system_prompt_round2() + f"Context: {context}\nQuestion: {question}"
+
+def shared_user_prompt_round1():
+    return "Please answer the question in the context above directly and concisely, as in the first example."
+
+def shared_user_prompt_round2(answer1):
+    return (
+        f"Answer: {answer1}\n"
+        "Please quote the supporting sentence from the context above, as in the second example."
+    )
+
 def load_items(input_file):
     with open(input_file, "r", encoding="utf-8") as f:
         first = f.read(1)
@@ -58,44 +78,15 @@ def resolve_device(device_str):
         print(f"Warning: Requested device '{device_str}' not available. Falling back to CPU.")
         return "cpu"
 
-def extract_assistant_response(result):
-    """
-    用正则从输出中提取assistant后的内容，去掉冗余的system/user段。
-    支持常见三种格式（assistant、ASSISTANT、<|im_start|>assistant）。
-    若未命中，则返回原文。
-    """
-    match = re.search(r"(?:^|\n)assistant\s*\n(.*)", result, re.DOTALL | re.IGNORECASE)
-    if match:
-        return match.group(1).strip()
-    match = re.search(r"<\|im_start\|>assistant\s*(.*?)<\|im_end\|>", result, re.DOTALL | re.IGNORECASE)
-    if match:
-        return match.group(1).strip()
-    return result.strip()
-
 def remove_think_tags(text):
     # 支持多组<think>...</think>，并允许换行
     return re.sub(r"<think>\s*?</think>\s*", "", text, flags=re.DOTALL)
 
 def local_generate(model, tokenizer, system_prompt, user_prompt, max_new_tokens=4096, device="cpu", enable_thinking=None, use_qwen_template=False, stream=False):
-    # Qwen/chat模板兼容
-    if use_qwen_template and hasattr(tokenizer, "apply_chat_template"):
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt}
-        ]
-        chat_template_kwargs = dict(
-            conversation=messages,
-            tokenize=False,
-            add_generation_prompt=True
-        )
-        if enable_thinking is not None:
-            chat_template_kwargs["enable_thinking"] = enable_thinking
-        prompt = tokenizer.apply_chat_template(**chat_template_kwargs)
-    else:
-        prompt = system_prompt + "\n" + user_prompt
+    prompt = build_prompt(tokenizer, system_prompt, user_prompt, enable_thinking, use_qwen_template)
 
-    inputs = tokenizer(prompt, return_tensors="pt").to(device)
     if stream and hasattr(model, "generate") and "stream" in model.generate.__code__.co_varnames:
+        inputs = tokenizer(prompt, return_tensors="pt").to(device)
         # Qwen系列和transformers>=4.38支持流式输出（假设stream参数）
         output_text = ""
         with torch.no_grad():
@@ -109,33 +100,9 @@ def local_generate(model, tokenizer, system_prompt, user_prompt, max_new_tokens=
                 output_text += tokenizer.decode(outputs[0][-1:], skip_special_tokens=True)
         result = output_text
     else:
-        with torch.no_grad():
-            outputs = model.generate(
-                **inputs,
-                max_new_tokens=max_new_tokens,
-                do_sample=False,
-                pad_token_id=tokenizer.eos_token_id
-            )
-        result = tokenizer.decode(outputs[0], skip_special_tokens=True)
-    assistant_result = extract_assistant_response(result)
-    assistant_result = remove_think_tags(assistant_result)
-    return assistant_result
-
-def get_done_set(output_path):
-    done_set = set()
-    if not os.path.exists(output_path):
-        return done_set
-    with open(output_path, "r", encoding="utf-8") as f:
-        for line in f:
-            if not line.strip():
-                continue
-            try:
-                obj = json.loads(line)
-                if "idx" in obj:
-                    done_set.add(obj["idx"])
-            except Exception:
-                continue
-    return done_set
+        # 与批量路径一致：只解码新生成的token，不依赖chat模板中的assistant标记截取回答
+        result = local_generate_batch(model, tokenizer, [prompt], max_new_tokens=max_new_tokens, device=device)[0]
+    return remove_think_tags(result).strip()
 
 def str2bool_or_none(v):
     if v is None:
@@ -161,6 +128,11 @@ def main():
     parser.add_argument("--enable_thinking_round1", nargs='?', const=False, default=None, help="第一轮enable_thinking，True/False，不传则None，只写参数名为False")
     parser.add_argument("--enable_thinking_round2", nargs='?', const=False, default=None, help="第二轮enable_thinking，True/False，不传则None，只写参数名为False")
     parser.add_argument("--stream", action="store_true", help="强制流式解码（如模型支持），否则仅在enable_thinking为True时自动流式")
+    parser.add_argument("--batch_size", type=int, default=1, help="每次generate的样本数，大于1时左padding批量推理（批量模式不走流式）")
+    parser.add_argument("--max_batch_tokens", type=int, default=0,
+                        help="批量模式下每批padding后的prompt token上限，0为不限；样本按长度分桶后组批")
+    parser.add_argument("--share_context", action="store_true",
+                        help="两轮共用上下文KV cache：few-shot示例和Context/Question前置只编码一次，第二轮只追加第一轮答案和指令（逐条模式，忽略batch_size）")
     args = parser.parse_args()
 
     args.enable_thinking_round1 = str2bool_or_none(args.enable_thinking_round1)
@@ -178,7 +150,9 @@ def main():
 
     items = load_items(args.input)
     done_set = get_done_set(args.output)
-    print(f"检测到已完成 {len(done_set)} 条，将跳过这些样本...")
+    report_resume(args.output, done_set)
+    # 跟随读取的下游（--follow）以完成标记判断结束，开始写之前先清掉上次的标记
+    clear_done(args.output)
 
     tokenizer = AutoTokenizer.from_pretrained(args.model_dir)
     model = AutoModelForCausalLM.from_pretrained(args.model_dir)
@@ -190,74 +164,186 @@ def main():
     model_type = getattr(model.config, "model_type", "").lower()
     use_qwen_template = "qwen" in model_type
 
+    tasks = []
+    for obj in items:
+        if "idx" not in obj:
+            msg = "原始数据缺少idx字段，跳过。"
+            logging.warning(msg)
+            continue
+        out_idx = obj["idx"]
+        if out_idx in done_set:
+            continue
+        question = obj.get("question", "")
+        raw_context = obj.get("text", "")
+        supporting_sentences = obj.get("supporting_sentences", [])
+        context = clean_context(raw_context, supporting_sentences=supporting_sentences)
+        tasks.append((out_idx, question, context))
+
+    def write_result(fout, out_idx, user_prompt1, user_prompt2, answer1, answer2,
+                     system_round1=None, system_round2=None):
+        llm_output = (
+            f"Answer to Question 1: {answer1}\n"
+            f"Answer to Question 2 (Supporting sentence): {answer2}"
+        )
+        out = {
+            "idx": out_idx,
+            "system_round1": system_round1 if system_round1 is not None else system_prompt_round1(),
+            "user_round1": user_prompt1,
+            "system_round2": system_round2 if system_round2 is not None else system_prompt_round2(),
+            "user_round2": user_prompt2,
+            "llm_output": llm_output
+        }
+        fout.write(json.dumps(out, ensure_ascii=False) + "\n")
+        fout.flush()
+
+    if args.share_context and args.batch_size > 1:
+        logging.warning("share_context模式逐条生成，忽略batch_size。")
+
+    trim_partial_line(args.output)
     with open(args.output, "a", encoding="utf-8") as fout:
-        for idx, obj in enumerate(tqdm(items, desc="本地模型推理中")):
-            if "idx" not in obj:
-                msg = "原始数据缺少idx字段，跳过。"
-                logging.warning(msg)
-                continue
-            out_idx = obj["idx"]
-            if out_idx in done_set:
-                continue
-            question = obj.get("question", "")
-            raw_context = obj.get("text", "")
-            supporting_sentences = obj.get("supporting_sentences", [])
-            context = clean_context(raw_context, supporting_sentences=supporting_sentences)
-
-            # 第一轮
-            user_prompt1 = f"Context: {context}\nQuestion: {question}\nPlease answer the question directly and concisely."
-            try:
-                answer1 = local_generate(
-                    model, tokenizer,
-                    system_prompt_round1(), user_prompt1,
-                    max_new_tokens=args.max_new_tokens, device=device,
-                    enable_thinking=args.enable_thinking_round1,
-                    use_qwen_template=use_qwen_template,
-                    stream=args.stream or (args.enable_thinking_round1 is True)
-                )
-                answer1 = answer1.strip()
-                logging.info(f"第{out_idx}条Q1本地模型生成成功。")
-            except Exception as e:
-                errmsg = f"第{out_idx}条Q1本地模型推理出错：{e}"
-                print(errmsg)
-                logging.error(errmsg)
-                continue
-
-            # 第二轮
-            user_prompt2 = f"Context: {context}\nQuestion: {question}\nAnswer: {answer1}\nPlease quote the supporting sentence from the context."
-            try:
-                answer2 = local_generate(
-                    model, tokenizer,
-                    system_prompt_round2(), user_prompt2,
-                    max_new_tokens=args.max_new_tokens, device=device,
-                    enable_thinking=args.enable_thinking_round2,
-                    use_qwen_template=use_qwen_template,
-                    stream=args.stream or (args.enable_thinking_round2 is True)
-                )
-                answer2 = answer2.strip()
-                logging.info(f"第{out_idx}条Q2本地模型生成成功。")
-            except Exception as e:
-                errmsg = f"第{out_idx}条Q2本地模型推理出错：{e}"
-                print(errmsg)
-                logging.error(errmsg)
-                continue
-
-            llm_output = (
-                f"Answer to Question 1: {answer1}\n"
-                f"Answer to Question 2 (Supporting sentence): {answer2}"
-            )
-
-            out = {
-                "idx": out_idx,
-                "system_round1": system_prompt_round1(),
-                "user_round1": user_prompt1,
-                "system_round2": system_prompt_round2(),
-                "user_round2": user_prompt2,
-                "llm_output": llm_output
-            }
-            fout.write(json.dumps(out, ensure_ascii=False) + "\n")
-            fout.flush()
+        if args.share_context:
+            # 每条样本的上下文不同，只保留当前样本的一份cache
+            prefix_cache = PrefixCache(model, tokenizer, device=device, max_entries=1)
+            for out_idx, question, context in tqdm(tasks, desc="本地模型推理中(共享上下文)"):
+                shared_system = shared_context_prompt(context, question)
+                user_prompt1 = shared_user_prompt_round1()
+                try:
+                    prefix1, prompt1 = split_prompt_prefix(
+                        tokenizer, shared_system, user_prompt1,
+                        args.enable_thinking_round1, use_qwen_template
+                    )
+                    answer1 = prefix_cache.generate(prefix1, prompt1, max_new_tokens=args.max_new_tokens)
+                    answer1 = remove_think_tags(answer1).strip()
+                    logging.info(f"第{out_idx}条Q1本地模型生成成功。")
+                except Exception as e:
+                    errmsg = f"第{out_idx}条Q1本地模型推理出错：{e}"
+                    print(errmsg)
+                    logging.error(errmsg)
+                    continue
+
+                user_prompt2 = shared_user_prompt_round2(answer1)
+                try:
+                    # 前缀与第一轮相同，直接命中上面的cache
+                    prefix2, prompt2 = split_prompt_prefix(
+                        tokenizer, shared_system, user_prompt2,
+                        args.enable_thinking_round2, use_qwen_template
+                    )
+                    answer2 = prefix_cache.generate(prefix2, prompt2, max_new_tokens=args.max_new_tokens)
+                    answer2 = remove_think_tags(answer2).strip()
+                    logging.info(f"第{out_idx}条Q2本地模型生成成功。")
+                except Exception as e:
+                    errmsg = f"第{out_idx}条Q2本地模型推理出错：{e}"
+                    print(errmsg)
+                    logging.error(errmsg)
+                    continue
+
+                write_result(fout, out_idx, user_prompt1, user_prompt2, answer1, answer2,
+                             system_round1=shared_system, system_round2=shared_system)
+        elif args.batch_size <= 1:
+            for out_idx, question, context in tqdm(tasks, desc="本地模型推理中"):
+                # 第一轮
+                user_prompt1 = f"Context: {context}\nQuestion: {question}\nPlease answer the question directly and concisely."
+                try:
+                    answer1 = local_generate(
+                        model, tokenizer,
+                        system_prompt_round1(), user_prompt1,
+                        max_new_tokens=args.max_new_tokens, device=device,
+                        enable_thinking=args.enable_thinking_round1,
+                        use_qwen_template=use_qwen_template,
+                        stream=args.stream or (args.enable_thinking_round1 is True)
+                    )
+                    answer1 = answer1.strip()
+                    logging.info(f"第{out_idx}条Q1本地模型生成成功。")
+                except Exception as e:
+                    errmsg = f"第{out_idx}条Q1本地模型推理出错：{e}"
+                    print(errmsg)
+                    logging.error(errmsg)
+                    continue
+
+                # 第二轮
+                user_prompt2 = f"Context: {context}\nQuestion: {question}\nAnswer: {answer1}\nPlease quote the supporting sentence from the context."
+                try:
+                    answer2 = local_generate(
+                        model, tokenizer,
+                        system_prompt_round2(), user_prompt2,
+                        max_new_tokens=args.max_new_tokens, device=device,
+                        enable_thinking=args.enable_thinking_round2,
+                        use_qwen_template=use_qwen_template,
+                        stream=args.stream or (args.enable_thinking_round2 is True)
+                    )
+                    answer2 = answer2.strip()
+                    logging.info(f"第{out_idx}条Q2本地模型生成成功。")
+                except Exception as e:
+                    errmsg = f"第{out_idx}条Q2本地模型推理出错：{e}"
+                    print(errmsg)
+                    logging.error(errmsg)
+                    continue
+
+                write_result(fout, out_idx, user_prompt1, user_prompt2, answer1, answer2)
+        else:
+            # 按第一轮prompt长度分桶组批（两轮prompt长度高度相关），结果按idx写回
+            all_user_prompts1 = [
+                f"Context: {context}\nQuestion: {question}\nPlease answer the question directly and concisely."
+                for _, question, context in tasks
+            ]
+            all_prompts1 = [
+                build_prompt(tokenizer, system_prompt_round1(), u, args.enable_thinking_round1, use_qwen_template)
+                for u in all_user_prompts1
+            ]
+            lengths = count_tokens(tokenizer, all_prompts1)
+            plan = plan_token_batches(lengths, args.batch_size, args.max_batch_tokens)
+            logging.info(f"共{len(tasks)}条，按长度分为{len(plan)}批。")
+            pbar = tqdm(total=len(tasks), desc="本地模型批量推理中")
+            for batch_ids in plan:
+                batch = [tasks[i] for i in batch_ids]
+                # 第一轮：整批一起生成答案
+                user_prompts1 = [all_user_prompts1[i] for i in batch_ids]
+                prompts1 = [all_prompts1[i] for i in batch_ids]
+                try:
+                    answers1 = local_generate_batch(
+                        model, tokenizer, prompts1,
+                        max_new_tokens=args.max_new_tokens, device=device
+                    )
+                    answers1 = [remove_think_tags(a).strip() for a in answers1]
+                except Exception as e:
+                    for out_idx, _, _ in batch:
+                        errmsg = f"第{out_idx}条Q1本地模型批量推理出错：{e}"
+                        print(errmsg)
+                        logging.error(errmsg)
+                    pbar.update(len(batch))
+                    continue
+
+                # 第二轮：带上第一轮答案，整批生成支持句
+                user_prompts2 = [
+                    f"Context: {context}\nQuestion: {question}\nAnswer: {answer1}\nPlease quote the supporting sentence from the context."
+                    for (_, question, context), answer1 in zip(batch, answers1)
+                ]
+                prompts2 = [
+                    build_prompt(tokenizer, system_prompt_round2(), u, args.enable_thinking_round2, use_qwen_template)
+                    for u in user_prompts2
+                ]
+                try:
+                    answers2 = local_generate_batch(
+                        model, tokenizer, prompts2,
+                        max_new_tokens=args.max_new_tokens, device=device
+                    )
+                    answers2 = [remove_think_tags(a).strip() for a in answers2]
+                except Exception as e:
+                    for out_idx, _, _ in batch:
+                        errmsg = f"第{out_idx}条Q2本地模型批量推理出错：{e}"
+                        print(errmsg)
+                        logging.error(errmsg)
+                    pbar.update(len(batch))
+                    continue
+
+                for i, (out_idx, _, _) in enumerate(batch):
+                    logging.info(f"第{out_idx}条Q1/Q2本地模型批量生成成功。")
+                    write_result(fout, out_idx, user_prompts1[i], user_prompts2[i], answers1[i], answers2[i])
+                pbar.update(len(batch))
+            pbar.close()
 
+    compact_output(args.output)
+    mark_done(args.output)
     logging.info(f"全部处理完成，结果保存在 {args.output}")
 
 if __name__ == "__main__":
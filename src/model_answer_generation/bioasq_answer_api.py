@@ -1,13 +1,25 @@
 import os
+import sys
 import json
 import re
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
 from tqdm import tqdm
 import argparse
 import logging
 from concurrent.futures import ThreadPoolExecutor, as_completed
 import time
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.async_engine import run_async, retry_async
+from common.rate_limiter import AdaptiveRateLimiter, is_rate_limit_error
+from common.jsonl_writer import OrderedJsonlWriter
+from common.checkpoint import get_done_set, report_resume, compact_output, trim_partial_line
+from common.jsonl_tail import clear_done, mark_done
+from common.llm_call import create_chat, create_chat_async
+from common.hedging import add_hedge_args, open_hedger
+from common.response_cache import add_cache_args, open_cache
+from common.telemetry import add_telemetry_args, open_telemetry
+
 def clean_context(text, supporting_sentences=None):
     text = re.sub(r"<answer>.*?<context>", "", text, flags=re.DOTALL)
     text = re.sub(r"<answer>.*?(\n|$)", "", text, flags=re.DOTALL)
@@ -47,22 +59,6 @@ def load_items(input_file):
         else:
             return [json.loads(line) for line in f if line.strip()]
 
-def get_done_set(output_path):
-    done_set = set()
-    if not os.path.exists(output_path):
-        return done_set
-    with open(output_path, "r", encoding="utf-8") as f:
-        for line in f:
-            if not line.strip():
-                continue
-            try:
-                obj = json.loads(line)
-                if "idx" in obj:
-                    done_set.add(obj["idx"])
-            except Exception:
-                continue
-    return done_set
-
 def str2bool_or_none(v):
     if v is None:
         return None
@@ -75,26 +71,14 @@ def str2bool_or_none(v):
         return False
     return None
 
-def chat_completion_with_stream(client, **kwargs):
-    """
-    调用流式接口，返回完整内容
-    """
-    stream_options = kwargs.pop("stream_options", None)
-    # Qwen平台建议加上if chunk.choices判断
-    completion = client.chat.completions.create(stream=True, **kwargs)
-    full_content = ""
-    for chunk in completion:
-        if hasattr(chunk, "choices") and chunk.choices:
-            delta = chunk.choices[0].delta
-            if hasattr(delta, "content") and delta.content:
-                full_content += delta.content
-    return full_content
-
-def chat_completion_with_sync(client, **kwargs):
-    completion = client.chat.completions.create(**kwargs)
-    return completion.choices[0].message.content.strip()
-
-def process_item(idx, obj, args, client):
+def build_round_kwargs(args, messages, enable_thinking):
+    """返回(请求参数, 是否流式)：显式开启thinking时走流式"""
+    kwargs = dict(model=args.model, messages=messages)
+    if enable_thinking is not None:
+        kwargs["extra_body"] = {"enable_thinking": enable_thinking}
+    return kwargs, bool(enable_thinking)
+
+def process_item(idx, obj, args, client, limiter=None, cache=None, telemetry=None, hedger=None):
     max_retries = args.max_retries
     retry_base_wait = args.retry_base_wait
 
@@ -118,28 +102,30 @@ def process_item(idx, obj, args, client):
     )
     messages1.append({"role": "user", "content": user_prompt1})
 
+    last_error = None
     for attempt in range(max_retries):
         try:
-            kwargs = dict(model=args.model, messages=messages1)
-            # 判断是否需要流式
-            if args.enable_thinking_round1 is not None:
-                kwargs["extra_body"] = {"enable_thinking": args.enable_thinking_round1}
-                if args.enable_thinking_round1:
-                    answer1 = chat_completion_with_stream(client, **kwargs)
-                else:
-                    answer1 = chat_completion_with_sync(client, **kwargs)
-            else:
-                answer1 = chat_completion_with_sync(client, **kwargs)
+            # 开启thinking时走流式
+            kwargs, use_stream = build_round_kwargs(args, messages1, args.enable_thinking_round1)
+            answer1 = create_chat(client, kwargs, stream=use_stream, cache=cache, limiter=limiter,
+                                  hedger=hedger, telemetry=telemetry, item=f"{out_idx}:Q1").content
             answer1 = answer1.strip()
             break
         except Exception as e:
+            last_error = e
+            if limiter is not None and is_rate_limit_error(e):
+                # 429由共享限流器统一暂停并降并发，这里不再各自睡眠
+                errmsg = f"第{out_idx}条(Q1)请求被限流(429)：{e}，第{attempt + 1}次重试，由共享限流器统一等待..."
+                print(errmsg)
+                logging.warning(errmsg)
+                continue
             wait_time = retry_base_wait * (2 ** attempt)
             errmsg = f"第{out_idx}条(Q1)请求出错：{e}，第{attempt + 1}次重试，等待{wait_time:.1f}秒..."
             print(errmsg)
             logging.warning(errmsg)
             time.sleep(wait_time)
     else:
-        errmsg = f"第{out_idx}条(Q1)请求连续{max_retries}次失败，已跳过。最后错误：{e}"
+        errmsg = f"第{out_idx}条(Q1)请求连续{max_retries}次失败，已跳过。最后错误：{last_error}"
         print(errmsg)
         logging.error(errmsg)
         return {"idx": out_idx, "error": errmsg}
@@ -156,25 +142,100 @@ def process_item(idx, obj, args, client):
 
     for attempt in range(max_retries):
         try:
-            kwargs = dict(model=args.model, messages=messages2)
-            if args.enable_thinking_round2 is not None:
-                kwargs["extra_body"] = {"enable_thinking": args.enable_thinking_round2}
-                if args.enable_thinking_round2:
-                    answer2 = chat_completion_with_stream(client, **kwargs)
-                else:
-                    answer2 = chat_completion_with_sync(client, **kwargs)
-            else:
-                answer2 = chat_completion_with_sync(client, **kwargs)
+            # 开启thinking时走流式
+            kwargs, use_stream = build_round_kwargs(args, messages2, args.enable_thinking_round2)
+            answer2 = create_chat(client, kwargs, stream=use_stream, cache=cache, limiter=limiter,
+                                  hedger=hedger, telemetry=telemetry, item=f"{out_idx}:Q2").content
             answer2 = answer2.strip()
             break
         except Exception as e:
+            last_error = e
+            if limiter is not None and is_rate_limit_error(e):
+                # 429由共享限流器统一暂停并降并发，这里不再各自睡眠
+                errmsg = f"第{out_idx}条(Q2)请求被限流(429)：{e}，第{attempt + 1}次重试，由共享限流器统一等待..."
+                print(errmsg)
+                logging.warning(errmsg)
+                continue
             wait_time = retry_base_wait * (2 ** attempt)
             errmsg = f"第{out_idx}条(Q2)请求出错：{e}，第{attempt + 1}次重试，等待{wait_time:.1f}秒..."
             print(errmsg)
             logging.warning(errmsg)
             time.sleep(wait_time)
     else:
-        errmsg = f"第{out_idx}条(Q2)请求连续{max_retries}次失败，已跳过。最后错误：{e}"
+        errmsg = f"第{out_idx}条(Q2)请求连续{max_retries}次失败，已跳过。最后错误：{last_error}"
+        print(errmsg)
+        logging.error(errmsg)
+        return {"idx": out_idx, "error": errmsg}
+
+    llm_output = (
+        f"Answer to Question 1: {answer1}\n"
+        f"Answer to Question 2 (Supporting sentence): {answer2}"
+    )
+
+    logging.info(f"第{out_idx}条成功生成。")
+    return {
+        "idx": out_idx,
+        "system_round1": system_prompt_round1(),
+        "user_round1": user_prompt1,
+        "system_round2": system_prompt_round2(),
+        "user_round2": user_prompt2,
+        "llm_output": llm_output
+    }
+
+async def process_item_async(obj, args, client, limiter=None, cache=None, telemetry=None, hedger=None):
+    if "idx" not in obj:
+        msg = "原始数据缺少idx字段，跳过。"
+        logging.warning(msg)
+        return {"error": msg}
+
+    out_idx = obj["idx"]
+    question = obj.get("question", "")
+    raw_context = obj.get("text", "")
+    supporting_sentences = obj.get("supporting_sentences", [])
+    context = clean_context(raw_context, supporting_sentences=supporting_sentences)
+
+    async def ask(messages, enable_thinking, label):
+        kwargs, use_stream = build_round_kwargs(args, messages, enable_thinking)
+        result = await retry_async(
+            lambda: create_chat_async(client, kwargs, stream=use_stream, cache=cache, limiter=limiter,
+                                      hedger=hedger, telemetry=telemetry, item=f"{out_idx}:{label}"),
+            args.max_retries, args.retry_base_wait, f"第{out_idx}条({label})", limiter=limiter
+        )
+        return result.content.strip()
+
+    # 第一轮
+    user_prompt1 = (
+        f"Context: {context}\n"
+        f"Question: {question}\n"
+        "Please answer the question directly and concisely."
+    )
+    messages1 = [
+        {"role": "system", "content": system_prompt_round1()},
+        {"role": "user", "content": user_prompt1},
+    ]
+    try:
+        answer1 = await ask(messages1, args.enable_thinking_round1, "Q1")
+    except Exception as e:
+        errmsg = f"第{out_idx}条(Q1)请求连续{args.max_retries}次失败，已跳过。最后错误：{e}"
+        print(errmsg)
+        logging.error(errmsg)
+        return {"idx": out_idx, "error": errmsg}
+
+    # 第二轮
+    user_prompt2 = (
+        f"Context: {context}\n"
+        f"Question: {question}\n"
+        f"Answer: {answer1}\n"
+        "Please quote the supporting sentence from the context."
+    )
+    messages2 = [
+        {"role": "system", "content": system_prompt_round2()},
+        {"role": "user", "content": user_prompt2},
+    ]
+    try:
+        answer2 = await ask(messages2, args.enable_thinking_round2, "Q2")
+    except Exception as e:
+        errmsg = f"第{out_idx}条(Q2)请求连续{args.max_retries}次失败，已跳过。最后错误：{e}"
         print(errmsg)
         logging.error(errmsg)
         return {"idx": out_idx, "error": errmsg}
@@ -207,6 +268,15 @@ def main():
     parser.add_argument("--retry_base_wait", type=float, default=20, help="429出错后等待的基础秒数，指数退避")
     parser.add_argument("--enable_thinking_round1", nargs='?', const=False, default=None, help="第一轮enable_thinking，True/False，不传则None，只写参数名为False")
     parser.add_argument("--enable_thinking_round2", nargs='?', const=False, default=None, help="第二轮enable_thinking，True/False，不传则None，只写参数名为False")
+    parser.add_argument("--async_mode", action="store_true", help="使用AsyncOpenAI异步引擎，单进程内并发，重试等待不占线程")
+    parser.add_argument("--max_in_flight", type=int, default=64, help="异步模式下同时在途的最大请求数（按样本计）")
+    parser.add_argument("--adaptive_limit", action="store_true",
+                        help="启用共享自适应限流器：成功时加性增大并发，429时乘性减小并按Retry-After全局暂停")
+    parser.add_argument("--max_rps", type=float, default=0, help="自适应限流器的每秒请求数上限，0为不限")
+    parser.add_argument("--max_tpm", type=int, default=0, help="自适应限流器的每分钟token数上限，0为不限")
+    add_cache_args(parser)
+    add_telemetry_args(parser)
+    add_hedge_args(parser)
     args = parser.parse_args()
 
     # 转换字符串为布尔值或None
@@ -221,40 +291,78 @@ def main():
     )
 
     client = OpenAI(api_key=args.api_key, base_url=args.base_url)
+    limiter = None
+    if args.adaptive_limit:
+        limiter = AdaptiveRateLimiter(
+            max_concurrency=args.max_in_flight if args.async_mode else args.threads,
+            max_rps=args.max_rps,
+            max_tpm=args.max_tpm
+        )
+    cache = open_cache(args)
+    hedger = open_hedger(args)
+    telemetry = open_telemetry(args, "bioasq", "answer")
     items = load_items(args.input)
 
     # 断点续跑：统计已完成idx
     done_set = get_done_set(args.output)
-    print(f"检测到已完成 {len(done_set)} 条，将跳过这些样本...")
+    report_resume(args.output, done_set)
+    # 跟随读取的下游（--follow）以完成标记判断结束，开始写之前先清掉上次的标记
+    clear_done(args.output)
+
+    if args.async_mode:
+        async_client = AsyncOpenAI(api_key=args.api_key, base_url=args.base_url)
+        to_process = [obj for obj in items if obj.get("idx") not in done_set]
+        expected = [obj["idx"] for obj in to_process if "idx" in obj]
+
+        with OrderedJsonlWriter(args.output, expected, mode="a") as writer:  # 追加模式
+            def collect(out):
+                if out is not None and "idx" in out:
+                    writer.write(out)
+
+            run_async(
+                to_process,
+                lambda obj: process_item_async(obj, args, async_client, limiter, cache, telemetry, hedger),
+                max_in_flight=args.max_in_flight,
+                on_result=collect
+            )
+        logging.info(f"全部处理完成(异步)，结果保存在 {args.output}")
 
-    if args.threads == 1:
+    elif args.threads == 1:
+        trim_partial_line(args.output)
         with open(args.output, "a", encoding="utf-8") as fout:  # 追加模式
             for idx, obj in enumerate(tqdm(items, desc="LLM生成中")):
                 if obj.get("idx") in done_set:
                     continue
-                out = process_item(idx, obj, args, client)
+                out = process_item(idx, obj, args, client, limiter, cache, telemetry, hedger)
                 fout.write(json.dumps(out, ensure_ascii=False) + "\n")
                 fout.flush()
         logging.info(f"全部处理完成，结果保存在 {args.output}")
 
     else:
         to_process = [(idx, obj) for idx, obj in enumerate(items) if obj.get("idx") not in done_set]
-        results = {}
-        with ThreadPoolExecutor(max_workers=args.threads) as executor:
-            futures = [executor.submit(process_item, idx, obj, args, client) for idx, obj in to_process]
+        expected = [obj["idx"] for _, obj in to_process if "idx" in obj]
+        # 结果一到就按提交顺序追加落盘，中途中断时已完成的部分都已写入，可直接续跑
+        with OrderedJsonlWriter(args.output, expected, mode="a") as writer, \
+                ThreadPoolExecutor(max_workers=args.threads) as executor:
+            futures = [executor.submit(process_item, idx, obj, args, client, limiter, cache, telemetry, hedger) for idx, obj in to_process]
             for future in tqdm(as_completed(futures), total=len(to_process), desc="LLM生成中(并发)"):
                 out = future.result()
                 if out is not None and "idx" in out:
-                    results[out["idx"]] = out
-
-        with open(args.output, "a", encoding="utf-8") as fout:  # 追加模式
-            for idx in sorted(results):
-                out = results[idx]
-                if out is None:
-                    continue
-                fout.write(json.dumps(out, ensure_ascii=False) + "\n")
-                fout.flush()
+                    writer.write(out)
         logging.info(f"全部处理完成(并发)，结果保存在 {args.output}")
 
+    compact_output(args.output)
+    mark_done(args.output)
+    if limiter is not None:
+        logging.info(limiter.summary())
+    if hedger is not None:
+        logging.info(hedger.summary())
+        hedger.close()
+    if cache is not None:
+        logging.info(cache.summary())
+        cache.close()
+    if telemetry is not None:
+        telemetry.close()
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,4 +1,5 @@
 import os
+import sys
 import json
 import re
 from tqdm import tqdm
@@ -7,6 +8,13 @@ import logging
 import torch
 from transformers import AutoTokenizer, AutoModelForCausalLM
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.local_batch import build_prompt, local_generate_batch, count_tokens, score_labels
+from common.batching import plan_token_batches
+from common.checkpoint import get_done_set, report_resume, compact_output, trim_partial_line
+from common.jsonl_tail import clear_done, mark_done
+from common.label_rules import extract_candidate_labels
+
 def extract_prompts(text):
     sys_match = re.search(r"<s>\[INST\]<<SYS>>\n(.*?)\n<<\/SYS>>\n", text, re.DOTALL)
     user_match = re.search(r"<<\/SYS>>\n\n(.*)\[\/INST\]", text, re.DOTALL)
@@ -41,53 +49,11 @@ def resolve_device(device_str):
         print(f"Warning: Requested device '{device_str}' not available. Falling back to CPU.")
         return "cpu"
 
-def extract_assistant_response(result):
-    """
-    用正则从输出中提取assistant后的内容，去掉冗余的system/user段。
-    支持常见三种格式（assistant、ASSISTANT、<|im_start|>assistant）。
-    若未命中，则返回原文。
-    """
-    # 尝试多种assistant开头的正则
-    match = re.search(r"(?:^|\n)assistant\s*\n(.*)", result, re.DOTALL | re.IGNORECASE)
-    if match:
-        return match.group(1).strip()
-    # 通用OpenAI格式
-    match = re.search(r"<\|im_start\|>assistant\s*(.*?)<\|im_end\|>", result, re.DOTALL | re.IGNORECASE)
-    if match:
-        return match.group(1).strip()
-    # 如果没有assistant提示符，直接返回原文
-    return result.strip()
-
 def local_generate(model, tokenizer, system_prompt, user_prompt, max_new_tokens=4096, device="cpu", enable_thinking=None, use_qwen_template=False):
-    if use_qwen_template and hasattr(tokenizer, "apply_chat_template"):
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt}
-        ]
-        chat_template_kwargs = dict(
-            conversation=messages,
-            tokenize=False,
-            add_generation_prompt=True
-        )
-        if enable_thinking is not None:
-            chat_template_kwargs["enable_thinking"] = enable_thinking
-        prompt = tokenizer.apply_chat_template(**chat_template_kwargs)
-    else:
-        prompt = system_prompt + "\n" + user_prompt
-
-    inputs = tokenizer(prompt, return_tensors="pt").to(device)
-    with torch.no_grad():
-        outputs = model.generate(
-            **inputs,
-            max_new_tokens=max_new_tokens,
-            do_sample=False,
-            pad_token_id=tokenizer.eos_token_id
-        )
-    result = tokenizer.decode(outputs[0], skip_special_tokens=True)
-    # 用正则自动截取assistant后的内容
-    assistant_result = extract_assistant_response(result)
-    assistant_result = remove_think_tags(assistant_result)
-    return assistant_result
+    prompt = build_prompt(tokenizer, system_prompt, user_prompt, enable_thinking, use_qwen_template)
+    # 与批量路径一致：只解码新生成的token，不依赖chat模板中的assistant标记截取回答
+    result = local_generate_batch(model, tokenizer, [prompt], max_new_tokens=max_new_tokens, device=device)[0]
+    return remove_think_tags(result).strip()
 
 def main():
     parser = argparse.ArgumentParser()
@@ -99,6 +65,11 @@ def main():
     parser.add_argument("--device", default="cpu", help="cpu、cuda 或 mps")
     parser.add_argument("--enable_thinking", action="store_true",
                         help="出现此参数时，显式关闭思考模式（即传 enable_thinking=False），不传则保持模型默认")
+    parser.add_argument("--batch_size", type=int, default=1, help="每次generate的样本数，大于1时左padding批量推理")
+    parser.add_argument("--max_batch_tokens", type=int, default=0,
+                        help="批量模式下每批padding后的prompt token上限，0为不限；样本按长度分桶后组批")
+    parser.add_argument("--constrained", action="store_true",
+                        help="标签约束模式：不做自由解码，对候选标签做一次批量前向的对数似然打分，输出最优标签及各标签概率（强制关闭思考模式）")
     args = parser.parse_args()
 
     logging.basicConfig(
@@ -118,6 +89,10 @@ def main():
         enable_thinking = None
 
     items = load_items(args.input)
+    done_set = get_done_set(args.output)
+    report_resume(args.output, done_set)
+    # 跟随读取的下游（--follow）以完成标记判断结束，开始写之前先清掉上次的标记
+    clear_done(args.output)
 
     tokenizer = AutoTokenizer.from_pretrained(args.model_dir)
     model = AutoModelForCausalLM.from_pretrained(args.model_dir)
@@ -129,41 +104,103 @@ def main():
     model_type = getattr(model.config, "model_type", "").lower()
     use_qwen_template = "qwen" in model_type
 
-    with open(args.output, "w", encoding="utf-8") as fout:
-        for idx, obj in enumerate(tqdm(items, desc="本地模型推理中")):
-            if "idx" not in obj:
-                msg = "原始数据缺少idx字段，跳过。"
-                logging.warning(msg)
-                continue
-            out_idx = obj["idx"]
-            text = obj["data"]
-            sys_prompt, user_prompt = extract_prompts(text)
-            if not (sys_prompt and user_prompt):
-                msg = f"第{out_idx + 1}条未能正确抽取prompt，跳过。"
-                logging.warning(msg)
-                continue
-            try:
-                result = local_generate(
-                    model, tokenizer, sys_prompt, user_prompt,
-                    max_new_tokens=args.max_new_tokens,
-                    device=device,
-                    enable_thinking=enable_thinking,
-                    use_qwen_template=use_qwen_template
-                )
-                logging.info(f"第{out_idx + 1}条本地模型生成成功。")
-                out = {
-                    "idx": out_idx,
-                    "system": sys_prompt,
-                    "user": user_prompt,
-                    "llm_output": result
-                }
-                fout.write(json.dumps(out, ensure_ascii=False) + "\n")
-                fout.flush()
-            except Exception as e:
-                errmsg = f"第{out_idx + 1}条本地模型推理出错：{e}"
-                print(errmsg)
-                logging.error(errmsg)
-                continue
+    tasks = []
+    for obj in items:
+        if "idx" not in obj:
+            msg = "原始数据缺少idx字段，跳过。"
+            logging.warning(msg)
+            continue
+        out_idx = obj["idx"]
+        if out_idx in done_set:
+            continue
+        text = obj["data"]
+        sys_prompt, user_prompt = extract_prompts(text)
+        if not (sys_prompt and user_prompt):
+            msg = f"第{out_idx + 1}条未能正确抽取prompt，跳过。"
+            logging.warning(msg)
+            continue
+        tasks.append((out_idx, sys_prompt, user_prompt))
+
+    def write_result(fout, out_idx, sys_prompt, user_prompt, result, label_probs=None):
+        out = {
+            "idx": out_idx,
+            "system": sys_prompt,
+            "user": user_prompt,
+            "llm_output": result
+        }
+        if label_probs is not None:
+            out["label_probs"] = label_probs
+        fout.write(json.dumps(out, ensure_ascii=False) + "\n")
+        fout.flush()
+
+    trim_partial_line(args.output)
+    with open(args.output, "a", encoding="utf-8") as fout:  # 追加模式，支持断点续跑
+        if args.constrained:
+            # 标签打分只需一次前向，思考模式的<think>段没有意义，统一关闭
+            for out_idx, sys_prompt, user_prompt in tqdm(tasks, desc="本地模型标签打分中"):
+                try:
+                    prompt = build_prompt(tokenizer, sys_prompt, user_prompt, False, use_qwen_template)
+                    result, label_probs = score_labels(
+                        model, tokenizer, prompt, extract_candidate_labels(sys_prompt), device=device
+                    )
+                    logging.info(f"第{out_idx + 1}条本地模型标签打分成功。")
+                    write_result(fout, out_idx, sys_prompt, user_prompt, result, label_probs)
+                except Exception as e:
+                    errmsg = f"第{out_idx + 1}条本地模型标签打分出错：{e}"
+                    print(errmsg)
+                    logging.error(errmsg)
+                    continue
+        elif args.batch_size <= 1:
+            for out_idx, sys_prompt, user_prompt in tqdm(tasks, desc="本地模型推理中"):
+                try:
+                    result = local_generate(
+                        model, tokenizer, sys_prompt, user_prompt,
+                        max_new_tokens=args.max_new_tokens,
+                        device=device,
+                        enable_thinking=enable_thinking,
+                        use_qwen_template=use_qwen_template
+                    )
+                    logging.info(f"第{out_idx + 1}条本地模型生成成功。")
+                    write_result(fout, out_idx, sys_prompt, user_prompt, result)
+                except Exception as e:
+                    errmsg = f"第{out_idx + 1}条本地模型推理出错：{e}"
+                    print(errmsg)
+                    logging.error(errmsg)
+                    continue
+        else:
+            # 预先分词，按长度分桶组批，减少padding浪费；结果按idx写回
+            all_prompts = [
+                build_prompt(tokenizer, sys_prompt, user_prompt, enable_thinking, use_qwen_template)
+                for _, sys_prompt, user_prompt in tasks
+            ]
+            lengths = count_tokens(tokenizer, all_prompts)
+            plan = plan_token_batches(lengths, args.batch_size, args.max_batch_tokens)
+            logging.info(f"共{len(tasks)}条，按长度分为{len(plan)}批。")
+            pbar = tqdm(total=len(tasks), desc="本地模型批量推理中")
+            for batch_ids in plan:
+                batch = [tasks[i] for i in batch_ids]
+                prompts = [all_prompts[i] for i in batch_ids]
+                try:
+                    results = local_generate_batch(
+                        model, tokenizer, prompts,
+                        max_new_tokens=args.max_new_tokens,
+                        device=device
+                    )
+                except Exception as e:
+                    for out_idx, _, _ in batch:
+                        errmsg = f"第{out_idx + 1}条本地模型批量推理出错：{e}"
+                        print(errmsg)
+                        logging.error(errmsg)
+                    pbar.update(len(batch))
+                    continue
+                for (out_idx, sys_prompt, user_prompt), result in zip(batch, results):
+                    result = remove_think_tags(result).strip()
+                    logging.info(f"第{out_idx + 1}条本地模型生成成功。")
+                    write_result(fout, out_idx, sys_prompt, user_prompt, result)
+                pbar.update(len(batch))
+            pbar.close()
+    compact_output(args.output)
+    mark_done(args.output)
     logging.info(f"全部处理完成，结果保存在 {args.output}")
 
 if __name__ == "__main__":
@@ -1,13 +1,25 @@
 import os
+import sys
 import json
 import re
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
 from tqdm import tqdm
 import argparse
 import logging
 from concurrent.futures import ThreadPoolExecutor, as_completed
 import time
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.async_engine import run_async, retry_async
+from common.rate_limiter import AdaptiveRateLimiter, is_rate_limit_error
+from common.jsonl_writer import OrderedJsonlWriter
+from common.checkpoint import get_done_set, report_resume, compact_output, trim_partial_line
+from common.jsonl_tail import clear_done, mark_done
+from common.llm_call import create_chat, create_chat_async
+from common.hedging import add_hedge_args, open_hedger
+from common.response_cache import add_cache_args, open_cache
+from common.telemetry import add_telemetry_args, open_telemetry
+
 def extract_prompts(text):
     sys_match = re.search(r"<s>\[INST\]<<SYS>>\n(.*?)\n<<\/SYS>>\n", text, re.DOTALL)
     user_match = re.search(r"<<\/SYS>>\n\n(.*)\[\/INST\]", text, re.DOTALL)
@@ -41,6 +53,15 @@ def main():
     parser.add_argument("--max_retries", type=int, default=5, help="每条最大重试次数")
     parser.add_argument("--retry_base_wait", type=float, default=20, help="429出错后等待的基础秒数，指数退避")
     parser.add_argument("--enable_thinking", action="store_true", help="启用thinking模式（即请求时传extra_body={enable_thinking:False}）")
+    parser.add_argument("--async_mode", action="store_true", help="使用AsyncOpenAI异步引擎，单进程内并发，重试等待不占线程")
+    parser.add_argument("--max_in_flight", type=int, default=64, help="异步模式下同时在途的最大请求数")
+    parser.add_argument("--adaptive_limit", action="store_true",
+                        help="启用共享自适应限流器：成功时加性增大并发，429时乘性减小并按Retry-After全局暂停")
+    parser.add_argument("--max_rps", type=float, default=0, help="自适应限流器的每秒请求数上限，0为不限")
+    parser.add_argument("--max_tpm", type=int, default=0, help="自适应限流器的每分钟token数上限，0为不限")
+    add_cache_args(parser)
+    add_telemetry_args(parser)
+    add_hedge_args(parser)
 
     args = parser.parse_args()
 
@@ -53,18 +74,26 @@ def main():
     )
 
     client = OpenAI(api_key=args.api_key, base_url=args.base_url)
+    limiter = None
+    if args.adaptive_limit:
+        limiter = AdaptiveRateLimiter(
+            max_concurrency=args.max_in_flight if args.async_mode else args.threads,
+            max_rps=args.max_rps,
+            max_tpm=args.max_tpm
+        )
+    cache = open_cache(args)
+    hedger = open_hedger(args)
+    telemetry = open_telemetry(args, "biored", "answer")
 
     items = load_items(args.input)
 
-    def process_item(idx, obj):
-        max_retries = args.max_retries
-        retry_base_wait = args.retry_base_wait
-
+    def prepare_item(obj):
+        """抽取prompt并构造请求参数，失败时返回(None, 错误记录)"""
         # 必须使用原始obj中的idx字段，没有则跳过
         if "idx" not in obj:
             msg = "原始数据缺少idx字段，跳过。"
             logging.warning(msg)
-            return {"error": msg}
+            return None, {"error": msg}
 
         out_idx = obj["idx"]
 
@@ -73,21 +102,32 @@ def main():
         if not (sys_prompt and user_prompt):
             msg = f"第{out_idx + 1}条未能正确抽取prompt，跳过。"
             logging.warning(msg)
-            return {"idx": out_idx, "error": msg}
+            # 只取决于输入，重跑结果不变，记为final，续跑和编排器都按已完成计
+            return None, {"idx": out_idx, "error": msg, "final": True}
+        kwargs = dict(
+            model=args.model,
+            messages=[
+                {"role": "system", "content": sys_prompt},
+                {"role": "user", "content": user_prompt},
+            ]
+        )
+        if args.enable_thinking:
+            kwargs["extra_body"] = {"enable_thinking": False}
+        return (out_idx, sys_prompt, user_prompt, kwargs), None
+
+    def process_item(idx, obj):
+        max_retries = args.max_retries
+        retry_base_wait = args.retry_base_wait
+
+        prepared, error_out = prepare_item(obj)
+        if prepared is None:
+            return error_out
+        out_idx, sys_prompt, user_prompt, kwargs = prepared
+        last_error = None
         for attempt in range(max_retries):
             try:
-                kwargs = dict(
-                    model=args.model,
-                    messages=[
-                        {"role": "system", "content": sys_prompt},
-                        {"role": "user", "content": user_prompt},
-                    ]
-                )
-                if args.enable_thinking:
-                    kwargs["extra_body"] = {"enable_thinking": False}
-                completion = client.chat.completions.create(**kwargs)
-
-                result = completion.choices[0].message.content
+                result = create_chat(client, kwargs, cache=cache, limiter=limiter, hedger=hedger,
+                                     telemetry=telemetry, item=out_idx).content
                 logging.info(f"第{out_idx + 1}条成功生成。")
                 return {
                     "idx": out_idx,
@@ -96,6 +136,13 @@ def main():
                     "llm_output": result
                 }
             except Exception as e:
+                last_error = e
+                if limiter is not None and is_rate_limit_error(e):
+                    # 429由共享限流器统一暂停并降并发，这里不再各自睡眠
+                    errmsg = f"第{out_idx + 1}条请求被限流(429)：{e}，第{attempt + 1}次重试，由共享限流器统一等待..."
+                    print(errmsg)
+                    logging.warning(errmsg)
+                    continue
                 wait_time = retry_base_wait * (2 ** attempt)
                 errmsg = f"第{out_idx + 1}条请求出错：{e}，第{attempt + 1}次重试，等待{wait_time:.1f}秒..."
                 print(errmsg)
@@ -103,14 +150,61 @@ def main():
                 time.sleep(wait_time)
                 continue
         # 超过最大重试次数，记录错误
-        errmsg = f"第{out_idx + 1}条请求连续{max_retries}次失败，已跳过。最后错误：{e}"
+        errmsg = f"第{out_idx + 1}条请求连续{max_retries}次失败，已跳过。最后错误：{last_error}"
         print(errmsg)
         logging.error(errmsg)
         return {"idx": out_idx, "error": errmsg}
 
-    if args.threads == 1:
-        with open(args.output, "w", encoding="utf-8") as fout:
+    async def process_item_async(obj):
+        prepared, error_out = prepare_item(obj)
+        if prepared is None:
+            return error_out
+        out_idx, sys_prompt, user_prompt, kwargs = prepared
+        try:
+            completion = await retry_async(
+                lambda: create_chat_async(async_client, kwargs, cache=cache, limiter=limiter, hedger=hedger,
+                                          telemetry=telemetry, item=out_idx),
+                args.max_retries, args.retry_base_wait, f"第{out_idx + 1}条", limiter=limiter
+            )
+        except Exception as e:
+            errmsg = f"第{out_idx + 1}条请求连续{args.max_retries}次失败，已跳过。最后错误：{e}"
+            print(errmsg)
+            logging.error(errmsg)
+            return {"idx": out_idx, "error": errmsg}
+        result = completion.content
+        logging.info(f"第{out_idx + 1}条成功生成。")
+        return {
+            "idx": out_idx,
+            "system": sys_prompt,
+            "user": user_prompt,
+            "llm_output": result
+        }
+
+    # 断点续跑：跳过已成功的idx，带error的记录会重新请求
+    done_set = get_done_set(args.output)
+    report_resume(args.output, done_set)
+    # 跟随读取的下游（--follow）以完成标记判断结束，开始写之前先清掉上次的标记
+    clear_done(args.output)
+
+    if args.async_mode:
+        async_client = AsyncOpenAI(api_key=args.api_key, base_url=args.base_url)
+        to_process = [obj for obj in items if obj.get("idx") not in done_set]
+        expected = [obj["idx"] for obj in to_process if "idx" in obj]
+
+        with OrderedJsonlWriter(args.output, expected, mode="a") as writer:  # 追加模式
+            def collect(out):
+                if out is not None and "idx" in out:
+                    writer.write(out)
+
+            run_async(to_process, process_item_async, max_in_flight=args.max_in_flight, on_result=collect)
+        logging.info(f"全部处理完成(异步)，结果保存在 {args.output}")
+
+    elif args.threads == 1:
+        trim_partial_line(args.output)
+        with open(args.output, "a", encoding="utf-8") as fout:  # 追加模式
             for idx, obj in enumerate(tqdm(items, desc="LLM生成中")):
+                if obj.get("idx") in done_set:
+                    continue
                 out = process_item(idx, obj)
                 if "error" in out:
                     fout.write(json.dumps(out, ensure_ascii=False) + "\n")
@@ -121,22 +215,30 @@ def main():
         logging.info(f"全部处理完成，结果保存在 {args.output}")
 
     else:
-        results = {}
-        with ThreadPoolExecutor(max_workers=args.threads) as executor:
-            futures = [executor.submit(process_item, idx, obj) for idx, obj in enumerate(items)]
-            for future in tqdm(as_completed(futures), total=len(items), desc="LLM生成中(并发)"):
+        to_process = [(idx, obj) for idx, obj in enumerate(items) if obj.get("idx") not in done_set]
+        expected = [obj["idx"] for _, obj in to_process if "idx" in obj]
+        # 结果一到就按提交顺序追加落盘，不再等全部请求结束
+        with OrderedJsonlWriter(args.output, expected, mode="a") as writer, \
+                ThreadPoolExecutor(max_workers=args.threads) as executor:
+            futures = [executor.submit(process_item, idx, obj) for idx, obj in to_process]
+            for future in tqdm(as_completed(futures), total=len(to_process), desc="LLM生成中(并发)"):
                 out = future.result()
                 if out is not None and "idx" in out:
-                    results[out["idx"]] = out
-
-        with open(args.output, "w", encoding="utf-8") as fout:
-            for idx in sorted(results):
-                out = results[idx]
-                if out is None:
-                    continue
-                fout.write(json.dumps(out, ensure_ascii=False) + "\n")
-                fout.flush()
+                    writer.write(out)
         logging.info(f"全部处理完成(并发)，结果保存在 {args.output}")
 
+    compact_output(args.output)
+    mark_done(args.output)
+    if limiter is not None:
+        logging.info(limiter.summary())
+    if hedger is not None:
+        logging.info(hedger.summary())
+        hedger.close()
+    if cache is not None:
+        logging.info(cache.summary())
+        cache.close()
+    if telemetry is not None:
+        telemetry.close()
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
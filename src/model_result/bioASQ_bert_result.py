@@ -1,10 +1,16 @@
+import os
+import sys
+import glob
 import json
 import re
 import torch
-from bert_score import score as bert_score
-from rouge_score import rouge_scorer
 import logging
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.bertscore_cache import BertScorer, add_bertscore_args, check_backend, open_bertscorer
+from common.manifest import save_inputs_manifest, skip_if_unchanged
+from common.rouge_engine import RougeEngine
+
 def extract_gold_supporting_sentences(gold_item):
     return gold_item.get("supporting_sentences", [])
 
@@ -31,19 +37,45 @@ def choose_device():
         logging.info("Using CPU for BERTScore evaluation.")
         return "cpu"
 
-def main(gold_json_file, llm_json_file, report_file="supporting_sentence_report.txt"):
-    logging.info(f"Loading gold file: {gold_json_file}")
-    with open(gold_json_file, "r", encoding="utf-8") as f:
-        gold_data = [json.loads(line) for line in f if line.strip()]
-    logging.info(f"Loading LLM answer file: {llm_json_file}")
-    with open(llm_json_file, "r", encoding="utf-8") as f:
-        llm_data = [json.loads(line) for line in f if line.strip()]
+def load_jsonl(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
 
-    gold_dict = {item["idx"]: item for item in gold_data}
-    llm_dict = {item["idx"]: item for item in llm_data}
+def find_answer_files(spec, pattern="*bioASQ*-answer.json"):
+    """
+    --answer为单个文件时原样返回；为目录时递归查找匹配pattern的答案文件；
+    含通配符时按glob展开（支持**），展开出的目录同样递归查找。返回(文件列表, 根目录)，根目录用于在结果目录下保持相同的相对路径。
+    """
+    if os.path.isfile(spec):
+        return [spec], os.path.dirname(spec)
+    if os.path.isdir(spec):
+        hits, root = [spec], spec
+    else:
+        hits = glob.glob(spec, recursive=True)
+        parts = []
+        for part in os.path.normpath(spec).split(os.sep):
+            if glob.has_magic(part):
+                break
+            parts.append(part)
+        root = os.sep.join(parts) or "."
+    files = set()
+    for hit in hits:
+        if os.path.isdir(hit):
+            files.update(glob.glob(os.path.join(hit, "**", pattern), recursive=True))
+        elif os.path.isfile(hit):
+            files.add(hit)
+    return sorted(files), root
 
+def report_path(answer_file, root, result_dir):
+    """<root>/<厂商>/<模型>/<名称>-answer.json → <result_dir>/<厂商>/<模型>/<名称>-bert.txt"""
+    rel = os.path.relpath(answer_file, root)
+    base = rel[:-len("-answer.json")] if rel.endswith("-answer.json") else os.path.splitext(rel)[0]
+    return os.path.join(result_dir, base + "-bert.txt")
+
+def evaluate_answers(gold_dict, llm_dict, rouge_engine):
+    """逐条抽取supporting sentence并计算Coverage和ROUGE，返回写报告所需的各列表（BERTScore之后统一计算）"""
     gold_sents, pred_sents = [], []
-    coverages, rouge_ls, rouge_1s, rouge_2s, bert_f1s = [], [], [], [], []
+    coverages, rouge_ls, rouge_1s, rouge_2s = [], [], [], []
     skipped_indices = []
 
     logging.info(f"Starting evaluation on {len(set(gold_dict.keys()) & set(llm_dict.keys()))} samples.")
@@ -63,34 +95,35 @@ def main(gold_json_file, llm_json_file, report_file="supporting_sentence_report.
         gold_sents.append(gold_support)
         pred_sents.append(llm_support)
         valid_indices.append(idx)
-        coverage = int(gold_support in llm_support or llm_support in gold_support)
-        coverages.append(coverage)
-        scorer = rouge_scorer.RougeScorer(['rouge1', 'rouge2', 'rougeL'], use_stemmer=True)
-        scores = scorer.score(gold_support, llm_support)
-        rouge_1s.append(scores["rouge1"].fmeasure)
-        rouge_2s.append(scores["rouge2"].fmeasure)
-        rouge_ls.append(scores["rougeL"].fmeasure)
-        logging.info(f"Evaluated idx={idx}: Coverage={coverage}, ROUGE-1={scores['rouge1'].fmeasure:.4f}, "
-                     f"ROUGE-2={scores['rouge2'].fmeasure:.4f}, ROUGE-L={scores['rougeL'].fmeasure:.4f}")
-
-    device = choose_device()
-    logging.info("Starting BERTScore evaluation...")
-    if gold_sents and pred_sents:
-        P, R, F1 = bert_score(
-            pred_sents,
-            gold_sents,
-            lang="en",
-            model_type="bert-base-uncased",
-            device=device,
-            verbose=True
-        )
-        bert_f1s = F1.tolist()
-    else:
-        bert_f1s = []
-    logging.info("BERTScore evaluation finished.")
+        coverages.append(int(gold_support in llm_support or llm_support in gold_support))
 
+    # ROUGE整批计算（scorer只构建一次，金标准分词结果缓存，条数多时多进程）
+    for idx, coverage, scores in zip(valid_indices, coverages, rouge_engine.score_pairs(gold_sents, pred_sents)):
+        rouge_1s.append(scores["rouge1"])
+        rouge_2s.append(scores["rouge2"])
+        rouge_ls.append(scores["rougeL"])
+        logging.debug(f"Evaluated idx={idx}: Coverage={coverage}, ROUGE-1={scores['rouge1']:.4f}, "
+                      f"ROUGE-2={scores['rouge2']:.4f}, ROUGE-L={scores['rougeL']:.4f}")
+    logging.info(f"Coverage/ROUGE evaluation finished: {len(valid_indices)} samples, {len(skipped_indices)} skipped.")
+    return {
+        "valid_indices": valid_indices,
+        "gold_sents": gold_sents,
+        "pred_sents": pred_sents,
+        "coverages": coverages,
+        "rouge_1s": rouge_1s,
+        "rouge_2s": rouge_2s,
+        "rouge_ls": rouge_ls,
+        "skipped_indices": skipped_indices,
+    }
+
+def write_report(report_file, ev, bert_f1s):
+    gold_sents, pred_sents, coverages = ev["gold_sents"], ev["pred_sents"], ev["coverages"]
+    rouge_1s, rouge_2s, rouge_ls = ev["rouge_1s"], ev["rouge_2s"], ev["rouge_ls"]
+    report_dir = os.path.dirname(report_file)
+    if report_dir:
+        os.makedirs(report_dir, exist_ok=True)
     with open(report_file, "w", encoding="utf-8") as fout:
-        for i, idx in enumerate(valid_indices):
+        for i, idx in enumerate(ev["valid_indices"]):
             fout.write(f"=== idx: {idx} ===\n")
             fout.write(f"Gold supporting: {gold_sents[i]}\n")
             fout.write(f"LLM supporting:  {pred_sents[i]}\n")
@@ -106,16 +139,71 @@ def main(gold_json_file, llm_json_file, report_file="supporting_sentence_report.
         fout.write(f"BERTScore-F1: {sum(bert_f1s)/len(bert_f1s):.4f}\n" if bert_f1s else "BERTScore-F1: N/A\n")
 
     logging.info(f"评测完成，报告已保存到 {report_file}")
-    if skipped_indices:
-        logging.info(f"共跳过 {len(skipped_indices)} 个空句样本，索引为: {skipped_indices}")
+    if ev["skipped_indices"]:
+        logging.info(f"共跳过 {len(ev['skipped_indices'])} 个空句样本，索引为: {ev['skipped_indices']}")
+
+def main(gold_json_file, llm_json_file, report_file="supporting_sentence_report.txt", bert_scorer=None):
+    main_multi(gold_json_file, [llm_json_file], [report_file], bert_scorer)
+
+def main_multi(gold_json_file, llm_json_files, report_files, bert_scorer=None, on_report=None, rouge_workers=0,
+               verify_backend=0):
+    """
+    多个模型的答案文件共用一次金标准读取和一个BERT模型：先逐个文件算Coverage/ROUGE，
+    再把所有文件的句子一起送入BERT编码（批次跨文件组成），最后逐个文件算BERTScore并写报告。
+    on_report(llm_json_file, report_file)在每份报告写完后调用（如写manifest）；
+    verify_backend>0且用的不是PyTorch后端时，取前verify_backend对用PyTorch重算，把F1差异写入日志。
+    """
+    logging.info(f"Loading gold file: {gold_json_file}")
+    gold_dict = {item["idx"]: item for item in load_jsonl(gold_json_file)}
+
+    evaluations = []
+    rouge_engine = RougeEngine(["rouge1", "rouge2", "rougeL"], use_stemmer=True, workers=rouge_workers)
+    try:
+        for llm_json_file in llm_json_files:
+            logging.info(f"Loading LLM answer file: {llm_json_file}")
+            llm_dict = {item["idx"]: item for item in load_jsonl(llm_json_file)}
+            evaluations.append(evaluate_answers(gold_dict, llm_dict, rouge_engine))
+    finally:
+        rouge_engine.close()
+
+    logging.info("Starting BERTScore evaluation...")
+    texts = [t for ev in evaluations for t in ev["pred_sents"] + ev["gold_sents"]]
+    if texts and bert_scorer is None:
+        bert_scorer = BertScorer(device=choose_device())
+    if texts:
+        bert_scorer.embed(texts)
+        logging.info(bert_scorer.summary())
+    if texts and verify_backend > 0 and bert_scorer.backend != "torch":
+        cands = [t for ev in evaluations for t in ev["pred_sents"]]
+        refs = [t for ev in evaluations for t in ev["gold_sents"]]
+        check = check_backend(bert_scorer, cands, refs, verify_backend)
+        msg = (f"后端精度检验（{bert_scorer.backend_tag}对比torch，{check['pairs']}对）：F1差值最大{check['max_abs_diff']:.4f}，"
+               f"平均{check['mean_abs_diff']:.4f}，平均F1偏差{check['mean_f1_diff']:+.4f}；torch编码{check['torch_rate'] or 0:.1f}条/秒")
+        print(msg)
+        logging.info(msg)
+    logging.info("BERTScore evaluation finished.")
+
+    for llm_json_file, report_file, ev in zip(llm_json_files, report_files, evaluations):
+        bert_f1s = bert_scorer.score(ev["pred_sents"], ev["gold_sents"])[2] if ev["gold_sents"] else []
+        write_report(report_file, ev, bert_f1s)
+        if on_report is not None:
+            on_report(llm_json_file, report_file)
 
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument("--benchmark", default="data/evaluation/benchmark/BioASQ.json", help="金标准jsonl")
-    parser.add_argument("--answer", required=True, help="llm生成数据jsonl")
-    parser.add_argument("--result", default="bert_result.txt", help="报告输出文件")
+    parser.add_argument("--answer", required=True,
+                        help="llm生成数据jsonl；也可以是目录或通配符（如data/evaluation/model_answer/**/），一次加载模型评测全部答案文件")
+    parser.add_argument("--answer_pattern", default="*bioASQ*-answer.json",
+                        help="--answer为目录时查找的答案文件名模式，默认也包含qwen3-8b-bioASQ-thinking-r2-answer.json这类变体")
+    parser.add_argument("--result", default="bert_result.txt", help="报告输出文件（单个答案文件时）")
+    parser.add_argument("--result_dir", default="data/evaluation/model_result",
+                        help="多个答案文件时的报告目录，按答案文件的相对路径写<名称>-bert.txt")
     parser.add_argument("--log", default="bert_eval.log", help="日志文件路径（含文件名），如 logs/bert_eval.log")
+    parser.add_argument("--force", action="store_true", help="即使输入文件和上次相同也重新计算")
+    parser.add_argument("--rouge_workers", type=int, default=0, help="计算ROUGE的进程数，0为CPU核数，1为不开进程池")
+    add_bertscore_args(parser)
     args = parser.parse_args()
 
     logging.basicConfig(
@@ -126,4 +214,31 @@ if __name__ == "__main__":
         ]
     )
 
-    main(args.benchmark, args.answer, args.result)
\ No newline at end of file
+    answer_files, answer_root = find_answer_files(args.answer, args.answer_pattern)
+    if not answer_files:
+        parser.error(f"没有找到答案文件：{args.answer}")
+    if os.path.isfile(args.answer):
+        jobs = [(args.answer, args.result)]
+    else:
+        jobs = [(answer, report_path(answer, answer_root, args.result_dir)) for answer in answer_files]
+        logging.info(f"共{len(jobs)}个答案文件，报告写入{args.result_dir}")
+
+    # 输入文件内容未变化时直接复用已有报告
+    config = {"stage": "bioasq_bert", "model_type": args.model_type, "num_layers": args.num_layers}
+    if args.backend != "torch":
+        config["backend"] = "onnx-int8" if args.quantize else args.backend
+    if args.embedding_cache and args.embedding_dtype != "float32":
+        # float16向量缓存会让分数相差约1e-4，换用后旧报告不能再当作未变化复用
+        config["embedding_dtype"] = args.embedding_dtype
+    jobs = [(answer, result) for answer, result in jobs
+            if not skip_if_unchanged(result, [args.benchmark, answer], config, args.force)]
+    if jobs:
+        bert_scorer = open_bertscorer(args, choose_device())
+        main_multi(
+            args.benchmark, [answer for answer, _ in jobs], [result for _, result in jobs], bert_scorer,
+            on_report=lambda answer, result: save_inputs_manifest(result, [args.benchmark, answer], config),
+            rouge_workers=args.rouge_workers, verify_backend=args.verify_backend
+        )
+        if bert_scorer.store is not None:
+            logging.info(bert_scorer.store.summary())
+            bert_scorer.store.close()
@@ -1,7 +1,12 @@
+import os
+import sys
 import json
 from sklearn.metrics import classification_report, accuracy_score
 import argparse
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.manifest import save_inputs_manifest, skip_if_unchanged
+
 def extract_label(label_json_str):
     """从label_json中提取label的True/False字符串"""
     try:
@@ -48,5 +53,11 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--test", required=True, help="模型输出jsonl文件（含label_json字段）")
     parser.add_argument("--result", default="label_report.txt", help="统计报告输出txt文件")
+    parser.add_argument("--force", action="store_true", help="即使输入文件和上次相同也重新计算")
     args = parser.parse_args()
-    main(args.test, args.result)
\ No newline at end of file
+    # 输入文件内容未变化时直接复用已有报告
+    inputs = [args.test]
+    config = {"stage": "bioasq_result"}
+    if not skip_if_unchanged(args.result, inputs, config, args.force):
+        main(args.test, args.result)
+        save_inputs_manifest(args.result, inputs, config)
\ No newline at end of file
@@ -1,8 +1,13 @@
+import os
+import sys
 import json
 import re
 from sklearn.metrics import classification_report
 import argparse
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.manifest import save_inputs_manifest, skip_if_unchanged
+
 def extract_label_from_model(label_json_str):
     try:
         if isinstance(label_json_str, dict):
@@ -67,5 +72,11 @@ if __name__ == "__main__":
     parser.add_argument("--test", required=True, help="模型输出jsonl文件")
     parser.add_argument("--benchmark", default="data/evaluation/benchmark/chemprot.json", help="金标准jsonl文件")
     parser.add_argument("--result", default="classification_report.txt", help="评测报告输出txt文件")
+    parser.add_argument("--force", action="store_true", help="即使输入文件和上次相同也重新计算")
     args = parser.parse_args()
-    main(args.test, args.benchmark, args.result)
\ No newline at end of file
+    # 输入文件内容未变化时直接复用已有报告
+    inputs = [args.test, args.benchmark]
+    config = {"stage": "chemprot_result"}
+    if not skip_if_unchanged(args.result, inputs, config, args.force):
+        main(args.test, args.benchmark, args.result)
+        save_inputs_manifest(args.result, inputs, config)
\ No newline at end of file
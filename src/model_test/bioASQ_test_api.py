@@ -1,10 +1,22 @@
 import os
+import sys
 import json
 import re
 from openai import OpenAI
-from tqdm import tqdm
 import argparse
 import logging
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.checkpoint import get_done_set, report_resume, compact_output
+from common.jsonl_tail import FollowedInput, add_follow_args
+from common.jsonl_writer import OrderedJsonlWriter
+from common.judge_batch import batch_system_prompt, request_batch, run_judge_stream, run_judge_tasks
+from common.llm_call import create_chat
+from common.manifest import RecordManifest, record_hash, reuse_unchanged
+from common.response_cache import add_cache_args, open_cache
+from common.rate_limiter import add_limit_args, open_limiter
+from common.telemetry import add_telemetry_args, open_telemetry
 
 def extract_gold_answer(text):
     """
@@ -30,6 +42,77 @@ def extract_predicted_answer(llm_output):
         return answer
     return ""
 
+# 构造system prompt
+SYSTEM_PROMPT = (
+    "You are an expert in biomedical text analysis, specifically in the BioASQ challenge. "
+    "Your task is: given a question and two answers, which contains a gold answer and a predicted answer. "
+    "Determine if the predicted answer is the same to the label.\n"
+    "If yes, output true, otherwise output false.\n"
+    "Here is an example:\n"
+    "Question: What is the gene mutated in the Gaucher disease?\n"
+    "Gold Answer: glucocerebrosidase.\n"
+    "Predicted answer: The gene mutated in Gaucher's disease is glucocerebrosidase (GBA1).\n"
+    "Your answer is: { \"label\": \"True\" }\n"
+    "only output a json contains a label, the output format examples are as follows:\n"
+    "{ \"label\": \"True\" }; { \"label\": \"False\" }\n"
+)
+
+BATCH_SYSTEM_PROMPT = batch_system_prompt(SYSTEM_PROMPT, '{ "idx": 0, "label": "True" }')
+
+def build_user_prompt(question, gold_answer, predicted_answer):
+    return (
+        f"Question: {question}\n"
+        f"Gold Answer: {gold_answer}\n"
+        f"Predicted answer: {predicted_answer}\n"
+    )
+
+def normalize_judge_label(label):
+    """批量结果里的label可能是布尔值或大小写不一的字符串，统一成"True"/"False"，否则返回None"""
+    if isinstance(label, bool):
+        return str(label)
+    if isinstance(label, str) and label.strip().lower() in ("true", "false"):
+        return label.strip().capitalize()
+    return None
+
+def judge_one(cur_idx, question, gold_answer, predicted_answer, client, model, max_retries=5, cache=None, telemetry=None, limiter=None):
+    user_prompt = build_user_prompt(question, gold_answer, predicted_answer)
+    wait_times = [5, 10, 15, 20, 25]
+    last_exception = None
+    for attempt in range(max_retries):
+        try:
+            kwargs = dict(
+                model=model,
+                messages=[
+                    {"role": "system", "content": SYSTEM_PROMPT},
+                    {"role": "user", "content": user_prompt},
+                ],
+                response_format={"type": "json_object"},
+            )
+            result = create_chat(client, kwargs, cache=cache, limiter=limiter, telemetry=telemetry, item=cur_idx).content
+            logging.info(f"第{cur_idx + 1}条成功生成。")
+            return {
+                "idx": cur_idx,
+                "label_json": result,
+                "question": question,
+                "gold_answer": gold_answer,
+                "predicted_answer": predicted_answer
+            }
+        except Exception as e:
+            last_exception = e
+            logging.warning(f"第{cur_idx + 1}条第{attempt + 1}次请求出错：{e}")
+            if attempt < max_retries - 1:
+                time.sleep(wait_times[min(attempt, len(wait_times) - 1)])
+    errmsg = f"第{cur_idx + 1}条请求重试{max_retries}次仍失败：{last_exception}"
+    print(errmsg)
+    logging.error(errmsg)
+    return {
+        "idx": cur_idx,
+        "error": errmsg,
+        "question": question,
+        "gold_answer": gold_answer,
+        "predicted_answer": predicted_answer
+    }
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--model", default="qwen-max-latest", help="模型名称")
@@ -39,6 +122,14 @@ def main():
     parser.add_argument("--log", default="bioASQ-test.log", help="日志文件名")
     parser.add_argument("--api_key", default=os.getenv("DASHSCOPE_API_KEY"), help="API KEY")
     parser.add_argument("--base_url", default="https://dashscope.aliyuncs.com/compatible-mode/v1", help="API base url")
+    parser.add_argument("--threads", type=int, default=4, help="并发线程数量")
+    parser.add_argument("--max_retries", type=int, default=5, help="每条最大重试次数")
+    parser.add_argument("--judge_batch_size", type=int, default=1,
+                        help="每次请求打包判定的条数，大于1时按idx返回results数组，缺失或不合法的条目逐条补请求")
+    add_cache_args(parser)
+    add_limit_args(parser)
+    add_telemetry_args(parser)
+    add_follow_args(parser, "答案")
     args = parser.parse_args()
 
     # 配置日志
@@ -49,6 +140,9 @@ def main():
         datefmt="%Y-%m-%d %H:%M:%S"
     )
     client = OpenAI(api_key=args.api_key, base_url=args.base_url)
+    cache = open_cache(args)
+    limiter = open_limiter(args, args.threads)
+    telemetry = open_telemetry(args, "bioasq", "test")
 
     # 读取gold标准文件，支持json或jsonl
     gold_path = args.gold
@@ -61,22 +155,24 @@ def main():
             gold_items = [json.loads(line) for line in f if line.strip()]
     idx2gold = {obj["idx"]: obj for obj in gold_items if "idx" in obj}
 
-    # 读取llm预测输出
-    with open(args.input, "r", encoding="utf-8") as fin:
-        items = [json.loads(line) for line in fin if line.strip()]
+    config = {"stage": "bioasq_test", "model": args.model, "prompt": SYSTEM_PROMPT}
+
+    def input_hash(cur_idx, obj):
+        return record_hash(obj, idx2gold.get(cur_idx))
 
-    idx2out = {}
-    for idx, obj in enumerate(tqdm(items, desc="LLM判断正误")):
-        cur_idx = obj.get("idx", idx)
+    def prepare(cur_idx, obj):
+        """
+        缺gold或提取不到预测答案时返回error记录，否则返回判定任务。
+        这两种预检失败只取决于输入，记为final，续跑和流水线调度都视为已完成，输入变化时由manifest触发重算。
+        """
         gold_obj = idx2gold.get(cur_idx)
         if not gold_obj:
             logging.warning(f"没有找到gold标准，idx={cur_idx}")
-            out = {
+            return {
                 "idx": cur_idx,
-                "error": "No gold standard found for idx."
+                "error": "No gold standard found for idx.",
+                "final": True
             }
-            idx2out[cur_idx] = out
-            continue
 
         question = gold_obj.get("question", "").strip()
         gold_answer = extract_gold_answer(gold_obj.get("text", ""))
@@ -85,70 +181,99 @@ def main():
         predicted_answer = extract_predicted_answer(llm_output)
         if not predicted_answer:
             logging.warning(f"无法提取预测答案, idx={cur_idx}")
-            out = {
+            return {
                 "idx": cur_idx,
-                "error": "No predicted answer found."
+                "error": "No predicted answer found.",
+                "final": True
             }
-            idx2out[cur_idx] = out
-            continue
-
-        # 构造system和user prompt
-        system_prompt = (
-            "You are an expert in biomedical text analysis, specifically in the BioASQ challenge. "
-            "Your task is: given a question and two answers, which contains a gold answer and a predicted answer. "
-            "Determine if the predicted answer is the same to the label.\n"
-            "If yes, output true, otherwise output false.\n"
-            "Here is an example:\n"
-            "Question: What is the gene mutated in the Gaucher disease?\n"
-            "Gold Answer: glucocerebrosidase.\n"
-            "Predicted answer: The gene mutated in Gaucher's disease is glucocerebrosidase (GBA1).\n"
-            "Your answer is: { \"label\": \"True\" }\n"
-            "only output a json contains a label, the output format examples are as follows:\n"
-            "{ \"label\": \"True\" }; { \"label\": \"False\" }\n"
-        )
-        user_prompt = (
-            f"Question: {question}\n"
-            f"Gold Answer: {gold_answer}\n"
-            f"Predicted answer: {predicted_answer}\n"
-        )
+        return (cur_idx, question, gold_answer, predicted_answer)
 
-        try:
-            completion = client.chat.completions.create(
-                model=args.model,
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_prompt},
-                ],
-                response_format={"type": "json_object"},
-            )
-            result = completion.choices[0].message.content
-            logging.info(f"第{cur_idx + 1}条成功生成。")
-            out = {
-                "idx": cur_idx,
-                "label_json": result,
-                "question": question,
-                "gold_answer": gold_answer,
-                "predicted_answer": predicted_answer
-            }
-        except Exception as e:
-            errmsg = f"第{cur_idx + 1}条请求出错：{e}"
-            print(errmsg)
-            logging.error(errmsg)
-            out = {
+    def judge_single(cur_idx, question, gold_answer, predicted_answer):
+        return judge_one(cur_idx, question, gold_answer, predicted_answer, client, args.model, args.max_retries, cache, telemetry, limiter)
+
+    def judge_group(group):
+        entries = [
+            (cur_idx, build_user_prompt(question, gold_answer, predicted_answer))
+            for cur_idx, question, gold_answer, predicted_answer in group
+        ]
+        results = request_batch(
+            client, args.model, BATCH_SYSTEM_PROMPT, entries,
+            lambda idx, entry: normalize_judge_label(entry.get("label")) is not None,
+            args.max_retries, cache, telemetry=telemetry, limiter=limiter, label=f"第{group[0][0] + 1}~{group[-1][0] + 1}条批量"
+        )
+        outs = []
+        for cur_idx, question, gold_answer, predicted_answer in group:
+            entry = results.get(cur_idx)
+            if entry is None:
+                logging.warning(f"第{cur_idx + 1}条批量结果缺失或不合法，改为单条请求。")
+                outs.append(judge_single(cur_idx, question, gold_answer, predicted_answer))
+                continue
+            logging.info(f"第{cur_idx + 1}条成功生成（批量）。")
+            outs.append({
                 "idx": cur_idx,
-                "error": errmsg,
+                "label_json": json.dumps({"label": normalize_judge_label(entry["label"])}, ensure_ascii=False),
                 "question": question,
                 "gold_answer": gold_answer,
-                "predicted_answer": predicted_answer
-            }
-        idx2out[cur_idx] = out
-
-    with open(args.output, "w", encoding="utf-8") as fout:
-        for obj in items:
-            cur_idx = obj.get("idx")
-            out = idx2out.get(cur_idx, {"idx": cur_idx, "error": "No result generated."})
-            fout.write(json.dumps(out, ensure_ascii=False) + "\n")
-            fout.flush()
+                "predicted_answer": predicted_answer,
+                "judge_batch": len(group)
+            })
+        return outs
+
+    # 断点续跑：跳过已成功的idx，带error的记录会重新请求
+    done_set = get_done_set(args.output)
+    if args.follow:
+        # 流水线模式：答案边生成边判定，增量重算按到达的每条记录比对manifest，上游写出完成标记后结束
+        source = FollowedInput(
+            args.input, args.output, done_set, RecordManifest(args.output, config), prepare,
+            input_hash, idle_timeout=args.follow_timeout or None
+        )
+        with OrderedJsonlWriter(args.output, [], mode="a") as writer:
+            run_judge_stream(
+                source.tasks(writer), writer, args.threads, judge_single, judge_group,
+                batch_size=args.judge_batch_size, desc="LLM判断正误"
+            )
+        source.finish()
+    else:
+        # 读取llm预测输出
+        with open(args.input, "r", encoding="utf-8") as fin:
+            items = [json.loads(line) for line in fin if line.strip()]
+
+        # 增量重算：按每条输入的内容哈希比对manifest，只重算输入变化的条目
+        input_hashes = {obj.get("idx", idx): input_hash(obj.get("idx", idx), obj) for idx, obj in enumerate(items)}
+        done_set = reuse_unchanged(args.output, done_set, input_hashes, config)
+        report_resume(args.output, done_set)
+
+        tasks = []
+        expected = []
+        precheck_errors = []
+        for idx, obj in enumerate(items):
+            cur_idx = obj.get("idx", idx)
+            if cur_idx in done_set:
+                continue
+            expected.append(cur_idx)
+            prepared = prepare(cur_idx, obj)
+            if isinstance(prepared, dict):
+                precheck_errors.append(prepared)
+            else:
+                tasks.append(prepared)
+
+        # 并发请求，结果按输入顺序逐条追加落盘
+        with OrderedJsonlWriter(args.output, expected, mode="a") as writer:
+            for out in precheck_errors:
+                writer.write(out)
+            run_judge_tasks(
+                tasks, writer, args.threads, judge_single, judge_group,
+                batch_size=args.judge_batch_size, desc="LLM判断正误"
+            )
+
+        compact_output(args.output)
+    if limiter is not None:
+        logging.info(limiter.summary())
+    if cache is not None:
+        logging.info(cache.summary())
+        cache.close()
+    if telemetry is not None:
+        telemetry.close()
     logging.info(f"全部处理完成，结果保存在 {args.output}")
 
 if __name__ == "__main__":
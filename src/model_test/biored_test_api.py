@@ -1,9 +1,78 @@
 import os
+import sys
 import json
 from openai import OpenAI
-from tqdm import tqdm
 import argparse
 import logging
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.checkpoint import get_done_set, report_resume, compact_output
+from common.jsonl_tail import FollowedInput, add_follow_args
+from common.jsonl_writer import OrderedJsonlWriter
+from common.judge_batch import batch_system_prompt, request_batch, run_judge_stream, run_judge_tasks
+from common.llm_call import create_chat
+from common.manifest import RecordManifest, record_hash, reuse_unchanged
+from common.response_cache import add_cache_args, open_cache
+from common.rate_limiter import add_limit_args, open_limiter
+from common.telemetry import add_telemetry_args, open_telemetry
+from common.label_rules import BIORED_ALIASES, RULES_VERSION, extract_candidate_labels, extract_label, rule_label_json
+
+def build_system_prompt(obj):
+    # 提取system字段至"based only on the information provided in the text"为止
+    system_full = obj.get("system", "").strip()
+    end_flag = "based only on the information provided in the text."
+    pos = system_full.find(end_flag)
+    if pos != -1:
+        system_part = system_full[:pos + len(end_flag)]
+    else:
+        system_part = system_full
+
+    # 拼接新system_prompt
+    return (
+        system_part +
+        '\nonly output a json contains a label, the output format examples are as follows: { "label": "Association" }; { "label": "bind" }; { "label": "Cotreatment" }'
+    )
+
+# 批量模式下每条的任务描述（含实体和候选关系）放进各自的条目里
+BATCH_SYSTEM_PROMPT = batch_system_prompt(
+    "Each item gives a relation extraction task and a model's answer to it. "
+    "Determine the relation label that the answer expresses, choosing only from the candidate relations listed in that item's task.",
+    '{ "idx": 0, "label": "Association" }'
+)
+
+def judge_one(cur_idx, system_prompt, user_prompt, client, model, max_retries=5, cache=None, telemetry=None, limiter=None):
+    wait_times = [5, 10, 15, 20, 25]
+    last_exception = None
+    for attempt in range(max_retries):
+        try:
+            kwargs = dict(
+                model=model,
+                messages=[
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": user_prompt},
+                ],
+                response_format={"type": "json_object"},
+            )
+            result = create_chat(client, kwargs, cache=cache, limiter=limiter, telemetry=telemetry, item=cur_idx).content
+            logging.info(f"第{cur_idx + 1}条成功生成。")
+            return {
+                "idx": cur_idx,
+                "label_json": result,
+                "label_source": "llm"
+            }
+        except Exception as e:
+            last_exception = e
+            logging.warning(f"第{cur_idx + 1}条第{attempt + 1}次请求出错：{e}")
+            if attempt < max_retries - 1:
+                time.sleep(wait_times[min(attempt, len(wait_times) - 1)])
+    errmsg = f"第{cur_idx + 1}条请求重试{max_retries}次仍失败：{last_exception}"
+    print(errmsg)
+    logging.error(errmsg)
+    return {
+        "idx": cur_idx,
+        "error": errmsg
+    }
 
 def main():
     parser = argparse.ArgumentParser()
@@ -13,6 +82,16 @@ def main():
     parser.add_argument("--log", default="biored-test.log", help="日志文件名")
     parser.add_argument("--api_key", default=os.getenv("DASHSCOPE_API_KEY"), help="API KEY")
     parser.add_argument("--base_url", default="https://dashscope.aliyuncs.com/compatible-mode/v1", help="API base url")
+    parser.add_argument("--threads", type=int, default=4, help="并发线程数量")
+    parser.add_argument("--max_retries", type=int, default=5, help="每条最大重试次数")
+    parser.add_argument("--judge_batch_size", type=int, default=1,
+                        help="每次请求打包判定的条数，大于1时按idx返回results数组，缺失或不合法的条目逐条补请求")
+    parser.add_argument("--rule_threshold", type=float, default=0.95,
+                        help="规则抽取标签的置信度不低于该值时直接写入label_json，不再请求LLM；默认只采用exact/json/marker/last_line，设为0.9可再加上全文只提到一种标签的single，设为大于1则全部走LLM")
+    add_cache_args(parser)
+    add_limit_args(parser)
+    add_telemetry_args(parser)
+    add_follow_args(parser, "答案")
     args = parser.parse_args()
 
     # 配置日志
@@ -23,63 +102,118 @@ def main():
         datefmt="%Y-%m-%d %H:%M:%S"
     )
     client = OpenAI(api_key=args.api_key, base_url=args.base_url)
+    cache = open_cache(args)
+    limiter = open_limiter(args, args.threads)
+    telemetry = open_telemetry(args, "biored", "test")
 
-    # 读取jsonl文件
-    with open(args.input, "r", encoding="utf-8") as fin:
-        items = [json.loads(line) for line in fin if line.strip()]
-
-    idx2out = {}
-    for idx, obj in enumerate(tqdm(items, desc="Refine label by LLM")):
-        cur_idx = obj.get("idx", idx)
-
-        # 提取system字段至"based only on the information provided in the text"为止
-        system_full = obj.get("system", "").strip()
-        end_flag = "based only on the information provided in the text."
-        pos = system_full.find(end_flag)
-        if pos != -1:
-            system_part = system_full[:pos + len(end_flag)]
-        else:
-            system_part = system_full
-
-        # 拼接新system_prompt
-        system_prompt = (
-            system_part +
-            '\nonly output a json contains a label, the output format examples are as follows: { "label": "Association" }; { "label": "bind" }; { "label": "Cotreatment" }'
-        )
+    config = {"stage": "biored_test", "model": args.model, "prompt": build_system_prompt({}), "rule_threshold": args.rule_threshold,
+              "rules": RULES_VERSION}
 
+    def prepare(cur_idx, obj):
+        """输出里已明确给出标签的，本地规则直接解析并返回输出记录，不再请求LLM；否则返回判定任务"""
+        system_prompt = build_system_prompt(obj)
         user_prompt = obj.get("llm_output", "").strip()
-        try:
-            completion = client.chat.completions.create(
-                model=args.model,
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_prompt},
-                ],
-                response_format={"type": "json_object"},
-            )
-            result = completion.choices[0].message.content
-            logging.info(f"第{cur_idx + 1}条成功生成。")
-            out = {
+        label, confidence, rule = extract_label(user_prompt, extract_candidate_labels(obj.get("system", "")), BIORED_ALIASES)
+        if label is not None and confidence >= args.rule_threshold:
+            return {
                 "idx": cur_idx,
-                "label_json": result
+                "label_json": rule_label_json(label),
+                "label_source": "rule",
+                "rule": rule,
+                "rule_confidence": confidence
             }
-        except Exception as e:
-            errmsg = f"第{cur_idx + 1}条请求出错：{e}"
-            print(errmsg)
-            logging.error(errmsg)
-            out = {
+        return (cur_idx, system_prompt, user_prompt)
+
+    def judge_single(cur_idx, system_prompt, user_prompt):
+        return judge_one(cur_idx, system_prompt, user_prompt, client, args.model, args.max_retries, cache, telemetry, limiter)
+
+    def judge_group(group):
+        candidates = {cur_idx: extract_candidate_labels(system_prompt) for cur_idx, system_prompt, _ in group}
+        entries = [
+            (cur_idx, f"Task: {system_prompt}\nAnswer: {user_prompt}")
+            for cur_idx, system_prompt, user_prompt in group
+        ]
+        results = request_batch(
+            client, args.model, BATCH_SYSTEM_PROMPT, entries,
+            lambda idx, entry: entry.get("label") in candidates[idx],
+            args.max_retries, cache, telemetry=telemetry, limiter=limiter, label=f"第{group[0][0] + 1}~{group[-1][0] + 1}条批量"
+        )
+        outs = []
+        for cur_idx, system_prompt, user_prompt in group:
+            entry = results.get(cur_idx)
+            if entry is None:
+                logging.warning(f"第{cur_idx + 1}条批量结果缺失或不合法，改为单条请求。")
+                outs.append(judge_single(cur_idx, system_prompt, user_prompt))
+                continue
+            logging.info(f"第{cur_idx + 1}条成功生成（批量）。")
+            outs.append({
                 "idx": cur_idx,
-                "error": errmsg
-            }
-        idx2out[cur_idx] = out
-
-    with open(args.output, "w", encoding="utf-8") as fout:
-        for obj in items:
-            cur_idx = obj.get("idx")
-            out = idx2out.get(cur_idx, {"idx": cur_idx, "error": "No result generated."})
-            fout.write(json.dumps(out, ensure_ascii=False) + "\n")
-            fout.flush()
+                "label_json": json.dumps({"label": entry["label"]}, ensure_ascii=False),
+                "label_source": "llm",
+                "judge_batch": len(group)
+            })
+        return outs
+
+    # 断点续跑：跳过已成功的idx，带error的记录会重新请求
+    done_set = get_done_set(args.output)
+    if args.follow:
+        # 流水线模式：答案边生成边判定，增量重算按到达的每条记录比对manifest，上游写出完成标记后结束
+        source = FollowedInput(
+            args.input, args.output, done_set, RecordManifest(args.output, config), prepare,
+            lambda cur_idx, obj: record_hash(obj), idle_timeout=args.follow_timeout or None
+        )
+        with OrderedJsonlWriter(args.output, [], mode="a") as writer:
+            run_judge_stream(
+                source.tasks(writer), writer, args.threads, judge_single, judge_group,
+                batch_size=args.judge_batch_size, desc="Refine label by LLM"
+            )
+        source.finish()
+        n_rule, n_llm = source.direct, source.submitted
+    else:
+        # 读取jsonl文件
+        with open(args.input, "r", encoding="utf-8") as fin:
+            items = [json.loads(line) for line in fin if line.strip()]
+
+        # 增量重算：按每条输入的内容哈希比对manifest，只重算输入变化的条目
+        input_hashes = {obj.get("idx", idx): record_hash(obj) for idx, obj in enumerate(items)}
+        done_set = reuse_unchanged(args.output, done_set, input_hashes, config)
+        report_resume(args.output, done_set)
+
+        tasks = []
+        rule_outs = []
+        expected = []
+        for idx, obj in enumerate(items):
+            cur_idx = obj.get("idx", idx)
+            if cur_idx in done_set:
+                continue
+            expected.append(cur_idx)
+            prepared = prepare(cur_idx, obj)
+            if isinstance(prepared, dict):
+                rule_outs.append(prepared)
+            else:
+                tasks.append(prepared)
+
+        # 并发请求，结果按输入顺序逐条追加落盘
+        with OrderedJsonlWriter(args.output, expected, mode="a") as writer:
+            for out in rule_outs:
+                writer.write(out)
+            run_judge_tasks(
+                tasks, writer, args.threads, judge_single, judge_group,
+                batch_size=args.judge_batch_size, desc="Refine label by LLM"
+            )
+
+        # 没有结果的条目补错误记录，下游统计的分母与输入条数一致
+        compact_output(args.output, expected_ids=list(input_hashes))
+        n_rule, n_llm = len(rule_outs), len(tasks)
+    logging.info(f"规则解析{n_rule}条，LLM判定{n_llm}条")
+    if limiter is not None:
+        logging.info(limiter.summary())
+    if cache is not None:
+        logging.info(cache.summary())
+        cache.close()
+    if telemetry is not None:
+        telemetry.close()
     logging.info(f"全部处理完成，结果保存在 {args.output}")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
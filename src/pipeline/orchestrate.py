@@ -0,0 +1,414 @@
+import os
+import re
+import sys
+import json
+import time
+import shlex
+import argparse
+import logging
+import subprocess
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.checkpoint import get_done_set, load_records
+from common.jsonl_tail import clear_done
+from common.manifest import manifest_path
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EVAL_DIR = "data/evaluation"
+
+# 每个benchmark各阶段的脚本；新文件名中的benchmark按键名书写，已有结果的大小写不统一（如-biored-/-bioRED-），由resolve_existing匹配
+BENCHMARKS = {
+    "chemprot": {
+        "file": "chemprot.json",
+        "answer": "model_answer_generation/chemprot_answer_api.py",
+        "test": "model_test/chemprot_test_api.py",
+        "result": "model_result/chemprot_test_result.py",
+        "gpt": "gpt_test/chemprot_gpt_api.py",
+    },
+    "bioRED": {
+        "file": "bioRED.json",
+        "answer": "model_answer_generation/biored_answer_api.py",
+        "test": "model_test/biored_test_api.py",
+        "result": "model_result/biored_test_result.py",
+        "gpt": "gpt_test/biored_gpt_api.py",
+    },
+    "bioASQ": {
+        "file": "BioASQ.json",
+        "answer": "model_answer_generation/bioasq_answer_api.py",
+        "test": "model_test/bioASQ_test_api.py",
+        "result": "model_result/bioASQ_test_result.py",
+        "bert": "model_result/bioASQ_bert_result.py",
+        "gpt": "gpt_test/bioASQ_gpt_api.py",
+    },
+}
+API_STAGES = ("answer", "test", "gpt")
+STAGE_ORDER = ("answer", "test", "result", "bert", "gpt", "gpt_result")
+# 同时可运行时优先调度下游节点，尽快出完整结果
+STAGE_PRIORITY = {"gpt_result": 0, "result": 0, "bert": 1, "test": 2, "gpt": 2, "answer": 3}
+
+class Node:
+    """
+    DAG中的一个节点：一条脚本命令，inputs为依赖的文件，deps为上游节点名。
+    stream_dep为可流水线跟随的上游（answer）：它一开始运行本节点即可带--follow启动，不必等它结束。
+    """
+    def __init__(self, name, stage, model, benchmark, cmd, output, inputs, deps, stream_dep=None):
+        self.name = name
+        self.stage = stage
+        self.model = model
+        self.benchmark = benchmark
+        self.cmd = cmd
+        self.output = output
+        self.inputs = inputs
+        self.deps = deps
+        self.stream_dep = stream_dep
+        self.following = False
+        self.state = "pending"
+        self.proc = None
+        self.started = None
+        self.elapsed = None
+
+    @property
+    def uses_api(self):
+        return self.stage in API_STAGES
+
+def family_of(model):
+    """按模型名推断data/evaluation下的厂商目录"""
+    name = model.lower()
+    if name.startswith("deepseek"):
+        return "DeepSeek"
+    if name.startswith("qwen"):
+        return "Qwen"
+    return "Other"
+
+def discover_models(eval_dir):
+    """已有结果目录下出现过的(厂商, 模型)"""
+    models = set()
+    for stage_dir in ("model_answer", "model_test", "gpt_test", "model_result"):
+        root = os.path.join(eval_dir, stage_dir)
+        if not os.path.isdir(root):
+            continue
+        for family in os.listdir(root):
+            family_dir = os.path.join(root, family)
+            if not os.path.isdir(family_dir):
+                continue
+            for model in os.listdir(family_dir):
+                if os.path.isdir(os.path.join(family_dir, model)):
+                    models.add((family, model))
+    return sorted(models)
+
+def parse_models(text, eval_dir):
+    if not text:
+        return discover_models(eval_dir)
+    models = []
+    for entry in text.split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        if "/" in entry:
+            family, model = entry.split("/", 1)
+        else:
+            family, model = family_of(entry), entry
+        models.append((family, model))
+    return models
+
+def resolve_existing(path):
+    """
+    已有结果文件名中benchmark的大小写不统一（如deepseek-r1-biored-result.txt和qwen3-8b-bioRED-result.txt），
+    path不存在时在同目录下按文件名忽略大小写查找已有文件，找到则沿用，否则返回原路径。
+    """
+    if os.path.exists(path):
+        return path
+    folder, name = os.path.split(path)
+    if not os.path.isdir(folder):
+        return path
+    matches = sorted(f for f in os.listdir(folder) if f.lower() == name.lower())
+    return os.path.join(folder, matches[0]) if matches else path
+
+def build_dag(args, models, benchmarks):
+    """
+    每个模型×benchmark：answer → test → result，answer → gpt → gpt_result，bioASQ另有answer → bert。
+    返回{节点名: Node}。
+    """
+    ev = args.eval_dir
+    py = sys.executable
+    nodes = {}
+    no_thinking = re.compile(args.no_thinking_models) if args.no_thinking_models else None
+    api_common = []
+    if args.api_key:
+        api_common += ["--api_key", args.api_key]
+    if args.base_url:
+        api_common += ["--base_url", args.base_url]
+    # 总请求速率按API节点并发数平分，每个API节点（answer/test/gpt）各带一份给自己的共享限流器
+    if args.max_rps > 0:
+        api_common += ["--adaptive_limit", "--max_rps", f"{args.max_rps / args.max_api_jobs:.3f}"]
+    # 汇总类脚本输入未变化时会按manifest跳过，--force时一并强制重算
+    force = ["--force"] if args.force else []
+
+    def add(node):
+        nodes[node.name] = node
+
+    for family, model in models:
+        for bench in benchmarks:
+            conf = BENCHMARKS[bench]
+            tag = f"{model}-{bench}"
+            log = lambda stage: os.path.join(args.log_dir, f"{tag}-{stage}.log")
+            script = lambda stage: os.path.join(SRC_DIR, conf[stage])
+            benchmark_file = os.path.join(ev, "benchmark", conf["file"])
+            answer = resolve_existing(os.path.join(ev, "model_answer", family, model, f"{tag}-answer.json"))
+            test = resolve_existing(os.path.join(ev, "model_test", family, model, f"{tag}-test.json"))
+            result = resolve_existing(os.path.join(ev, "model_result", family, model, f"{tag}-result.txt"))
+            gpt = resolve_existing(os.path.join(ev, "gpt_test", family, model, f"{tag}-gpt.json"))
+            gpt_result = resolve_existing(os.path.join(ev, "gpt_result", model, f"{tag}-gpt.txt"))
+
+            if "answer" in args.stages:
+                cmd = [py, script("answer"), "--model", model, "--input", benchmark_file, "--output", answer,
+                       "--log", log("answer")] + api_common
+                if no_thinking and no_thinking.search(model):
+                    if bench == "bioASQ":
+                        cmd += ["--enable_thinking_round1", "--enable_thinking_round2"]
+                    else:
+                        cmd += ["--enable_thinking"]
+                cmd += shlex.split(args.answer_args)
+                add(Node(f"{tag}:answer", "answer", model, bench, cmd, answer, [benchmark_file], []))
+            answer_dep = [f"{tag}:answer"] if "answer" in args.stages else []
+            stream_dep = answer_dep[0] if args.stream and answer_dep else None
+
+            if "test" in args.stages:
+                cmd = [py, script("test"), "--model", args.judge_model, "--input", answer, "--output", test,
+                       "--log", log("test")] + api_common
+                if bench == "bioASQ":
+                    cmd += ["--gold", benchmark_file]
+                cmd += shlex.split(args.test_args)
+                add(Node(f"{tag}:test", "test", model, bench, cmd, test, [answer], answer_dep, stream_dep))
+            if "result" in args.stages:
+                cmd = [py, script("result"), "--test", test, "--result", result] + force
+                if bench != "bioASQ":
+                    cmd += ["--benchmark", benchmark_file]
+                deps = [f"{tag}:test"] if "test" in args.stages else []
+                add(Node(f"{tag}:result", "result", model, bench, cmd, result, [test], deps))
+            if "bert" in args.stages and "bert" in conf:
+                bert = resolve_existing(os.path.join(ev, "model_result", family, model, f"{tag}-bert.txt"))
+                cmd = [py, script("bert"), "--benchmark", benchmark_file, "--answer", answer, "--result", bert,
+                       "--log", log("bert")] + force + shlex.split(args.bert_args)
+                add(Node(f"{tag}:bert", "bert", model, bench, cmd, bert, [answer], answer_dep))
+            if "gpt" in args.stages:
+                cmd = [py, script("gpt"), "--model", args.judge_model, "--benchmark", benchmark_file,
+                       "--answer", answer, "--output", gpt, "--log", log("gpt")] + api_common
+                cmd += shlex.split(args.gpt_args)
+                add(Node(f"{tag}:gpt", "gpt", model, bench, cmd, gpt, [answer], answer_dep, stream_dep))
+            if "gpt_result" in args.stages:
+                cmd = [py, os.path.join(SRC_DIR, "gpt_result/gpt_result.py"), "--test", gpt, "--result", gpt_result] + force
+                deps = [f"{tag}:gpt"] if "gpt" in args.stages else []
+                add(Node(f"{tag}:gpt_result", "gpt_result", model, bench, cmd, gpt_result, [gpt], deps))
+    return nodes
+
+def input_ids(path):
+    """输入文件中全部idx（answer输出或benchmark都是带idx的JSONL）"""
+    return {r["idx"] for r in load_records(path) if "idx" in r}
+
+def is_up_to_date(node):
+    """
+    输出比所有输入都新，且API阶段的输出已覆盖输入的全部idx（没有残留可重试的error记录）时视为已完成，跳过。
+    标为final的预检失败记录（如bioASQ缺gold、提取不到预测答案）重跑结果不变，按已完成计。
+    API阶段未完成时重跑会自动续跑，只补缺失和失败的部分。
+    """
+    if not os.path.exists(node.output):
+        return False
+    out_mtime = os.path.getmtime(node.output)
+    for path in node.inputs:
+        if not os.path.exists(path) or os.path.getmtime(path) > out_mtime:
+            return False
+    if node.uses_api:
+        expected = set()
+        for path in node.inputs:
+            expected |= input_ids(path)
+        if not expected <= get_done_set(node.output):
+            return False
+    return True
+
+def discard_output(path):
+    """--force时在节点启动前删除逐条输出及其manifest，API阶段不再续跑、复用已有记录"""
+    for p in (path, manifest_path(path)):
+        if os.path.exists(p):
+            os.remove(p)
+            logging.info(f"--force：已删除{p}")
+
+def mark_up_to_date(nodes, force=False):
+    """已是最新的节点标为skipped；上游将要重跑时下游也要重跑"""
+    for node in nodes.values():
+        if not force and is_up_to_date(node):
+            node.state = "skipped"
+    changed = True
+    while changed:
+        changed = False
+        for node in nodes.values():
+            if node.state == "skipped" and any(nodes[d].state == "pending" for d in node.deps if d in nodes):
+                node.state = "pending"
+                changed = True
+
+def run_dag(nodes, args):
+    """
+    全局调度：依赖都成功的节点进入就绪队列，同时运行的子进程不超过max_jobs，
+    其中调用API的不超过max_api_jobs、本地计算的不超过max_local_jobs；失败节点的下游全部跳过。
+    --stream时test/gpt节点在answer节点启动后即带--follow启动，answer失败则终止正在跟随它的节点。
+    """
+    os.makedirs(args.log_dir, exist_ok=True)
+    mark_up_to_date(nodes, args.force)
+    running = []
+    total = sum(1 for n in nodes.values() if n.state == "pending")
+    finished = 0
+    logging.info(f"共{len(nodes)}个节点，需运行{total}个，已是最新{len(nodes) - total}个")
+    print(f"共{len(nodes)}个节点，需运行{total}个，已是最新{len(nodes) - total}个")
+
+    def deps_state(node):
+        states = {d: nodes[d].state for d in node.deps if d in nodes}
+        if any(s in ("failed", "cancelled") for s in states.values()):
+            return "cancelled"
+        if all(s in ("done", "skipped") or (d == node.stream_dep and s == "running") for d, s in states.items()):
+            return "ready"
+        return "waiting"
+
+    while True:
+        # 回收已结束的子进程
+        for node in list(running):
+            code = node.proc.poll()
+            if code is None:
+                continue
+            running.remove(node)
+            node.log_file.close()
+            node.elapsed = time.time() - node.started
+            finished += 1
+            if node.state == "cancelled":
+                logging.warning(f"[{finished}/{total}] {node.name} 跟随的上游失败，已终止")
+                continue
+            node.state = "done" if code == 0 else "failed"
+            msg = f"[{finished}/{total}] {node.name} {'完成' if code == 0 else f'失败(退出码{code})'}，耗时{node.elapsed:.1f}s"
+            print(msg)
+            (logging.info if code == 0 else logging.error)(msg)
+            if code != 0:
+                # 正在跟随它输出的下游不会再等到完成标记，直接终止
+                for follower in running:
+                    if follower.following and follower.stream_dep == node.name:
+                        follower.state = "cancelled"
+                        follower.proc.terminate()
+
+        ready = []
+        for node in nodes.values():
+            if node.state != "pending":
+                continue
+            state = deps_state(node)
+            if state == "cancelled":
+                node.state = "cancelled"
+                finished += 1
+                logging.warning(f"{node.name} 的上游失败，跳过")
+            elif state == "ready":
+                ready.append(node)
+        ready.sort(key=lambda n: (STAGE_PRIORITY[n.stage], n.model, n.benchmark))
+
+        api_running = sum(1 for n in running if n.uses_api)
+        local_running = len(running) - api_running
+        for node in ready:
+            if len(running) >= args.max_jobs:
+                break
+            if node.uses_api and api_running >= args.max_api_jobs:
+                continue
+            if not node.uses_api and local_running >= args.max_local_jobs:
+                continue
+            os.makedirs(os.path.dirname(node.output) or ".", exist_ok=True)
+            cmd = node.cmd
+            if node.stream_dep in nodes and nodes[node.stream_dep].state == "running":
+                cmd = cmd + ["--follow"]
+                node.following = True
+            if args.force and node.uses_api:
+                discard_output(node.output)
+            if args.stream and node.stage == "answer":
+                # 先清掉上次的完成标记，避免跟随的下游读到旧标记提前结束
+                clear_done(node.output)
+            node.log_file = open(os.path.join(args.log_dir, f"{node.name.replace(':', '-')}.out"), "a", encoding="utf-8")
+            logging.info(f"启动 {node.name}：{' '.join(shlex.quote(c) for c in cmd)}")
+            node.proc = subprocess.Popen(cmd, stdout=node.log_file, stderr=subprocess.STDOUT)
+            node.started = time.time()
+            node.state = "running"
+            running.append(node)
+            if node.uses_api:
+                api_running += 1
+            else:
+                local_running += 1
+
+        if not running and not any(n.state == "pending" for n in nodes.values()):
+            break
+        time.sleep(args.poll_interval)
+
+    return {state: sorted(n.name for n in nodes.values() if n.state == state)
+            for state in ("done", "skipped", "failed", "cancelled")}
+
+def main():
+    parser = argparse.ArgumentParser(description="按 模型×benchmark 构建 answer → test → result / gpt_test → gpt_result 的DAG，全局并发调度")
+    parser.add_argument("--models", default=None,
+                        help="模型列表，逗号分隔，可写成 厂商/模型（如 Qwen/qwen3-8b）；默认取data/evaluation下已有的全部模型")
+    parser.add_argument("--benchmarks", default="chemprot,bioRED,bioASQ", help="benchmark列表，逗号分隔")
+    parser.add_argument("--stages", default="answer,test,result,bert,gpt,gpt_result", help="要运行的阶段，逗号分隔")
+    parser.add_argument("--eval_dir", default=EVAL_DIR, help="评测数据根目录")
+    parser.add_argument("--log_dir", default="logs/orchestrate", help="各节点日志和标准输出目录")
+    parser.add_argument("--judge_model", default="qwen-max-latest", help="model_test和gpt_test使用的裁判模型")
+    parser.add_argument("--api_key", default=None, help="传给所有API阶段的API KEY，不传则各脚本用自己的默认值")
+    parser.add_argument("--base_url", default=None, help="传给所有API阶段的base url（可指向本地模拟接口）")
+    parser.add_argument("--no_thinking_models", default="^qwen3",
+                        help="名称匹配该正则的模型生成答案时关闭thinking（Qwen3开源模型），空字符串则不处理")
+    parser.add_argument("--answer_args", default="--threads 8", help="追加给answer阶段的参数")
+    parser.add_argument("--test_args", default="--threads 8", help="追加给test阶段的参数")
+    parser.add_argument("--gpt_args", default="--threads 8", help="追加给gpt阶段的参数")
+    parser.add_argument("--bert_args", default="", help="追加给bert阶段的参数")
+    parser.add_argument("--max_jobs", type=int, default=8, help="同时运行的节点总数上限")
+    parser.add_argument("--max_api_jobs", type=int, default=6,
+                        help="同时运行的API节点上限；总请求并发约为该值乘以各阶段的--threads")
+    parser.add_argument("--max_rps", type=float, default=0,
+                        help="所有API阶段（answer/test/gpt）的总请求速率上限（次/秒），按max_api_jobs平分给各节点的自适应限流器，0为不限")
+    parser.add_argument("--max_local_jobs", type=int, default=max(1, (os.cpu_count() or 2) // 2),
+                        help="同时运行的本地计算节点（result/bert/gpt_result）上限")
+    parser.add_argument("--stream", action="store_true",
+                        help="流水线模式：answer节点一启动，其test/gpt节点即带--follow边读答案边判定，不等answer结束")
+    parser.add_argument("--force", action="store_true", help="忽略已有输出，全部重跑：API阶段启动前删除原输出和manifest，汇总阶段加--force")
+    parser.add_argument("--dry_run", action="store_true", help="只打印DAG和每个节点是否需要运行")
+    parser.add_argument("--poll_interval", type=float, default=0.5, help="调度循环的轮询间隔（秒）")
+    parser.add_argument("--log", default="orchestrate.log", help="调度日志文件名")
+    args = parser.parse_args()
+    args.stages = [s.strip() for s in args.stages.split(",") if s.strip()]
+    for stage in args.stages:
+        if stage not in STAGE_ORDER:
+            parser.error(f"未知阶段：{stage}，可选 {', '.join(STAGE_ORDER)}")
+    benchmarks = [b.strip() for b in args.benchmarks.split(",") if b.strip()]
+    for bench in benchmarks:
+        if bench not in BENCHMARKS:
+            parser.error(f"未知benchmark：{bench}，可选 {', '.join(BENCHMARKS)}")
+
+    logging.basicConfig(
+        filename=args.log,
+        level=logging.INFO,
+        format="%(asctime)s [%(levelname)s] %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S"
+    )
+    models = parse_models(args.models, args.eval_dir)
+    nodes = build_dag(args, models, benchmarks)
+
+    if args.dry_run:
+        mark_up_to_date(nodes, args.force)
+        for node in sorted(nodes.values(), key=lambda n: (n.model, n.benchmark, STAGE_ORDER.index(n.stage))):
+            status = "最新" if node.state == "skipped" else "需运行"
+            deps = ",".join(d.split(":")[1] for d in node.deps) or "-"
+            print(f"{node.name:<55} 依赖:{deps:<8} {status}  {' '.join(shlex.quote(c) for c in node.cmd)}")
+        return
+
+    start = time.time()
+    summary = run_dag(nodes, args)
+    elapsed = time.time() - start
+    msg = (f"全部结束，耗时{elapsed:.1f}s：完成{len(summary['done'])}个，已是最新{len(summary['skipped'])}个，"
+           f"失败{len(summary['failed'])}个，因上游失败跳过{len(summary['cancelled'])}个")
+    print(msg)
+    logging.info(msg)
+    if summary["failed"]:
+        print("失败节点：" + json.dumps(summary["failed"], ensure_ascii=False))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()